@@ -0,0 +1,255 @@
+"""
+Asyncio download engine for the Sentinel Hub Processing API.
+
+Every request sent through one engine shares a single OAuth token and a single
+aiohttp connection pool, concurrency is bounded by a semaphore.
+Docks https://docs.sentinel-hub.com/api/latest/api/overview/authentication/
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+
+import settings
+from cache import cacheable, request_key
+from metrics import REGISTRY
+from scheduler import RetryableError, Scheduler, estimate_processing_units, parse_retry_after
+from utils import atomic_write
+
+log = logging.getLogger(__name__)
+
+
+class OAuthToken(object):
+    """
+    OAuth client credentials token shared by all coroutines of an engine.
+    Token is fetched lazily and refreshed shortly before it expires.
+    """
+
+    def __init__(self, session, client_id, client_secret, token_url):
+        self.session = session
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self._token = None
+        self._expires_at = 0
+        self._lock = asyncio.Lock()
+
+    def is_valid(self):
+        return (
+            self._token is not None
+            and time.time() < self._expires_at - settings.OAUTH_TOKEN_LEEWAY
+        )
+
+    def invalidate(self):
+        self._token = None
+
+    async def header(self):
+        if not self.is_valid():
+            async with self._lock:
+                # other coroutine could refresh token while we were waiting
+                if not self.is_valid():
+                    await self._fetch()
+        return {"Authorization": f"Bearer {self._token}"}
+
+    async def _fetch(self):
+        data = {
+            "grant_type": "client_credentials",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+        }
+        async with self.session.post(self.token_url, data=data) as resp:
+            resp.raise_for_status()
+            body = await resp.json()
+        self._token = body["access_token"]
+        self._expires_at = time.time() + body.get("expires_in", 3600)
+        log.debug("OAuth token received, expires in {0} s".format(
+            body.get("expires_in")))
+
+
+class AsyncDownloadEngine(object):
+    """
+    Usage:
+        async with AsyncDownloadEngine(config) as engine:
+            await engine.execute_all(download_requests)
+    """
+
+    def __init__(self, config, max_concurrency=None, connection_limit=None, cache=None,
+                 scheduler=None, callback=None):
+        """
+        :param callback: called as callback(download_request, content, error)
+        when request is done or failed
+        """
+        self.config = config
+        self.cache = cache
+        self.callback = callback
+        self.scheduler = scheduler
+        self.max_concurrency = max_concurrency or settings.ASYNC_MAX_CONCURRENCY
+        self.connection_limit = connection_limit or settings.ASYNC_CONNECTION_LIMIT
+        self.session = None
+        self.token = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.connection_limit)
+        timeout = aiohttp.ClientTimeout(total=settings.DOWNLOAD_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.token = OAuthToken(
+            self.session,
+            self.config.sh_client_id,
+            self.config.sh_client_secret,
+            settings.SENTINEL_HUB_OAUTH_URL,
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self.scheduler is None:
+            self.scheduler = Scheduler()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        log.info("SCHEDULER: {0}".format(self.scheduler.stats))
+        await self.session.close()
+        self.session = None
+
+    async def post(self, url, payload, headers=None, job=None):
+        """
+        POST json payload with auth header, token is refreshed once on 401.
+        :param url: endpoint url
+        :param payload: json serializable body
+        :param headers: additional headers
+        :param job: metrics.JobMetrics, oauth/ttfb/transfer phases are recorded
+        :return: raw response content
+        :raises RetryableError: on 429 and 5xx
+        """
+        job = job or REGISTRY.job(url)
+        for attempt in range(2):
+            req_headers = dict(headers or {})
+            with job.phase("oauth"):
+                req_headers.update(await self.token.header())
+            sent = time.perf_counter()
+            async with self.session.post(url, json=payload, headers=req_headers) as resp:
+                job.add_phase("ttfb", time.perf_counter() - sent)
+                if resp.status == 401 and attempt == 0:
+                    self.token.invalidate()
+                    continue
+                if resp.status == 429 or resp.status >= 500:
+                    raise RetryableError(
+                        resp.status, parse_retry_after(resp.headers.get("Retry-After")))
+                resp.raise_for_status()
+                with job.phase("transfer"):
+                    content = await resp.read()
+                job.bytes += len(content)
+                return content
+
+    async def execute(self, download_request):
+        """
+        Execute sentinelhub DownloadRequest (SentinelHubRequest.download_list item)
+        and store response in the same place get_data(save_data=True) does.
+        :param download_request: sentinelhub.DownloadRequest
+        :return: raw response content
+        """
+        job = REGISTRY.job(download_request.get_hashed_name(), engine="async")
+        try:
+            with job.phase("cache"):
+                key = None
+                if self.cache and cacheable(download_request):
+                    key = request_key(download_request)
+                content = self.cache.get(key) if key else None
+            job.cache_hit = content is not None
+            if content is None:
+                content = await self.download(download_request, job)
+                if key:
+                    with job.phase("write"):
+                        self.cache.put(key, content)
+            if download_request.save_response:
+                with job.phase("write"):
+                    save_response(download_request, content)
+        except Exception as exc:
+            job.finish("failed")
+            if self.callback:
+                self.callback(download_request, None, exc)
+            raise
+        job.finish()
+        if self.callback:
+            self.callback(download_request, content, None)
+        return content
+
+    async def download(self, download_request, job=None):
+        """
+        Send request when scheduler budgets allow it,
+        only this request is retried on 429/5xx.
+        """
+        job = job or REGISTRY.job(download_request.get_hashed_name(), engine="async")
+        return await self.send(
+            download_request.url,
+            download_request.post_values,
+            headers=download_request.headers,
+            units=estimate_processing_units(download_request),
+            name=download_request.get_hashed_name(),
+            job=job,
+        )
+
+    async def send(self, url, payload, headers=None, units=0.0, name=None, job=None):
+        """
+        post through scheduler budgets and concurrency limit,
+        retried with backoff on 429/5xx and connection errors.
+        :param units: processing units of request, 0 for Catalog and other APIs
+        :param name: request name in logs, default url
+        """
+        job = job or REGISTRY.job(name or url, engine="async")
+        for attempt in range(settings.SCHEDULER_MAX_RETRIES + 1):
+            try:
+                queued = time.perf_counter()
+                await self.scheduler.acquire(units)
+                async with self._semaphore:
+                    job.add_phase("queue", time.perf_counter() - queued)
+                    job.processing_units += units
+                    return await self.post(url, payload, headers=headers, job=job)
+            except (RetryableError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                if attempt == settings.SCHEDULER_MAX_RETRIES:
+                    raise
+                job.retries += 1
+                error = exc if isinstance(exc, RetryableError) else RetryableError(None)
+                delay = self.scheduler.backoff(attempt, error)
+                log.warning("Request {0} failed with {1}, retry in {2:.1f} s".format(
+                    name or url, exc, delay))
+                await asyncio.sleep(delay)
+
+    async def execute_all(self, download_requests):
+        """
+        Execute all requests concurrently, one failed request does not stop others.
+        :return: list of contents or exceptions in order of download_requests
+        """
+        results = await asyncio.gather(
+            *[self.execute(req) for req in download_requests],
+            return_exceptions=True
+        )
+        for req, res in zip(download_requests, results):
+            if isinstance(res, Exception):
+                log.error("Request {0} failed: {1}".format(
+                    req.get_hashed_name(), res))
+        return results
+
+
+def save_response(download_request, content):
+    request_path, response_path = download_request.get_storage_paths()
+    atomic_write(response_path, content)
+    atomic_write(
+        request_path,
+        json.dumps(download_request.get_request_params(include_metadata=True),
+                   indent=4).encode()
+    )
+    log.debug(f"Files Saved in {os.path.dirname(response_path)}")
+
+
+def run_requests(config, download_requests, max_concurrency=None, cache=None, callback=None):
+    """
+    Sync entry point, runs all download requests in a new event loop.
+    """
+    async def _run():
+        async with AsyncDownloadEngine(config, max_concurrency, cache=cache,
+                                       callback=callback) as engine:
+            return await engine.execute_all(download_requests)
+
+    return asyncio.run(_run())
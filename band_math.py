@@ -0,0 +1,153 @@
+"""
+Local NumPy rendering of NDVI visualizations from settings.BAND_TYPES.
+Raw B04, B08 and dataMask are downloaded once (settings.RAW_BANDS_EVALSCRIPT)
+and every visualization is computed here over whole date stacks,
+instead of one server side evalscript request per band type.
+Color stops follow the Sentinel Hub evalscript V3 visualizers
+https://docs.sentinel-hub.com/api/latest/evalscript/functions/
+"""
+import numpy as np
+
+# ColorMapVisualizer.createDefaultColorMap(), discrete steps
+DEFAULT_COLOR_MAP = [
+    (-1.0, 0x000000),
+    (-0.2, 0xFF0000),
+    (-0.1, 0x9A0000),
+    (0.0, 0x660000),
+    (0.1, 0xFFFF33),
+    (0.2, 0xCCCC33),
+    (0.3, 0x666600),
+    (0.4, 0x33FFFF),
+    (0.5, 0x33CCCC),
+    (0.6, 0x006666),
+    (0.7, 0x33FF33),
+    (0.8, 0x33CC33),
+    (0.9, 0x006600),
+]
+
+# ColorGradientVisualizer.create*(0, 1), linear interpolation between stops
+BLUE_RED = [
+    (0.0, 0x000080),
+    (0.125, 0x0000FF),
+    (0.375, 0x00FFFF),
+    (0.625, 0xFFFF00),
+    (0.875, 0xFF0000),
+    (1.0, 0x800000),
+]
+WHITE_GREEN = [
+    (0.0, 0xFFFFFF),
+    (1.0, 0x008000),
+]
+RED_TEMPERATURE = [
+    (0.0, 0x000000),
+    (0.525, 0xAE0000),
+    (0.85, 0xFF6E00),
+    (1.0, 0xFFFFFF),
+]
+
+# HighlightCompressVisualizer compresses values above this part of range
+HIGHLIGHT_KNEE = 0.92
+
+# band order of RAW_BANDS_EVALSCRIPT output
+B04, B08, DATA_MASK = 0, 1, 2
+
+
+def ndvi(b08, b04):
+    """
+    index(B08, B04) of evalscript, 0 where both bands are 0.
+    """
+    total = b08 + b04
+    with np.errstate(divide="ignore", invalid="ignore"):
+        val = np.where(total == 0, 0.0, (b08 - b04) / total)
+    return val.astype(np.float32)
+
+
+def _stops(stops):
+    values = np.array([s[0] for s in stops], dtype=np.float32)
+    colors = np.array(
+        [((c >> 16) & 0xFF, (c >> 8) & 0xFF, c & 0xFF) for _, c in stops],
+        dtype=np.float32
+    ) / 255.0
+    return values, colors
+
+
+def color_map(values, stops):
+    """
+    :return: values.shape + (3,) rgb in [0, 1], color of last stop <= value
+    """
+    thresholds, colors = _stops(stops)
+    idx = np.searchsorted(thresholds, values, side="right") - 1
+    return colors[np.clip(idx, 0, len(colors) - 1)]
+
+
+def color_gradient(values, stops):
+    """
+    :return: values.shape + (3,) rgb in [0, 1] interpolated between stops
+    """
+    thresholds, colors = _stops(stops)
+    return np.stack(
+        [np.interp(values, thresholds, colors[:, c]) for c in range(3)],
+        axis=-1
+    ).astype(np.float32)
+
+
+def highlight_compress(values, min_value=0.0, max_value=1.0):
+    """
+    HighlightCompressVisualizerSingle, linear in [min_value, max_value]
+    with highlights compressed toward 1.
+    """
+    val = np.clip((values - min_value) / (max_value - min_value), 0.0, None)
+    over = np.clip(val - HIGHLIGHT_KNEE, 0.0, None)
+    compressed = HIGHLIGHT_KNEE + (1 - HIGHLIGHT_KNEE) * (
+        1 - np.exp(-over / (1 - HIGHLIGHT_KNEE)))
+    return np.where(val > HIGHLIGHT_KNEE, compressed, val)[..., np.newaxis]
+
+
+VISUALIZERS = {
+    "NDVI-CM": lambda val: color_map(val, DEFAULT_COLOR_MAP),
+    "NDVIGV": highlight_compress,
+    "NDVIRainbow": lambda val: color_gradient(val, BLUE_RED),
+    "NDVIGTW": lambda val: color_gradient(val, WHITE_GREEN),
+    "NDVIRTWL": lambda val: color_gradient(val, RED_TEMPERATURE),
+    "NDVIINDEX": lambda val: val[..., np.newaxis],
+}
+
+
+def check_local_band(band_name):
+    if band_name not in VISUALIZERS:
+        raise ValueError("Band type {0} can not be rendered locally, use one of {1}".format(
+            band_name, ", ".join(VISUALIZERS)))
+    return band_name
+
+
+def auto_scale(values):
+    """
+    sampleType AUTO of Processing API, [0, 1] -> [0, 255] uint8
+    """
+    return (np.clip(values, 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+
+
+def _render(band_name, val, mask):
+    out = VISUALIZERS[band_name](val)
+    return auto_scale(np.concatenate([out, mask[..., np.newaxis]], axis=-1))
+
+
+def render(band_name, raw):
+    """
+    :param band_name: key of VISUALIZERS
+    :param raw: float32 array (..., height, width, 3) with B04, B08, dataMask
+    :return: uint8 array (..., height, width, bands) same as server side PNG
+    """
+    return _render(band_name, ndvi(raw[..., B08], raw[..., B04]), raw[..., DATA_MASK])
+
+
+def render_stack(band_names, raw_stack):
+    """
+    NDVI is computed once for the whole stack and shared by all band types.
+    :param band_names: list of band types
+    :param raw_stack: float32 array (dates, height, width, 3)
+    :return: dict band name -> uint8 array (dates, height, width, bands)
+    """
+    val = ndvi(raw_stack[..., B08], raw_stack[..., B04])
+    mask = raw_stack[..., DATA_MASK]
+    return {name: _render(name, val, mask) for name in band_names}
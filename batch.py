@@ -0,0 +1,231 @@
+"""
+Batch runner for many fields of settings.FIELDS in one process.
+All (field, date, band) jobs go into one queue and are executed through one
+AsyncDownloadEngine, so every field shares one OAuth token and connection pool.
+
+python batch.py -b NDVIGV,TRUE-COLORHC
+python batch.py --fields test,other -t 2020-05-01,2020-05-30 -b NDVIGV
+python batch.py --fields-file fields.txt -b NDVIGV
+"""
+import argparse
+import collections
+import logging
+
+import settings
+from cache import ResponseCache
+from fields_photo_downloader import GISImageDownloader
+from utils import init_logger, lazy_import, timeit
+
+asyncio = lazy_import("asyncio")
+estimator = lazy_import("estimator")
+AsyncDownloadEngine = lazy_import("async_engine", "AsyncDownloadEngine")
+needs_tiling = lazy_import("tiling", "needs_tiling")
+
+log = logging.getLogger(__name__)
+
+Job = collections.namedtuple("Job", ["field", "date", "band_type", "download_request"])
+
+
+class BatchRunner(object):
+    def __init__(self, field_names, band_types, time_range=None, all_dates=False):
+        """
+        :param field_names: list of settings.FIELDS keys
+        :param band_types: list of settings.BAND_TYPES keys
+        :param time_range: (start_date, end_date), default is field "time_range"
+        :param all_dates: request every day without catalog search,
+        always with settings.CATALOG_PLANNING False
+        """
+        self.cache = ResponseCache() if settings.RESPONSE_CACHE else None
+        self.downloaders = collections.OrderedDict(
+            (name, GISImageDownloader(name, cache=self.cache)) for name in field_names
+        )
+        self.band_types = check_band_types(band_types)
+        self.time_range = time_range
+        self.all_dates = all_dates or not settings.CATALOG_PLANNING
+        self.progress = {}
+        # request hash -> downloader of its field, see request_result
+        self.request_fields = {}
+
+    def field_dates(self, downloader):
+        if self.time_range:
+            return downloader.dates_range(self.time_range)
+        return downloader.dates_range((downloader.start_date, downloader.end_date))
+
+    async def plan_dates(self, name, downloader, engine):
+        """
+        :return: dates of field with acquisition and without clouds
+        """
+        dates = self.field_dates(downloader)
+        if self.all_dates:
+            return dates
+        try:
+            dates = await downloader.catalog.filter_dates_async(
+                downloader._bbox, dates, engine)
+        except Exception as catalog_exc:
+            log.error("Catalog search for {0} failed: {1}".format(name, catalog_exc))
+        if settings.CLOUD_PROBE:
+            dates = await downloader.probe_dates_async(dates, engine)
+        return dates
+
+    async def plan(self, engine):
+        """
+        Dates of all fields are searched concurrently through engine.
+        :return: list of Job for every field, date and band type
+        """
+        fields = []
+        for name, downloader in self.downloaders.items():
+            if needs_tiling(downloader._size):
+                log.error("Field {0} is larger than MAX_REQUEST_DIMENSION, "
+                          "skipped, use fields_photo_downloader.py".format(name))
+                continue
+            fields.append((name, downloader))
+        field_dates = await asyncio.gather(*[
+            self.plan_dates(name, downloader, engine) for name, downloader in fields
+        ])
+        jobs = []
+        for (name, downloader), dates in zip(fields, field_dates):
+            field_jobs = []
+            for date in dates:
+                for band_type in self.band_types:
+                    req = downloader.sentinel_cli_hub_request(
+                        downloader._bbox, (date, date), band_type)
+                    field_jobs.append(Job(name, date, band_type, req.download_list[0]))
+            downloader.journal.plan([
+                (job.download_request.get_hashed_name(), name, job.date, job.band_type)
+                for job in field_jobs
+            ])
+            for job in field_jobs:
+                self.request_fields[job.download_request.get_hashed_name()] = downloader
+            jobs.extend(field_jobs)
+            self.progress[name] = {"total": len(dates) * len(self.band_types),
+                                   "done": 0, "failed": 0}
+        log.info("BATCH: {0} jobs for {1} fields".format(len(jobs), len(self.progress)))
+        return jobs
+
+    def request_result(self, download_request, content, error):
+        """
+        Callback of shared engine, result goes to downloader of its field
+        (journal, spatial index, scene store), catalog and probe requests are skipped.
+        """
+        downloader = self.request_fields.get(download_request.get_hashed_name())
+        if downloader is not None:
+            downloader.request_result(download_request, content, error)
+
+    async def _execute(self, engine, job):
+        try:
+            await engine.execute(job.download_request)
+            failed = False
+        except Exception as job_exc:
+            log.error("{0} {1} {2} failed: {3}".format(
+                job.field, job.date, job.band_type, job_exc))
+            failed = True
+        progress = self.progress[job.field]
+        progress["failed" if failed else "done"] += 1
+        if progress["done"] + progress["failed"] == progress["total"]:
+            log.info("FIELD {0} finished: {1}".format(job.field, progress))
+
+    async def run_async(self):
+        config = next(iter(self.downloaders.values())).config
+        async with AsyncDownloadEngine(config, cache=self.cache,
+                                       callback=self.request_result) as engine:
+            jobs = await self.plan(engine)
+            await asyncio.gather(*[self._execute(engine, job) for job in jobs])
+        return self.progress
+
+    def plan_offline(self, metrics_jsonl=None):
+        """
+        --plan, jobs of every field estimated without network calls, see estimator.py
+        """
+        jobs = []
+        for name, downloader in self.downloaders.items():
+            if needs_tiling(downloader._size):
+                continue
+            dates = self.field_dates(downloader)
+            probe = False
+            if not self.all_dates:
+                cached = downloader.catalog.cached_dates(downloader._bbox, dates)
+                # empty list is a cached search without acquisitions
+                if cached is not None:
+                    dates = cached
+                probe = settings.CLOUD_PROBE
+            for i, band_type in enumerate(self.band_types):
+                downloader.band_type = band_type
+                jobs.extend(estimator.expand_jobs(downloader, dates, probe and i == 0))
+        result = estimator.estimate(
+            jobs, estimator.load_throughput(metrics_jsonl or settings.METRICS_JSONL_PATH))
+        estimator.log_estimate(result)
+        return result
+
+    @timeit
+    def run(self):
+        progress = asyncio.run(self.run_async())
+        if self.cache:
+            log.info("CACHE: {0}".format(self.cache.report()))
+        return progress
+
+
+def check_band_types(band_types):
+    for band_type in band_types:
+        if band_type not in settings.BAND_TYPES:
+            raise ValueError("Band type {0} incorrect check settings.BAND_TYPES.".format(
+                band_type))
+    return band_types
+
+
+def read_field_names(fields, fields_file):
+    if fields_file:
+        with open(fields_file) as f:
+            names = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    elif fields:
+        names = [name.strip() for name in fields.split(",")]
+    else:
+        names = list(settings.FIELDS)
+    unknown = [name for name in names if name not in settings.FIELDS]
+    if unknown:
+        raise ValueError("Fields {0} are not set in settings.FIELDS".format(unknown))
+    return names
+
+
+if __name__ == '__main__':
+    init_logger(log)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fields", help="comma separated settings.FIELDS keys, "
+                                         "all fields by default",
+                        action="store")
+    parser.add_argument("--fields-file", help="file with one settings.FIELDS key per line",
+                        action="store")
+    parser.add_argument("-t", "--time-range", help="time from,to "
+                                                    "Example 2020-02-01,2020-03-01, "
+                                                    "field time_range by default",
+                        action="store")
+    parser.add_argument("-b", "--band-type", help="comma separated band types",
+                        action="store", required=True)
+    parser.add_argument("--all-dates", help="request every day of time range "
+                                            "without catalog search",
+                        action="store_true")
+    parser.add_argument("--no-cache", help="do not use response cache",
+                        action="store_true")
+    parser.add_argument("--no-cloud-probe", help="download dates without checking "
+                                                 "clouds over field first",
+                        action="store_true")
+    parser.add_argument("--plan", "--dry-run", help="print jobs, PU, bytes and wall time "
+                                                    "estimate without downloading",
+                        action="store_true")
+    parser.add_argument("--metrics-jsonl", help="metrics of previous runs for --plan "
+                                                "wall time", action="store")
+    args = parser.parse_args()
+    if args.no_cache:
+        settings.RESPONSE_CACHE = False
+    if args.no_cloud_probe:
+        settings.CLOUD_PROBE = False
+
+    names = read_field_names(args.fields, args.fields_file)
+    time_range = None
+    if args.time_range:
+        time_range = tuple(args.time_range.strip().split(","))
+    band_types = [b.strip() for b in args.band_type.split(",")]
+    runner = BatchRunner(names, band_types, time_range, args.all_dates)
+    if args.plan:
+        runner.plan_offline(args.metrics_jsonl)
+    else:
+        runner.run()
@@ -0,0 +1,210 @@
+"""
+Local stand-in of Sentinel Hub OAuth, Processing and Catalog endpoints
+for offline benchmarks. Point the downloader to it with
+SENTINEL_HUB_BASE_URL=http://127.0.0.1:<port>
+
+python benchmarks/fake_sentinel_hub.py --port 8765 --latency 0.2 --rate-limit 0.05
+
+GET /stats returns per request latencies and counters, POST /reset clears them.
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import random
+import re
+import tarfile
+import time
+
+import numpy as np
+import tifffile
+from aiohttp import web
+from PIL import Image
+
+BANDS_RE = re.compile(r"bands:\s*(\d+)")
+REVISIT_DAYS = 5
+
+
+class FakeSentinelHub(object):
+    def __init__(self, latency=0.1, jitter=0.5, payload_bytes=None, error_rate=0.0,
+                 rate_limit=0.0, retry_after_ms=500, max_concurrent=0):
+        """
+        :param latency: mean processing time of one request in seconds
+        :param jitter: latency is uniform in latency * (1 +- jitter)
+        :param payload_bytes: fixed size of random response body, real image if not set
+        :param error_rate: part of requests answered with 500
+        :param rate_limit: part of requests answered with 429
+        :param retry_after_ms: Retry-After header of 429 response
+        :param max_concurrent: requests processed at once, 0 is unlimited
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.payload_bytes = payload_bytes
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after_ms = retry_after_ms
+        self.max_concurrent = max_concurrent
+        self._semaphore = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {
+            "tokens": 0, "process": 0, "catalog": 0,
+            "errors": 0, "rate_limited": 0, "bytes": 0, "latencies": [],
+        }
+
+    def app(self):
+        app = web.Application(client_max_size=16 * 1024 ** 2)
+        app.router.add_post("/oauth/token", self.token)
+        app.router.add_post("/api/v1/process", self.process)
+        app.router.add_post("/api/v1/catalog/search", self.catalog)
+        app.router.add_get("/stats", self.get_stats)
+        app.router.add_post("/reset", self.post_reset)
+        return app
+
+    async def token(self, request):
+        self.stats["tokens"] += 1
+        return web.json_response({"access_token": "fake-token", "expires_in": 3600,
+                                  "token_type": "Bearer"})
+
+    async def catalog(self, request):
+        self.stats["catalog"] += 1
+        body = await request.json()
+        start, end = [datetime.datetime.strptime(v[:10], "%Y-%m-%d")
+                      for v in body["datetime"].split("/")]
+        features = [
+            {"properties": {"datetime": (start + datetime.timedelta(days=d)).strftime(
+                "%Y-%m-%dT10:00:00Z")}}
+            for d in range(0, (end - start).days + 1, REVISIT_DAYS)
+        ]
+        return web.json_response({"type": "FeatureCollection", "features": features,
+                                  "context": {"returned": len(features)}})
+
+    async def process(self, request):
+        started = time.monotonic()
+        self.stats["process"] += 1
+        body = await request.json()
+        if self._semaphore is None and self.max_concurrent:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        if random.random() < self.rate_limit:
+            self.stats["rate_limited"] += 1
+            return web.Response(status=429, headers={"Retry-After": str(self.retry_after_ms)})
+        if random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=500, text="injected error")
+
+        if self._semaphore:
+            async with self._semaphore:
+                await self._work()
+        else:
+            await self._work()
+        content, content_type = self.render(body, request.headers.get("accept", "image/png"))
+        self.stats["bytes"] += len(content)
+        self.stats["latencies"].append(time.monotonic() - started)
+        return web.Response(body=content, content_type=content_type)
+
+    async def _work(self):
+        await asyncio.sleep(max(0.0, self.latency * random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    def render(self, body, accept):
+        if self.payload_bytes:
+            return random.getrandbits(8 * self.payload_bytes).to_bytes(
+                self.payload_bytes, "little"), accept
+        output = body.get("output", {})
+        width, height = output.get("width", 256), output.get("height", 256)
+        evalscript = body.get("evalscript", "")
+        match = BANDS_RE.search(evalscript)
+        bands = int(match.group(1)) if match else 3
+        float_output = "FLOAT32" in evalscript
+
+        if "ORBIT" in evalscript:
+            time_range = body["input"]["data"][0]["dataFilter"]["timeRange"]
+            start = datetime.datetime.strptime(time_range["from"][:10], "%Y-%m-%d")
+            end = datetime.datetime.strptime(time_range["to"][:10], "%Y-%m-%d")
+            dates = [(start + datetime.timedelta(days=d)).strftime("%Y-%m-%dT10:00:00Z")
+                     for d in range(0, (end - start).days + 1, REVISIT_DAYS)]
+            files = {
+                "default.tif": encode(image(height, width, bands * len(dates), False), "tif"),
+                "userdata.json": json.dumps({"dates": dates, "bands": bands}).encode(),
+            }
+            return tar(files), "application/x-tar"
+
+        responses = output.get("responses", [{"identifier": "default",
+                                              "format": {"type": "image/png"}}])
+        if len(responses) == 1:
+            ext = ext_of(responses[0])
+            return encode(image(height, width, bands, float_output), ext), accept
+        scripts = evalscript.split("var script_")[1:]
+        files = {}
+        for response, script in zip(responses, scripts):
+            match = BANDS_RE.search(script)
+            response_bands = int(match.group(1)) if match else bands
+            ext = ext_of(response)
+            files[f"{response['identifier']}.{ext}"] = encode(
+                image(height, width, response_bands, False), ext)
+        return tar(files), "application/x-tar"
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def post_reset(self, request):
+        self.reset()
+        return web.json_response({"reset": True})
+
+
+def ext_of(response):
+    return "tif" if "tiff" in response.get("format", {}).get("type", "") else "png"
+
+
+def image(height, width, bands, float_output):
+    if float_output:
+        return np.random.random((height, width, bands)).astype(np.float32)
+    return np.random.randint(0, 256, (height, width, bands), dtype=np.uint8)
+
+
+def encode(array, ext):
+    buf = io.BytesIO()
+    if ext == "tif":
+        tifffile.imwrite(buf, array)
+    else:
+        Image.fromarray(array[..., 0] if array.shape[-1] == 1 else array).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.1,
+                        help="mean processing time of request, seconds")
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--payload-bytes", type=int, default=None,
+                        help="random body of fixed size instead of real image")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="part of requests answered with 429")
+    parser.add_argument("--retry-after-ms", type=int, default=500)
+    parser.add_argument("--max-concurrent", type=int, default=0)
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    server = FakeSentinelHub(
+        latency=args.latency, jitter=args.jitter, payload_bytes=args.payload_bytes,
+        error_rate=args.error_rate, rate_limit=args.rate_limit,
+        retry_after_ms=args.retry_after_ms, max_concurrent=args.max_concurrent,
+    )
+    web.run_app(server.app(), host=args.host, port=args.port, print=None)
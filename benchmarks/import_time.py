@@ -0,0 +1,107 @@
+"""
+Startup benchmark of CLI entry points (python -X importtime report).
+Startup is wall time of the command minus wall time of bare interpreter,
+median of --repeat runs. Exit 1 when startup is over --budget-ms or when
+a heavy package is imported by a command which must not need it.
+
+python benchmarks/import_time.py
+python benchmarks/import_time.py --budget-ms 100 --top 20 -o import_time.json  # CI
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# packages loaded on first use only (utils.lazy_import)
+HEAVY = ("numpy", "sentinelhub", "matplotlib", "shapely", "tifffile", "PIL", "aiohttp")
+
+# name, command arguments
+SCENARIOS = [
+    ("fields_photo_downloader --help", ["fields_photo_downloader.py", "--help"]),
+    ("batch --help", ["batch.py", "--help"]),
+    ("daemon_client --help", ["daemon_client.py", "--help"]),
+]
+
+
+def run(args, importtime=False):
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + args
+    started = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=REPO_DIR, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise RuntimeError("{0} failed: {1}".format(" ".join(args), proc.stderr[-2000:]))
+    return elapsed, proc.stderr
+
+
+def parse_importtime(stderr):
+    """
+    :return: dict of module -> (self us, cumulative us)
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def wall_ms(args, repeat):
+    return statistics.median(run(args)[0] for _ in range(repeat)) * 1000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=7, help="runs per scenario")
+    parser.add_argument("--budget-ms", type=float, default=100.0,
+                        help="max startup over bare interpreter, exit 1 over it")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports reported")
+    parser.add_argument("-o", "--output", help="result JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    interpreter_ms = wall_ms(["-c", "pass"], args.repeat)
+    print("interpreter {0:.1f} ms".format(interpreter_ms))
+    results, failures = [], []
+    for name, cmd in SCENARIOS:
+        startup_ms = wall_ms(cmd, args.repeat) - interpreter_ms
+        modules = parse_importtime(run(cmd, importtime=True)[1])
+        heavy = sorted({m.split(".")[0] for m in modules} & set(HEAVY))
+        top = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+        results.append({
+            "scenario": name,
+            "startup_ms": round(startup_ms, 1),
+            "modules": len(modules),
+            "heavy": heavy,
+            "top_self_us": [[module, times[0]] for module, times in top],
+        })
+        print("{0}: {1:.1f} ms, {2} modules".format(name, startup_ms, len(modules)))
+        for module, (self_us, cumulative_us) in top:
+            print("    {0:>8} us self {1:>8} us cumulative  {2}".format(
+                self_us, cumulative_us, module))
+        if startup_ms > args.budget_ms:
+            failures.append("{0}: {1:.1f} ms over budget {2} ms".format(
+                name, startup_ms, args.budget_ms))
+        if heavy:
+            failures.append("{0}: imports {1} at startup".format(name, ", ".join(heavy)))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"interpreter_ms": round(interpreter_ms, 1), "budget_ms": args.budget_ms,
+                       "results": results}, f, indent=2)
+    for failure in failures:
+        print("FAIL " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
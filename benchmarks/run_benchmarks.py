@@ -0,0 +1,239 @@
+"""
+Offline benchmark of download modes against benchmarks/fake_sentinel_hub.py.
+Every scenario runs in its own process, result file is JSON with
+throughput, p50/p95/p99 latency, peak RSS and CPU time per scenario.
+
+python benchmarks/run_benchmarks.py --latency 0.2 --rate-limit 0.05 -o benchmark.json
+python benchmarks/run_benchmarks.py --baseline benchmark.json --tolerance 0.2  # CI
+
+Server latency is measured by the fake server from request arrival to response,
+client job latency and phase totals come from client metrics JSON lines (metrics.py).
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+BASE_ARGS = [
+    "-c", "34.878856,32.120528,34.885315,32.129178",
+    "-t", "2020-05-01,2020-05-30",
+    "-b", "NDVIGV",
+    "--no-cache",
+]
+
+# name, GISImageDownloader entry point, extra CLI arguments
+SCENARIOS = [
+    ("main_cli-async", "main_cli", ["-m", "async"]),
+    ("main_cli-mp", "main_cli", ["-m", "mp"]),
+    ("main_cli-sync", "main_cli", ["-m", "sync"]),
+    ("main_cli_sync", "main_cli_sync", []),
+    ("multi-temporal", "main_cli", ["--multi-temporal"]),
+    ("multi-band", "main_cli", ["-b", "NDVIGV,TRUE-COLORHC"]),
+    ("raw", "main_cli", ["--raw", "-b", "NDVIGV,NDVI-CM,NDVIINDEX"]),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Fake Sentinel Hub did not start on port {0}".format(port))
+
+
+def server_call(base_url, path, method="GET"):
+    req = urllib.request.Request(base_url + path, method=method,
+                                 data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(req) as resp:
+        return json.loads(resp.read())
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def run_scenario(base_url, name, entry, extra_args):
+    data_dir = tempfile.mkdtemp(prefix="bench_")
+    env = dict(os.environ,
+               SENTINEL_HUB_BASE_URL=base_url,
+               SENTINEL_HUB_CLIENT_ID="bench",
+               SENTINEL_HUB_SECRET_KEY="bench",
+               # fake server is plain http, oauthlib of sentinelhub client refuses it otherwise
+               OAUTHLIB_INSECURE_TRANSPORT="1")
+    server_call(base_url, "/reset", "POST")
+    log_path = os.path.join(data_dir, "client.log")
+    metrics_path = os.path.join(data_dir, "metrics.jsonl")
+    with open(log_path, "wb") as log_file:
+        started = time.monotonic()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, "run_client.py"), entry, data_dir]
+            + BASE_ARGS + extra_args + ["--metrics-jsonl", metrics_path],
+            cwd=REPO_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+        )
+        # wait4 gives rusage of this child and its waited children (pool workers)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.monotonic() - started
+    with open(log_path, "rb") as log_file:
+        output = log_file.read().decode(errors="replace")
+    stats = server_call(base_url, "/stats")
+    jobs = read_jobs(metrics_path)
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+    latencies = [v * 1000 for v in stats["latencies"]]
+    job_latencies = [job["duration"] * 1000 for job in jobs]
+    phases = {}
+    for job in jobs:
+        for phase, seconds in job["phases"].items():
+            phases[phase] = phases.get(phase, 0.0) + seconds
+    result = {
+        "scenario": name,
+        "entry": entry,
+        "args": extra_args,
+        "exit_code": os.waitstatus_to_exitcode(status)
+        if hasattr(os, "waitstatus_to_exitcode") else status >> 8,
+        "wall_s": round(wall, 3),
+        "requests": stats["process"],
+        "completed": len(latencies),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else None,
+        "bytes": stats["bytes"],
+        "tokens": stats["tokens"],
+        "injected_errors": stats["errors"],
+        "injected_429": stats["rate_limited"],
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+        "client_jobs": len(jobs),
+        "client_failed_jobs": sum(1 for job in jobs if job["status"] != "ok"),
+        "client_retries": sum(job["retries"] for job in jobs),
+        "client_job_latency_ms": {
+            "p50": percentile(job_latencies, 50),
+            "p95": percentile(job_latencies, 95),
+            "p99": percentile(job_latencies, 99),
+        },
+        "client_phase_total_s": {k: round(v, 3) for k, v in phases.items()},
+        # ru_maxrss is KiB on Linux
+        "peak_rss_kb": usage.ru_maxrss,
+        "cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+    }
+    # CLI logs failed dates and exits 0, so exit code alone does not tell a failed run
+    result["failed"] = bool(result["exit_code"] or result["client_failed_jobs"]
+                            or not result["completed"])
+    if result["failed"]:
+        result["output_tail"] = output[-2000:]
+    return result
+
+
+def read_jobs(metrics_path):
+    if not os.path.exists(metrics_path):
+        return []
+    with open(metrics_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_regressions(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    failures = []
+    for result in results:
+        base = baseline.get(result["scenario"])
+        if not base or not base.get("throughput_rps") or base.get("failed", True):
+            continue
+        if (result["throughput_rps"] or 0) < base["throughput_rps"] * (1 - tolerance):
+            failures.append("{0}: throughput {1} rps, baseline {2} rps".format(
+                result["scenario"], result["throughput_rps"], base["throughput_rps"]))
+    return failures
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="benchmark.json")
+    parser.add_argument("-s", "--scenarios", help="comma separated scenario names, all by default")
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--payload-bytes", type=int, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--retry-after-ms", type=int, default=500)
+    parser.add_argument("--max-concurrent", type=int, default=0)
+    parser.add_argument("--baseline", help="previous result file, exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed throughput drop against baseline")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    scenarios = SCENARIOS
+    if args.scenarios:
+        names = args.scenarios.split(",")
+        scenarios = [s for s in SCENARIOS if s[0] in names]
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server_args = [
+        "--port", str(port), "--latency", str(args.latency), "--jitter", str(args.jitter),
+        "--error-rate", str(args.error_rate), "--rate-limit", str(args.rate_limit),
+        "--retry-after-ms", str(args.retry_after_ms), "--max-concurrent", str(args.max_concurrent),
+    ]
+    if args.payload_bytes:
+        server_args += ["--payload-bytes", str(args.payload_bytes)]
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_sentinel_hub.py")] + server_args)
+    try:
+        wait_port(port)
+        results = []
+        for name, entry, extra_args in scenarios:
+            result = run_scenario(base_url, name, entry, extra_args)
+            print("{scenario}: {wall_s} s, {throughput_rps} rps, p95 {p95} ms, "
+                  "rss {peak_rss_kb} KiB, cpu {cpu_s} s".format(
+                      p95=result["latency_ms"]["p95"], **result))
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "server": vars(args),
+            "results": results,
+        }, f, indent=4)
+
+    failed = [r["scenario"] for r in results if r["failed"]]
+    if failed:
+        print("Scenarios failed: {0}".format(failed))
+        return 1
+    if args.baseline:
+        regressions = check_regressions(results, args.baseline, args.tolerance)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
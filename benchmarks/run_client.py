@@ -0,0 +1,27 @@
+"""
+Run one GISImageDownloader entry point with fields_photo_downloader CLI arguments,
+started by run_benchmarks.py in a separate process.
+
+python benchmarks/run_client.py main_cli /tmp/bench_data -c ... -t ... -b NDVIGV
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings  # noqa: E402
+from fields_photo_downloader import GISImageDownloader, build_parser, configure  # noqa: E402
+
+FIELD = "test"
+
+
+def main(argv):
+    entry, data_dir = argv[0], argv[1]
+    settings.FIELDS[FIELD]["dir"] = data_dir
+    args = build_parser().parse_args(argv[2:])
+    configure(args)
+    getattr(GISImageDownloader(FIELD), entry)(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
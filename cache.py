@@ -0,0 +1,137 @@
+"""
+Content addressed cache of Processing API responses.
+Key is a hash of request payload (bbox, size, evalscript, data source,
+time interval) and response mime type, least recently used entries are
+evicted when cache grows over byte budget.
+Requests of dates which can still get new acquisitions
+(settings.CATALOG_SETTLE_DAYS) are not cached.
+"""
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import settings
+from utils import atomic_write
+
+log = logging.getLogger(__name__)
+
+
+def request_key(download_request):
+    """
+    :param download_request: sentinelhub.DownloadRequest
+    :return: sha256 hex digest
+    """
+    headers = download_request.headers or {}
+    key = json.dumps(
+        {
+            "url": download_request.url.split("/api/", 1)[-1],
+            "payload": download_request.post_values,
+            "accept": headers.get("accept"),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def cacheable(download_request):
+    """
+    :param download_request: sentinelhub.DownloadRequest
+    :return: False if time range of request ends less than CATALOG_SETTLE_DAYS ago,
+    response of such request can change when new acquisitions are processed
+    """
+    payload = download_request.post_values or {}
+    ends = [
+        data.get("dataFilter", {}).get("timeRange", {}).get("to")
+        for data in payload.get("input", {}).get("data", [])
+    ]
+    ends = [end[:10] for end in ends if end]
+    if not ends:
+        return True
+    end = datetime.datetime.strptime(max(ends), "%Y-%m-%d").date()
+    return datetime.date.today() - end > datetime.timedelta(days=settings.CATALOG_SETTLE_DAYS)
+
+
+class ResponseCache(object):
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or settings.RESPONSE_CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else settings.RESPONSE_CACHE_MAX_BYTES
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._entries = self._scan()
+        self._size = sum(self._entries.values())
+
+    def __getstate__(self):
+        # multiprocessing pickles downloader together with its cache
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """
+        :return: OrderedDict key -> size, least recently used first
+        """
+        found = []
+        if os.path.exists(self.cache_dir):
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if name.endswith(".tmp"):
+                        continue
+                    st = os.stat(os.path.join(root, name))
+                    found.append((st.st_mtime, name, st.st_size))
+        found.sort()
+        return collections.OrderedDict((name, size) for _, name, size in found)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            # mtime is the LRU clock, survives restarts
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by other process between read and touch too
+            with self._lock:
+                self.stats["misses"] += 1
+                self._size -= self._entries.pop(key, 0)
+            return None
+        with self._lock:
+            self.stats["hits"] += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return content
+
+    def put(self, key, content):
+        atomic_write(self.path(key), content)
+        with self._lock:
+            self.stats["stores"] += 1
+            self._size += len(content) - self._entries.pop(key, 0)
+            self._entries[key] = len(content)
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self.stats["evictions"] += 1
+            log.debug("CACHE EVICT {0}".format(key))
+
+    def report(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        ratio = self.stats["hits"] / total if total else 0.0
+        return dict(self.stats, size_bytes=self._size, entries=len(self._entries),
+                    hit_ratio=round(ratio, 3))
@@ -0,0 +1,136 @@
+"""
+Catalog first date planning.
+Before per day requests are sent Catalog API is asked which dates really have
+an acquisition over bbox, answer is cached on disk per bbox and time range.
+Docks https://docs.sentinel-hub.com/api/latest/api/catalog/
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+
+import settings
+from utils import atomic_write, lazy_import
+
+# aiohttp is imported only when catalog is not cached
+AsyncDownloadEngine = lazy_import("async_engine", "AsyncDownloadEngine")
+
+log = logging.getLogger(__name__)
+
+
+class AcquisitionCatalog(object):
+    def __init__(self, config, cache_dir, collection=None):
+        self.config = config
+        self.cache_dir = cache_dir
+        self.collection = collection or settings.CATALOG_COLLECTION
+        self.search_url = f"{settings.SENTINEL_HUB_BASE_URL}/api/v1/catalog/search"
+
+    def cache_path(self, bbox, time_range):
+        key = json.dumps(
+            [self.collection, bbox_list(bbox), str(bbox.crs), list(time_range)]
+        )
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    def acquisition_dates(self, bbox, time_range):
+        """
+        :param bbox: sentinelhub BBox
+        :param time_range: (start_date, end_date) str in %Y-%m-%d format
+        :return: sorted list of dates str with at least one acquisition
+        """
+        return asyncio.run(self.acquisition_dates_async(bbox, time_range))
+
+    async def acquisition_dates_async(self, bbox, time_range, engine=None):
+        """
+        Same as acquisition_dates, search goes through engine if it is given.
+        """
+        path = self.cache_path(bbox, time_range)
+        dates = self._load(path, time_range)
+        if dates is not None:
+            log.info("CATALOG CACHE HIT {0}".format(path))
+            return dates
+
+        if engine is None:
+            async with AsyncDownloadEngine(self.config) as engine:
+                dates = await self._search(engine, bbox, time_range)
+        else:
+            dates = await self._search(engine, bbox, time_range)
+        atomic_write(path, json.dumps({
+            "created": time.time(),
+            "collection": self.collection,
+            "time_range": list(time_range),
+            "dates": dates,
+        }).encode())
+        return dates
+
+    def filter_dates(self, bbox, dates):
+        """
+        Keep only those dates which have an acquisition, order is preserved.
+        """
+        return asyncio.run(self.filter_dates_async(bbox, dates))
+
+    async def filter_dates_async(self, bbox, dates, engine=None):
+        if not dates:
+            return dates
+        available = set(await self.acquisition_dates_async(
+            bbox, (dates[0], dates[-1]), engine))
+        planned = [date for date in dates if date in available]
+        log.info("CATALOG: {0} of {1} dates have acquisitions".format(
+            len(planned), len(dates)))
+        return planned
+
+    def cached_dates(self, bbox, dates):
+        """
+        Same as filter_dates from disk cache only, nothing is requested.
+        :return: list of dates str, None if time range was not searched yet
+        """
+        if not dates:
+            return dates
+        available = self._load(self.cache_path(bbox, (dates[0], dates[-1])),
+                                (dates[0], dates[-1]))
+        if available is None:
+            return None
+        available = set(available)
+        return [date for date in dates if date in available]
+
+    def _load(self, path, time_range):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            cached = json.load(f)
+        # new acquisitions still can appear for ranges which end recently
+        end = datetime.datetime.strptime(time_range[-1], "%Y-%m-%d").date()
+        settled = datetime.date.today() - end > datetime.timedelta(
+            days=settings.CATALOG_SETTLE_DAYS)
+        if not settled and time.time() - cached["created"] > settings.CATALOG_CACHE_TTL:
+            return None
+        return cached["dates"]
+
+    async def _search(self, engine, bbox, time_range):
+        payload = {
+            "bbox": bbox_list(bbox),
+            "bbox-crs": bbox.crs.opengis_string,
+            "datetime": f"{time_range[0]}T00:00:00Z/{time_range[-1]}T23:59:59Z",
+            "collections": [self.collection],
+            "limit": settings.CATALOG_PAGE_LIMIT,
+            "fields": {"include": ["properties.datetime"], "exclude": []},
+        }
+        dates = set()
+        while True:
+            # 429/5xx of a page are retried like Processing API requests
+            content = await engine.send(self.search_url, payload, name="catalog search")
+            body = json.loads(content)
+            for feature in body.get("features", []):
+                dates.add(feature["properties"]["datetime"][:10])
+            next_page = body.get("context", {}).get("next")
+            if next_page is None:
+                break
+            payload["next"] = next_page
+        return sorted(dates)
+
+
+def bbox_list(bbox):
+    return [bbox.min_x, bbox.min_y, bbox.max_x, bbox.max_y]
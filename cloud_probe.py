@@ -0,0 +1,36 @@
+"""
+Cheap cloud probe before full resolution downloads.
+For every date a low resolution CLM (s2cloudless cloud mask) and dataMask
+response is requested (settings.CLOUD_PROBE_EVALSCRIPT), date is downloaded
+only when cloudy part of field is below field "cloud_threshold".
+"""
+import math
+
+import numpy as np
+
+import settings
+
+
+def probe_size(size, max_dimension=None):
+    """
+    :param size: (width, height) of full resolution request
+    :param max_dimension: longer side of probe in px, default settings.CLOUD_PROBE_SIZE
+    :return: (width, height) of probe, aspect ratio is kept
+    """
+    max_dimension = max_dimension or settings.CLOUD_PROBE_SIZE
+    width, height = size
+    scale = min(1.0, max_dimension / max(width, height))
+    return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+
+def cloud_fraction(image):
+    """
+    :param image: probe response (height, width, 2), CLM and dataMask
+    :return: cloudy part of pixels with data, None if there is no data
+    """
+    # CLM is 1 for clouds, 255 for no data
+    clouds, data = image[:, :, 0] == 1, image[:, :, 1] > 0
+    valid = np.count_nonzero(data)
+    if not valid:
+        return None
+    return np.count_nonzero(clouds & data) / valid
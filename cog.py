@@ -0,0 +1,149 @@
+"""
+Tiled GeoTIFF with internal overviews (Cloud Optimized GeoTIFF layout),
+readers fetch only tiles and zoom levels they need.
+Georeferencing comes from request bbox, index bands of UINT16 responses get
+GDAL scale/offset metadata so readers get back index values.
+
+data_dir/cog/NDVIINDEX/2020-05-03.tif
+"""
+import os
+import tempfile
+
+import numpy as np
+import tifffile
+
+import settings
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+# --compression -> TIFF compression of tifffile
+COMPRESSIONS = {
+    "deflate": "ADOBE_DEFLATE",
+    "lzw": "LZW",
+    "zstd": "ZSTD",
+}
+# compressions without level
+NO_LEVEL = ("lzw",)
+
+# GeoTIFF tags and keys http://docs.opengeospatial.org/is/19-008r4/19-008r4.html
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+GEO_KEY_DIRECTORY = 34735
+GDAL_METADATA = 42112
+GT_MODEL_TYPE = 1024
+GT_RASTER_TYPE = 1025
+GEOGRAPHIC_TYPE = 2048
+PROJECTED_CS_TYPE = 3072
+
+
+def geo_tags(bbox, size, epsg):
+    """
+    :param bbox: [min_x, min_y, max_x, max_y]
+    :param size: (width, height)
+    :param epsg: EPSG code of bbox CRS
+    :return: tifffile extratags
+    """
+    min_x, min_y, max_x, max_y = bbox
+    width, height = size
+    geographic = epsg == 4326
+    keys = [
+        (GT_MODEL_TYPE, 2 if geographic else 1),
+        (GT_RASTER_TYPE, 1),  # PixelIsArea
+        (GEOGRAPHIC_TYPE if geographic else PROJECTED_CS_TYPE, epsg),
+    ]
+    directory = [1, 1, 0, len(keys)]
+    for key, value in keys:
+        directory += [key, 0, 1, value]
+    pixel_scale = ((max_x - min_x) / width, (max_y - min_y) / height, 0.0)
+    return [
+        (MODEL_PIXEL_SCALE, "d", 3, pixel_scale, True),
+        (MODEL_TIEPOINT, "d", 6, (0.0, 0.0, 0.0, min_x, max_y, 0.0), True),
+        (GEO_KEY_DIRECTORY, "H", len(directory), directory, True),
+    ]
+
+
+def scale_offset_tag(bands, scale, offset):
+    """
+    GDAL reads value = stored * scale + offset
+    """
+    items = "".join(
+        '<Item name="SCALE" sample="{0}" role="scale">{1}</Item>'
+        '<Item name="OFFSET" sample="{0}" role="offset">{2}</Item>'.format(band, scale, offset)
+        for band in range(bands)
+    )
+    return (GDAL_METADATA, "s", 0, "<GDALMetadata>{0}</GDALMetadata>".format(items), True)
+
+
+def overviews(image, tile_size):
+    """
+    Every level is half of previous one (nearest pixel, like gdaladdo default),
+    last level fits into one tile.
+    """
+    levels = []
+    level = image
+    while max(level.shape[:2]) > tile_size:
+        level = level[::2, ::2]
+        levels.append(level)
+    return levels
+
+
+def write_cog(path, image, bbox, epsg=4326, compression=None, predictor=None,
+              scale_offset=None, scaled_bands=None):
+    """
+    :param path: output .tif path, written atomically
+    :param image: array (height, width[, bands]) uint8, uint16 or float32
+    :param bbox: [min_x, min_y, max_x, max_y] of image
+    :param epsg: EPSG code of bbox CRS
+    :param compression: deflate, lzw or zstd, default settings.COG_COMPRESSION
+    :param predictor: horizontal (int) or floating point predictor, default settings.COG_PREDICTOR
+    :param scale_offset: (scale, offset) GDAL metadata of stored values
+    :param scaled_bands: number of leading bands scale_offset applies to, default all
+    """
+    compression = compression or settings.COG_COMPRESSION
+    predictor = settings.COG_PREDICTOR if predictor is None else predictor
+    if compression not in COMPRESSIONS:
+        raise ValueError("Compression incorrect use one of {0}.".format(", ".join(COMPRESSIONS)))
+    if compression != "deflate" and imagecodecs is None:
+        raise ValueError("{0} compression needs imagecodecs package.".format(compression))
+    compress = COMPRESSIONS[compression]
+    if compression not in NO_LEVEL:
+        compress = (compress, settings.COG_COMPRESSION_LEVEL)
+
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    if predictor and image.dtype.kind == "f" and imagecodecs is None:
+        # floating point predictor of tifffile needs imagecodecs
+        predictor = False
+    height, width, bands = image.shape
+    options = {
+        "tile": (settings.COG_TILE_SIZE, settings.COG_TILE_SIZE),
+        "compress": compress,
+        "predictor": predictor,
+        "planarconfig": "contig",
+        "photometric": "rgb" if bands in (3, 4) and image.dtype == np.uint8 else "minisblack",
+        "metadata": None,
+    }
+    if options["photometric"] == "rgb" and bands == 4:
+        options["extrasamples"] = ("unassalpha",)
+    extratags = geo_tags(bbox, (width, height), epsg)
+    if scale_offset:
+        extratags.append(scale_offset_tag(scaled_bands or bands, *scale_offset))
+
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name or None, suffix=".tmp")
+    os.close(fd)
+    try:
+        with tifffile.TiffWriter(tmp_path) as tif:
+            tif.save(image, extratags=extratags, **options)
+            for level in overviews(image, settings.COG_TILE_SIZE):
+                tif.save(np.ascontiguousarray(level), subfiletype=1, **options)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
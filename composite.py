@@ -0,0 +1,160 @@
+"""
+Streaming temporal composite of a field (--composite).
+Every date is folded into running reducers as soon as it is downloaded,
+memory depends only on raster size and histogram bins, not on number of dates.
+Only index band types (settings.BAND_TYPES "index_bands") are composited,
+first band of frame is the index value (NDVIINDEX, --sample-type FLOAT32 keeps
+NDVI in [-1, 1], uint8 frames are scaled to [0, 1], UINT16 frames are
+unscaled), last band is dataMask.
+Cloudy dates are already dropped by cloud probe (cloud_probe.py), so latest
+pixel with data is the latest clear one.
+
+data_dir/composite/NDVIINDEX/2020-05-01_2020-05-30/max.tif, max_date.tif, ...
+"""
+import json
+import os
+
+import numpy as np
+
+import settings
+from cog import write_cog
+from utils import atomic_write
+
+REDUCERS = ("max", "mean", "median", "latest")
+NO_DATE = -1
+
+
+def split_frame(image):
+    """
+    :param image: frame (height, width, bands), value first and dataMask last
+    :return: (values float32 (height, width), valid bool (height, width))
+    """
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    values = image[:, :, 0].astype(np.float32)
+    if image.dtype == np.uint8:
+        values /= 255.0
+    elif image.dtype == np.uint16:
+        values = values / settings.UINT16_SCALE - settings.UINT16_OFFSET
+    if image.shape[2] > 1:
+        valid = image[:, :, -1] > 0
+    else:
+        valid = np.ones(values.shape, dtype=bool)
+    return values, valid & np.isfinite(values)
+
+
+class Compositor(object):
+    def __init__(self, dates, reducers=None, bins=None, value_range=None):
+        """
+        :param dates: all dates of composite, dates may arrive in any order
+        :param reducers: names of REDUCERS, default settings.COMPOSITE_REDUCERS
+        :param bins: histogram bins of approximate median, default settings.COMPOSITE_MEDIAN_BINS
+        :param value_range: (low, high) of median histogram, default
+        (0, 1) for uint8 frames and settings.COMPOSITE_VALUE_RANGE otherwise
+        """
+        self.dates = sorted(dates)
+        self.date_index = {date: i for i, date in enumerate(self.dates)}
+        self.reducers = tuple(reducers or settings.COMPOSITE_REDUCERS)
+        unknown = set(self.reducers) - set(REDUCERS)
+        if unknown:
+            raise ValueError("Composite reducers incorrect use {0}.".format(", ".join(REDUCERS)))
+        self.bins = bins or settings.COMPOSITE_MEDIAN_BINS
+        self.value_range = value_range
+        self.added = set()
+        self.shape = None
+        self.state = {}
+
+    def _init_state(self, shape, dtype):
+        self.shape = shape
+        if self.value_range is None:
+            self.value_range = (0.0, 1.0) if dtype == np.uint8 else settings.COMPOSITE_VALUE_RANGE
+        if "max" in self.reducers:
+            self.state["max"] = np.full(shape, -np.inf, dtype=np.float32)
+            self.state["max_date"] = np.full(shape, NO_DATE, dtype=np.int16)
+        if "mean" in self.reducers:
+            self.state["sum"] = np.zeros(shape, dtype=np.float64)
+            self.state["count"] = np.zeros(shape, dtype=np.uint16)
+        if "median" in self.reducers:
+            self.state["histogram"] = np.zeros(shape + (self.bins,), dtype=np.uint16)
+        if "latest" in self.reducers:
+            self.state["latest"] = np.full(shape, np.nan, dtype=np.float32)
+            self.state["latest_date"] = np.full(shape, NO_DATE, dtype=np.int16)
+
+    def add(self, date, image):
+        """
+        Fold one date into reducers, every date is counted once.
+        :param date: date str of self.dates
+        :param image: frame (height, width, bands)
+        """
+        if date in self.added or date not in self.date_index:
+            return
+        if self.shape is None:
+            self._init_state(image.shape[:2], image.dtype)
+        values, valid = split_frame(image)
+        index = self.date_index[date]
+        state = self.state
+        if "max" in self.reducers:
+            better = valid & (values > state["max"])
+            state["max"][better] = values[better]
+            state["max_date"][better] = index
+        if "mean" in self.reducers:
+            state["sum"] += np.where(valid, values, 0.0)
+            state["count"] += valid
+        if "median" in self.reducers:
+            low, high = self.value_range
+            bins = ((values[valid] - low) / (high - low) * self.bins).astype(np.int64)
+            # every pixel is in a frame once, fancy index increment has no duplicates
+            cells = np.flatnonzero(valid) * self.bins + np.clip(bins, 0, self.bins - 1)
+            state["histogram"].reshape(-1)[cells] += 1
+        if "latest" in self.reducers:
+            newer = valid & (index > state["latest_date"])
+            state["latest"][newer] = values[newer]
+            state["latest_date"][newer] = index
+        self.added.add(date)
+
+    def result(self):
+        """
+        :return: dict name -> float32 array (height, width), NaN without data,
+        *_date arrays are indexes of self.dates (-1 without data)
+        """
+        if self.shape is None:
+            return {}
+        state, out = self.state, {}
+        if "max" in self.reducers:
+            out["max"] = np.where(state["max_date"] == NO_DATE, np.nan,
+                                  state["max"]).astype(np.float32)
+            out["max_date"] = state["max_date"]
+        if "mean" in self.reducers:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                out["mean"] = (state["sum"] / state["count"]).astype(np.float32)
+        if "median" in self.reducers:
+            histogram = state["histogram"]
+            total = histogram.sum(axis=-1, dtype=np.int64)
+            cumulative = np.cumsum(histogram, axis=-1, dtype=np.int64)
+            median_bin = np.argmax(cumulative * 2 >= total[..., np.newaxis], axis=-1)
+            low, high = self.value_range
+            median = low + (median_bin + 0.5) * (high - low) / self.bins
+            out["median"] = np.where(total == 0, np.nan, median).astype(np.float32)
+        if "latest" in self.reducers:
+            out["latest"] = state["latest"]
+            out["latest_date"] = state["latest_date"]
+        return out
+
+    def save(self, path, bbox, epsg=4326):
+        """
+        One GeoTIFF per result in path dir and composite.json with dates.
+        :return: list of written files
+        """
+        written = []
+        for name, image in self.result().items():
+            file_path = os.path.join(path, "{0}.tif".format(name))
+            write_cog(file_path, image, list(bbox), epsg=epsg)
+            written.append(file_path)
+        atomic_write(os.path.join(path, "composite.json"), json.dumps({
+            "dates": self.dates,
+            "added": sorted(self.added),
+            "reducers": list(self.reducers),
+            "value_range": list(self.value_range or ()),
+            "median_bins": self.bins,
+        }, indent=2).encode())
+        return written
@@ -0,0 +1,196 @@
+"""
+Time series datacube of one field and band type (time x y x x x band).
+Every date is split into CUBE_CHUNK_SIZE x CUBE_CHUNK_SIZE chunks, every chunk
+is zlib compressed raw array in its own file named "<time>.<row>.<col>"
+like Zarr does, so one date frame or one pixel time series is read
+without decoding whole cube.
+
+data_dir/cube/NDVIGV/512x512_3f1c2a9b7d40/  one cube per size and bbox hash
+    cube.json   shape, chunks, dtype, dates, bbox
+    0.0.0       chunk of first date, first chunk row and column
+    ...
+
+python cube.py /tmp/test_dir/cube/NDVIGV/512x512_3f1c2a9b7d40  # info of cube
+"""
+import json
+import logging
+import math
+import os
+import sys
+import zlib
+
+import numpy as np
+
+import settings
+from utils import atomic_write
+
+log = logging.getLogger(__name__)
+
+META_FILE = "cube.json"
+
+
+class DataCube(object):
+    """
+    Dates are appended in any order, time index of date is its position
+    in "dates" of metadata, readers return dates sorted.
+    """
+
+    def __init__(self, path, chunk_size=None, compression_level=None):
+        self.path = path
+        self.chunk_size = chunk_size or settings.CUBE_CHUNK_SIZE
+        self.compression_level = (settings.CUBE_COMPRESSION_LEVEL
+                                  if compression_level is None else compression_level)
+        self.meta = self._load_meta()
+
+    def _load_meta(self):
+        meta_path = os.path.join(self.path, META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def _save_meta(self):
+        atomic_write(os.path.join(self.path, META_FILE), json.dumps(self.meta, indent=4).encode())
+
+    def _create(self, image, bbox=None, band_type=None):
+        height, width, bands = image.shape
+        self.meta = {
+            "shape": [0, height, width, bands],
+            "chunks": [1, min(self.chunk_size, height), min(self.chunk_size, width), bands],
+            "dtype": image.dtype.str,
+            "compressor": {"id": "zlib", "level": self.compression_level},
+            "dates": [],
+            "bbox": [bbox.min_x, bbox.min_y, bbox.max_x, bbox.max_y] if bbox is not None else None,
+            "crs": str(bbox.crs) if bbox is not None else None,
+            "band_type": band_type,
+        }
+
+    @property
+    def dates(self):
+        return sorted(self.meta["dates"]) if self.meta else []
+
+    @property
+    def shape(self):
+        return tuple(self.meta["shape"]) if self.meta else None
+
+    @property
+    def dtype(self):
+        return np.dtype(self.meta["dtype"])
+
+    def _grid(self):
+        _, height, width, _ = self.meta["shape"]
+        _, chunk_y, chunk_x, _ = self.meta["chunks"]
+        return math.ceil(height / chunk_y), math.ceil(width / chunk_x)
+
+    def _chunk_path(self, t, row, col):
+        return os.path.join(self.path, f"{t}.{row}.{col}")
+
+    def _read_chunk(self, t, row, col):
+        with open(self._chunk_path(t, row, col), "rb") as f:
+            data = zlib.decompress(f.read())
+        return np.frombuffer(data, dtype=self.dtype).reshape(self._chunk_shape(row, col))
+
+    def _chunk_shape(self, row, col):
+        # edge chunks are stored cut to frame
+        _, height, width, bands = self.meta["shape"]
+        _, chunk_y, chunk_x, _ = self.meta["chunks"]
+        return (min(chunk_y, height - row * chunk_y),
+                min(chunk_x, width - col * chunk_x),
+                bands)
+
+    def write(self, date, image, bbox=None, band_type=None):
+        """
+        Store one date frame, frame of the same date is overwritten.
+        :param date: date str
+        :param image: array (height, width) or (height, width, bands)
+        :param bbox: sentinelhub BBox of frame, stored in metadata of new cube
+        :param band_type: settings BAND_TYPES, stored in metadata of new cube
+        """
+        if image.ndim == 2:
+            image = image[:, :, np.newaxis]
+        if self.meta is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._create(image, bbox, band_type)
+        _, height, width, bands = self.meta["shape"]
+        if image.shape != (height, width, bands):
+            raise ValueError("Frame {0} of {1} does not match cube shape {2}".format(
+                image.shape, date, (height, width, bands)))
+        image = image.astype(self.dtype, copy=False)
+
+        dates = self.meta["dates"]
+        t = dates.index(date) if date in dates else len(dates)
+        _, chunk_y, chunk_x, _ = self.meta["chunks"]
+        rows, cols = self._grid()
+        for row in range(rows):
+            for col in range(cols):
+                chunk = image[row * chunk_y:(row + 1) * chunk_y,
+                              col * chunk_x:(col + 1) * chunk_x]
+                atomic_write(self._chunk_path(t, row, col), zlib.compress(
+                    np.ascontiguousarray(chunk).tobytes(), self.compression_level))
+        # metadata goes last, date is visible only when all its chunks are written
+        if t == len(dates):
+            dates.append(date)
+            self.meta["shape"][0] = len(dates)
+        self._save_meta()
+
+    def frame(self, date):
+        """
+        :param date: date str
+        :return: array (height, width, bands) of date
+        """
+        _, height, width, _ = self.meta["shape"]
+        return self.window(0, 0, height, width, [date])[0]
+
+    def series(self, row, col):
+        """
+        Full time series of one pixel, only chunks containing pixel are decoded.
+        :param row: pixel row from north
+        :param col: pixel column from west
+        :return: (sorted dates, array (dates, bands))
+        """
+        dates = self.dates
+        return dates, self.window(row, col, 1, 1, dates)[:, 0, 0]
+
+    def window(self, row, col, height, width, dates=None):
+        """
+        :param row, col: north-west pixel of window
+        :param height, width: window size in pixels
+        :param dates: list of dates str, all sorted dates by default
+        :return: array (dates, height, width, bands)
+        """
+        dates = self.dates if dates is None else dates
+        _, chunk_y, chunk_x, bands = self.meta["chunks"]
+        out = np.empty((len(dates), height, width, bands), dtype=self.dtype)
+        row_chunks = range(row // chunk_y, (row + height - 1) // chunk_y + 1)
+        col_chunks = range(col // chunk_x, (col + width - 1) // chunk_x + 1)
+        for i, date in enumerate(dates):
+            t = self.meta["dates"].index(date)
+            for r in row_chunks:
+                for c in col_chunks:
+                    chunk = self._read_chunk(t, r, c)
+                    y0, x0 = max(row, r * chunk_y), max(col, c * chunk_x)
+                    y1 = min(row + height, r * chunk_y + chunk.shape[0])
+                    x1 = min(col + width, c * chunk_x + chunk.shape[1])
+                    out[i, y0 - row:y1 - row, x0 - col:x1 - col] = \
+                        chunk[y0 - r * chunk_y:y1 - r * chunk_y, x0 - c * chunk_x:x1 - c * chunk_x]
+        return out
+
+    def pixel(self, x, y):
+        """
+        :param x, y: coordinates in CRS of cube bbox
+        :return: (row, col) of pixel
+        """
+        min_x, min_y, max_x, max_y = self.meta["bbox"]
+        _, height, width, _ = self.meta["shape"]
+        col = int((x - min_x) / (max_x - min_x) * width)
+        row = int((max_y - y) / (max_y - min_y) * height)
+        if not (0 <= row < height and 0 <= col < width):
+            raise ValueError("Point {0}, {1} is outside of cube bbox".format(x, y))
+        return row, col
+
+
+if __name__ == '__main__':
+    cube = DataCube(sys.argv[1])
+    if cube.meta is None:
+        sys.exit("No cube in {0}".format(sys.argv[1]))
+    print(json.dumps(dict(cube.meta, dates=cube.dates), indent=4))
@@ -0,0 +1,287 @@
+"""
+Long running local service around GISImageDownloader.
+Imports, OAuth token, connection pool, response cache and downloaders of
+fields stay warm between calls, identical requests in flight are sent
+upstream once and every waiter gets the same file. Queued requests are
+executed by caller class priority (settings.DAEMON_PRIORITIES).
+
+python daemon.py
+python daemon.py --port 8765
+python daemon.py --socket /tmp/fields_drones.sock
+
+POST /jobs {"field": "test", "band_type": "NDVIGV", "time_range": "2020-05-01,2020-05-30",
+            "priority": "interactive"}
+-> {"files": {"2020-05-03": "/tmp/test_dir/.../response.png"}, "errors": {}}
+GET /status
+see daemon_client.py
+"""
+import argparse
+import asyncio
+import collections
+import http.server
+import itertools
+import json
+import logging
+import os
+import socketserver
+import threading
+
+import settings
+from async_engine import AsyncDownloadEngine
+from cache import ResponseCache, request_key
+from fields_photo_downloader import GISImageDownloader
+from metrics import REGISTRY
+from tiling import needs_tiling
+from utils import init_logger
+
+log = logging.getLogger(__name__)
+
+# queue item, seq keeps FIFO order inside one priority
+QueuedRequest = collections.namedtuple(
+    "QueuedRequest", ["priority", "seq", "key", "field", "download_request"])
+
+
+def check_priority(caller_class):
+    caller_class = caller_class or settings.DAEMON_DEFAULT_PRIORITY
+    if caller_class not in settings.DAEMON_PRIORITIES:
+        raise ValueError("Priority incorrect use one of {0}.".format(
+            ", ".join(settings.DAEMON_PRIORITIES)))
+    return settings.DAEMON_PRIORITIES[caller_class]
+
+
+class DownloadDaemon(object):
+    """
+    Event loop with one AsyncDownloadEngine runs in its own thread, every
+    downloader, journal and index is used only from that thread.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or settings.DAEMON_WORKERS
+        self.cache = ResponseCache() if settings.RESPONSE_CACHE else None
+        self.downloaders = {}
+        self.stats = collections.Counter()
+        self.loop = None
+        self.engine = None
+        self.queue = None
+        # request_key -> asyncio.Future of in flight request
+        self.inflight = {}
+        self._running = set()
+        self._seq = itertools.count()
+        self._ready = threading.Event()
+        self._stop = None
+
+    def downloader(self, field):
+        if field not in self.downloaders:
+            self.downloaders[field] = GISImageDownloader(field, cache=self.cache)
+        return self.downloaders[field]
+
+    def start(self):
+        threading.Thread(target=lambda: asyncio.run(self.run_async()), daemon=True).start()
+        self._ready.wait()
+
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._stop.set)
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.PriorityQueue()
+        self._stop = asyncio.Event()
+        # downloader of default field is created now, its config is the same for all fields
+        config = self.downloader(next(iter(settings.FIELDS))).config
+        async with AsyncDownloadEngine(config, cache=self.cache) as engine:
+            self.engine = engine
+            workers = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+            self._ready.set()
+            await self._stop.wait()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def submit(self, params, timeout=None):
+        """
+        Called from server threads, blocks until all dates of job are done.
+        :param params: dict of POST /jobs
+        :return: dict with files and errors by date
+        """
+        future = asyncio.run_coroutine_threadsafe(self.run_job(params), self.loop)
+        return future.result(timeout)
+
+    def status(self):
+        return {
+            "queued": self.queue.qsize(),
+            "inflight": len(self.inflight),
+            "fields": sorted(self.downloaders),
+            "upstream": self.stats["upstream"],
+            "coalesced": self.stats["coalesced"],
+            "failed": self.stats["failed"],
+        }
+
+    async def run_job(self, params):
+        field = params.get("field", "test")
+        priority = check_priority(params.get("priority"))
+        downloader = self.downloader(field)
+        if needs_tiling(downloader._size):
+            raise ValueError("Field {0} is larger than MAX_REQUEST_DIMENSION, "
+                             "use fields_photo_downloader.py".format(field))
+        band_type = downloader.check_band_type(params.get("band_type", ""))
+        time_range = params.get("time_range") or "{0},{1}".format(
+            downloader.start_date, downloader.end_date)
+        t = downloader.prepare_time(time_range)
+        dates = downloader.dates_range(t)
+        all_dates = params.get("all_dates") or not settings.CATALOG_PLANNING
+        if len(t) > 1 and not all_dates:
+            try:
+                dates = await downloader.catalog.filter_dates_async(
+                    downloader._bbox, dates, self.engine)
+            except Exception as catalog_exc:
+                log.error("Catalog search for {0} failed: {1}".format(field, catalog_exc))
+            if settings.CLOUD_PROBE:
+                dates = await downloader.probe_dates_async(dates, self.engine)
+
+        requests = collections.OrderedDict(
+            (date, downloader.sentinel_cli_hub_request(
+                downloader._bbox, (date, date), band_type).download_list[0])
+            for date in dates
+        )
+        downloader.journal.plan([
+            (dr.get_hashed_name(), field, date, band_type) for date, dr in requests.items()
+        ])
+        results = await asyncio.gather(
+            *[self.fetch(field, dr, priority) for dr in requests.values()],
+            return_exceptions=True
+        )
+        files, errors = {}, {}
+        for date, result in zip(requests, results):
+            if isinstance(result, Exception):
+                errors[date] = str(result)
+            else:
+                files[date] = result
+        return {"field": field, "band_type": band_type, "files": files, "errors": errors}
+
+    async def fetch(self, field, download_request, priority):
+        """
+        Wait for request, identical request in flight is not sent again.
+        Every waiter queues it with own priority, first dequeued copy is executed.
+        :return: path of saved response
+        """
+        key = request_key(download_request)
+        future = self.inflight.get(key)
+        if future is None:
+            future = self.inflight[key] = self.loop.create_future()
+            self.stats["upstream"] += 1
+        else:
+            self.stats["coalesced"] += 1
+            REGISTRY.inc("daemon_coalesced_total")
+        self.queue.put_nowait(
+            QueuedRequest(priority, next(self._seq), key, field, download_request))
+        await asyncio.shield(future)
+        _, response_path = download_request.get_storage_paths()
+        return response_path
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            future = self.inflight.get(item.key)
+            if future is None or future.done() or item.key in self._running:
+                continue
+            self._running.add(item.key)
+            downloader = self.downloader(item.field)
+            try:
+                content = await self.engine.execute(item.download_request)
+            except Exception as request_exc:
+                self.stats["failed"] += 1
+                downloader.request_result(item.download_request, None, request_exc)
+                future.set_exception(request_exc)
+            else:
+                downloader.request_result(item.download_request, content, None)
+                future.set_result(None)
+            finally:
+                self._running.discard(item.key)
+                self.inflight.pop(item.key, None)
+
+
+def make_handler(daemon):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/status":
+                self.send_error(404)
+                return
+            self.reply(200, daemon.status())
+
+        def do_POST(self):
+            if self.path != "/jobs":
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                params = json.loads(self.rfile.read(length) or b"{}")
+                params["priority"] = params.get("priority") or self.headers.get("X-Caller-Class")
+                self.reply(200, daemon.submit(params, settings.DAEMON_JOB_TIMEOUT))
+            except ValueError as param_exc:
+                self.reply(400, {"error": str(param_exc)})
+            except Exception as job_exc:
+                log.exception("Job failed")
+                self.reply(500, {"error": str(job_exc)})
+
+        def reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects (host, port) client address
+        return request, ("local", 0)
+
+
+def serve(daemon, port=None, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, make_handler(daemon))
+        log.info("Daemon on unix socket {0}".format(socket_path))
+    else:
+        port = port or settings.DAEMON_PORT
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), make_handler(daemon))
+        log.info("Daemon on http://127.0.0.1:{0}".format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+
+
+if __name__ == '__main__':
+    init_logger(log)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="local http port, default settings.DAEMON_PORT",
+                        type=int, action="store")
+    parser.add_argument("--socket", help="serve on unix socket instead of http port, "
+                                         "default path settings.DAEMON_SOCKET",
+                        nargs="?", const=settings.DAEMON_SOCKET, action="store")
+    parser.add_argument("--workers", help="requests executed at once, "
+                                          "default settings.DAEMON_WORKERS",
+                        type=int, action="store")
+    parser.add_argument("--metrics-port", help="serve Prometheus metrics on "
+                                               "http://127.0.0.1:<port>/metrics",
+                        type=int, action="store")
+    args = parser.parse_args()
+    REGISTRY.configure(port=args.metrics_port)
+    download_daemon = DownloadDaemon(args.workers)
+    download_daemon.start()
+    serve(download_daemon, args.port, args.socket)
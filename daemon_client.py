@@ -0,0 +1,90 @@
+"""
+Client of daemon.py, standard library only so callers do not pay
+sentinelhub import cost on every call.
+
+python daemon_client.py -t 2020-05-01,2020-05-30 -b NDVIGV --priority interactive
+python daemon_client.py --socket /tmp/fields_drones.sock -t 2020-05-03 -b NDVIGV
+"""
+import argparse
+import http.client
+import json
+import socket
+import sys
+
+import settings
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connection(port=None, socket_path=None, timeout=None):
+    if socket_path:
+        return UnixHTTPConnection(socket_path, timeout=timeout)
+    return http.client.HTTPConnection("127.0.0.1", port or settings.DAEMON_PORT, timeout=timeout)
+
+
+def submit(job, port=None, socket_path=None, timeout=None):
+    """
+    :param job: dict with field, band_type, time_range, priority and all_dates
+    :return: dict with files and errors by date
+    """
+    conn = connection(port, socket_path, timeout or settings.DAEMON_JOB_TIMEOUT)
+    try:
+        conn.request("POST", "/jobs", body=json.dumps(job),
+                     headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        body = json.loads(resp.read() or b"{}")
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise RuntimeError("Daemon job failed {0}: {1}".format(resp.status, body.get("error")))
+    return body
+
+
+def status(port=None, socket_path=None):
+    conn = connection(port, socket_path)
+    try:
+        conn.request("GET", "/status")
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--field", help="settings.FIELDS key", default="test",
+                        action="store")
+    parser.add_argument("-t", "--time-range", help="2020-11-01 or 2020-05-01,2020-05-30, "
+                                                   "default field time range",
+                        action="store")
+    parser.add_argument("-b", "--band-type", help="settings.BAND_TYPES key", action="store")
+    parser.add_argument("--priority", help="caller class of settings.DAEMON_PRIORITIES",
+                        action="store")
+    parser.add_argument("--all-dates", help="request every day of time range",
+                        action="store_true")
+    parser.add_argument("--port", type=int, action="store")
+    parser.add_argument("--socket", help="unix socket of daemon", nargs="?",
+                        const=settings.DAEMON_SOCKET, action="store")
+    parser.add_argument("--status", help="print queue and coalescing counters",
+                        action="store_true")
+    args = parser.parse_args()
+    if args.status:
+        result = status(args.port, args.socket)
+    else:
+        result = submit({
+            "field": args.field,
+            "band_type": args.band_type,
+            "time_range": args.time_range,
+            "priority": args.priority,
+            "all_dates": args.all_dates,
+        }, args.port, args.socket)
+    json.dump(result, sys.stdout, indent=2)
+    print()
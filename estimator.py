@@ -0,0 +1,168 @@
+"""
+Dry run of a planned download (--plan), jobs of fields, dates, band types
+and tiles are built as they would be sent, nothing is sent.
+Processing units come from request payload (scheduler.estimate_processing_units),
+bytes are uncompressed output, wall time is projected from throughput
+recorded in metrics JSON lines of previous runs (--metrics-jsonl) and
+scheduler rate limits.
+"""
+import collections
+import json
+import logging
+import os
+import statistics
+
+import settings
+from resolution import raster_bytes, script_profile
+from scheduler import estimate_processing_units
+from tiling import needs_tiling, split_bbox
+
+log = logging.getLogger(__name__)
+
+PlannedJob = collections.namedtuple(
+    "PlannedJob", ["field", "kind", "dates", "band_type", "window", "width", "height",
+                   "processing_units", "bytes"])
+
+
+def planned_job(field, kind, dates, band_type, download_request, window=None):
+    payload = download_request.post_values or {}
+    output = payload.get("output", {})
+    width, height = output.get("width") or 0, output.get("height") or 0
+    return PlannedJob(
+        field, kind, dates, band_type, window, width, height,
+        estimate_processing_units(download_request),
+        raster_bytes((width, height), script_profile(payload.get("evalscript"))),
+    )
+
+
+def expand_jobs(downloader, dates, probe=False):
+    """
+    Jobs in the same way download_dates dispatches them.
+    :param downloader: configured GISImageDownloader
+    :param dates: list of dates str
+    :param probe: add cloud probe of every date
+    :return: list of PlannedJob
+    """
+    field, bbox = downloader.field_name, downloader._bbox
+    jobs = []
+    if probe:
+        for date in dates:
+            jobs.append(planned_job(field, "probe", [date], None,
+                                    downloader.cloud_probe_request(bbox, (date, date))
+                                    .download_list[0]))
+    if downloader.local_bands:
+        for date in dates:
+            jobs.append(planned_job(field, "raw", [date], ",".join(downloader.local_bands),
+                                    downloader.raw_hub_request(bbox, (date, date))
+                                    .download_list[0]))
+    elif downloader.band_types:
+        for date in dates:
+            jobs.append(planned_job(field, "multi", [date], ",".join(downloader.band_types),
+                                    downloader.multi_hub_request(
+                                        bbox, (date, date), downloader.band_types)
+                                    .download_list[0]))
+    elif downloader.multi_temporal:
+        for window in downloader.date_windows(dates):
+            jobs.append(planned_job(field, "orbit", window, downloader.band_type,
+                                    downloader.orbit_hub_request(
+                                        bbox, (window[0], window[-1]), downloader.band_type)
+                                    .download_list[0]))
+    elif needs_tiling(downloader._size):
+        tiles = split_bbox(bbox, downloader._size)
+        for date in dates:
+            for tile in tiles:
+                jobs.append(planned_job(field, "tile", [date], downloader.band_type,
+                                        downloader.sentinel_cli_hub_request(
+                                            tile.bbox, (date, date), downloader.band_type,
+                                            size=tile.size).download_list[0],
+                                        tile.window))
+    else:
+        for date in dates:
+            jobs.append(planned_job(field, "date", [date], downloader.band_type,
+                                    downloader.sentinel_cli_hub_request(
+                                        bbox, (date, date), downloader.band_type)
+                                    .download_list[0]))
+    return jobs
+
+
+def load_throughput(path):
+    """
+    :param path: metrics JSON lines of previous runs
+    :return: dict of median seconds per job and seconds per PU of downloaded
+    (not cached, not failed) jobs, None if there are none
+    """
+    if not path or not os.path.exists(path):
+        return None
+    durations, units = [], []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") != "ok" or record.get("cache_hit"):
+                continue
+            durations.append(record["duration"])
+            units.append(record.get("processing_units") or 0.0)
+    if not durations:
+        return None
+    return {
+        "jobs": len(durations),
+        "seconds_per_job": statistics.median(durations),
+        "seconds_per_pu": sum(durations) / sum(units) if sum(units) else None,
+    }
+
+
+def estimate(jobs, throughput=None, concurrency=None):
+    """
+    Wall time is the slowest of recorded job latency at concurrency (per job
+    and, for jobs larger than recorded ones, per PU), request rate limit and
+    PU rate limit of scheduler.
+    :param jobs: list of PlannedJob
+    :param throughput: load_throughput result
+    :param concurrency: requests in flight, default settings.ASYNC_MAX_CONCURRENCY
+    :return: dict
+    """
+    concurrency = concurrency or settings.ASYNC_MAX_CONCURRENCY
+    units = sum(job.processing_units for job in jobs)
+    bounds = {
+        "request_rate": len(jobs) / settings.SCHEDULER_REQUESTS_PER_MINUTE * 60,
+        "pu_rate": units / settings.SCHEDULER_PU_PER_MINUTE * 60,
+    }
+    if throughput:
+        bounds["latency"] = len(jobs) * throughput["seconds_per_job"] / concurrency
+        if throughput["seconds_per_pu"]:
+            bounds["pu_latency"] = units * throughput["seconds_per_pu"] / concurrency
+    bound = max(bounds, key=bounds.get) if jobs else None
+    kinds = collections.Counter(job.kind for job in jobs)
+    return {
+        "jobs": len(jobs),
+        "kinds": dict(kinds),
+        "fields": len({job.field for job in jobs}),
+        "dates": len({date for job in jobs for date in job.dates}),
+        "pixels": sum(job.width * job.height for job in jobs),
+        "processing_units": round(units, 2),
+        "bytes": sum(job.bytes for job in jobs),
+        "concurrency": concurrency,
+        "wall_seconds": round(bounds[bound], 1) if bound else 0.0,
+        "bound_by": bound,
+        "throughput": throughput,
+    }
+
+
+def log_estimate(result):
+    log.info("PLAN: {0} jobs {1} of {2} fields and {3} dates".format(
+        result["jobs"], result["kinds"], result["fields"], result["dates"]))
+    log.info("PLAN: {0:.1f} Mpx, {1} PU, {2:.1f} MB uncompressed".format(
+        result["pixels"] / 1e6, result["processing_units"], result["bytes"] / 1024 ** 2))
+    if not result["throughput"]:
+        log.info("PLAN: no recorded throughput (--metrics-jsonl), wall time from rate limits")
+    log.info("PLAN: ~{0:.0f} s ({1:.1f} min) at concurrency {2}, bound by {3}".format(
+        result["wall_seconds"], result["wall_seconds"] / 60, result["concurrency"],
+        result["bound_by"]))
+
+
+def write_jobs(path, jobs):
+    with open(path, "w") as f:
+        for job in jobs:
+            f.write(json.dumps(job._asdict()) + "\n")
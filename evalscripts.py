@@ -0,0 +1,228 @@
+"""
+Compose several settings.BAND_TYPES evalscripts into one multi-output
+evalscript, all band products come back in one Processing API response (TAR).
+Docks https://docs.sentinel-hub.com/api/latest/evalscript/v3/#output-object-properties
+"""
+import io
+import json
+import os
+import re
+import tarfile
+
+import settings
+from utils import decode_image
+
+MULTI_OUTPUT_TEMPLATE = """
+//VERSION=3
+{scripts}
+
+var OUTPUTS = [{outputs}];
+
+function setup() {{
+  var bands = [];
+  var output = [];
+  for (var i = 0; i < OUTPUTS.length; i++) {{
+    var conf = OUTPUTS[i].script.setup();
+    var input = conf.input[0].bands;
+    for (var j = 0; j < input.length; j++) {{
+      if (bands.indexOf(input[j]) === -1) {{
+        bands.push(input[j]);
+      }}
+    }}
+    var out = conf.output;
+    out.id = OUTPUTS[i].id;
+    output.push(out);
+  }}
+  return {{
+    input: [{{bands: bands}}],
+    output: output
+  }};
+}}
+
+function evaluatePixel(samples) {{
+  var result = {{}};
+  for (var i = 0; i < OUTPUTS.length; i++) {{
+    result[OUTPUTS[i].id] = OUTPUTS[i].script.evaluatePixel(samples);
+  }}
+  return result;
+}}
+"""
+
+SCRIPT_TEMPLATE = """
+var {name} = (function() {{
+{body}
+return {{setup: setup, evaluatePixel: evaluatePixel}};
+}})();
+"""
+
+
+ORBIT_TEMPLATE = """
+//VERSION=3
+{script}
+
+var BANDS = script.setup().output.bands;
+
+function setup() {{
+  return {{
+    input: [{{bands: script.setup().input[0].bands}}],
+    output: {{id: "default", bands: BANDS}},
+    mosaicking: "ORBIT"
+  }};
+}}
+
+function orbits(scenes) {{
+  return scenes.orbits || scenes;
+}}
+
+function updateOutput(outputs, collection) {{
+  outputs.default.bands = Math.max(1, orbits(collection.scenes).length) * BANDS;
+}}
+
+function updateOutputMetadata(scenes, inputMetadata, outputMetadata) {{
+  var dates = [];
+  var list = orbits(scenes);
+  for (var i = 0; i < list.length; i++) {{
+    dates.push(list[i].dateFrom || list[i].date);
+  }}
+  outputMetadata.userData = {{dates: dates, bands: BANDS}};
+}}
+
+function evaluatePixel(samples, scenes) {{
+  var result = [];
+  for (var i = 0; i < samples.length; i++) {{
+    result = result.concat(script.evaluatePixel(samples[i]));
+  }}
+  return result;
+}}
+"""
+
+
+SAMPLE_TYPE_TEMPLATE = """
+//VERSION=3
+{script}
+
+function setup() {{
+  var conf = script.setup();
+  conf.output.sampleType = "{sample_type}";
+  return conf;
+}}
+
+function evaluatePixel(samples) {{
+  return script.evaluatePixel(samples){scale};
+}}
+"""
+
+# UINT16 output keeps index values -1..1 as (value + offset) * scale,
+# samples after index ones (dataMask) are returned as they are
+UINT16_SCALE = (".map(function (v, i) {{ return i < {index_bands} ? "
+                "(v + {offset}) * {scale} : v; }})")
+
+
+def index_bands(band_type):
+    """
+    :return: number of leading output samples of band type which are index values
+    """
+    return settings.BAND_TYPES[band_type].get("index_bands", 0)
+
+
+def check_sample_type(band_type, sample_type):
+    """
+    UINT16 stores scaled index values, visualized colors would be cut to 0 and 1.
+    """
+    if sample_type == "UINT16" and not index_bands(band_type):
+        raise ValueError("Sample type UINT16 needs index band type (settings.BAND_TYPES "
+                         "\"index_bands\"), {0} is a visualization.".format(band_type))
+
+
+def output_id(band_type):
+    """
+    Response identifier of band type, only letters, digits and _ are allowed.
+    """
+    return re.sub(r"[^A-Za-z0-9_]", "_", band_type)
+
+
+def compose_evalscript(band_types):
+    """
+    Every band type script is wrapped in its own closure,
+    so their globals (viz, setup, evaluatePixel) do not collide.
+    :param band_types: list of settings.BAND_TYPES keys
+    :return: evalscript with one output per band type
+    """
+    scripts = []
+    outputs = []
+    for band_type in band_types:
+        name = "script_{0}".format(output_id(band_type))
+        body = settings.BAND_TYPES[band_type]["exec_script"].replace("//VERSION=3", "")
+        scripts.append(SCRIPT_TEMPLATE.format(name=name, body=body))
+        outputs.append('{{id: "{0}", script: {1}}}'.format(output_id(band_type), name))
+    return MULTI_OUTPUT_TEMPLATE.format(scripts="".join(scripts), outputs=", ".join(outputs))
+
+
+def compose_sample_type_evalscript(band_type, sample_type):
+    """
+    Band type script with output sampleType replaced, UINT16 index values are scaled
+    by settings.UINT16_SCALE and UINT16_OFFSET.
+    :param band_type: settings.BAND_TYPES key
+    :param sample_type: AUTO, UINT8, UINT16 or FLOAT32
+    :return: evalscript
+    """
+    body = settings.BAND_TYPES[band_type]["exec_script"].replace("//VERSION=3", "")
+    check_sample_type(band_type, sample_type)
+    scale = ""
+    if sample_type == "UINT16":
+        scale = UINT16_SCALE.format(index_bands=index_bands(band_type),
+                                    offset=settings.UINT16_OFFSET, scale=settings.UINT16_SCALE)
+    return SAMPLE_TYPE_TEMPLATE.format(
+        script=SCRIPT_TEMPLATE.format(name="script", body=body),
+        sample_type=sample_type, scale=scale)
+
+
+def split_tar(content):
+    """
+    :param content: multipart TAR response
+    :return: dict response identifier -> (file extension, bytes)
+    """
+    outputs = {}
+    with tarfile.open(fileobj=io.BytesIO(content)) as tar:
+        for member in tar.getmembers():
+            if not member.isfile():
+                continue
+            identifier, ext = os.path.splitext(os.path.basename(member.name))
+            outputs[identifier] = (ext, tar.extractfile(member).read())
+    return outputs
+
+
+def compose_orbit_evalscript(band_type):
+    """
+    Multi-temporal evalscript, band type script is evaluated for every
+    orbit (scene) of time interval, scenes are stacked along bands axis
+    and their dates are returned in userdata.json.
+    :param band_type: settings.BAND_TYPES key
+    :return: evalscript
+    """
+    body = settings.BAND_TYPES[band_type]["exec_script"].replace("//VERSION=3", "")
+    return ORBIT_TEMPLATE.format(
+        script=SCRIPT_TEMPLATE.format(name="script", body=body))
+
+
+def split_orbit_response(content):
+    """
+    :param content: TAR response of compose_orbit_evalscript request
+    :return: list of (date str %Y-%m-%d, array height x width x bands),
+    first scene of a date is kept when one date has several orbits
+    """
+    outputs = split_tar(content)
+    metadata = json.loads(outputs["userdata"][1])
+    image = decode_image(outputs["default"][1])
+    if image.ndim == 2:
+        image = image[..., None]
+    bands = metadata["bands"]
+    scenes = []
+    seen = set()
+    for i, timestamp in enumerate(metadata["dates"]):
+        date = timestamp[:10]
+        if date in seen:
+            continue
+        seen.add(date)
+        scenes.append((date, image[..., i * bands:(i + 1) * bands]))
+    return scenes
@@ -0,0 +1,158 @@
+"""
+Field shape instead of bounding box.
+settings.FIELDS "geometry" (or --geometry) is a WGS84 polygon or multipolygon
+as GeoJSON or WKT, requests send it so pixels outside of field are clipped
+by Sentinel Hub, local processing works only on pixels of PackedMask.
+"""
+import json
+import os
+
+import numpy as np
+from shapely import wkt
+from shapely.geometry import MultiPolygon, box, shape
+
+
+def load_geometry(value):
+    """
+    :param value: GeoJSON dict (geometry, Feature or FeatureCollection),
+    GeoJSON or WKT str, or path of file with one of them
+    :return: shapely Polygon or MultiPolygon
+    """
+    if isinstance(value, str) and os.path.exists(value):
+        with open(value) as f:
+            value = f.read()
+    if isinstance(value, str):
+        value = value.strip()
+        value = json.loads(value) if value.startswith("{") else wkt.loads(value)
+    if isinstance(value, dict):
+        if value.get("type") == "FeatureCollection":
+            value = {
+                "type": "MultiPolygon",
+                "coordinates": [
+                    polygon
+                    for feature in value["features"]
+                    for polygon in _polygons(feature["geometry"])
+                ],
+            }
+        elif value.get("type") == "Feature":
+            value = value["geometry"]
+        value = shape(value)
+    if value.geom_type not in ("Polygon", "MultiPolygon"):
+        raise ValueError("Field geometry has to be Polygon or MultiPolygon, "
+                         "not {0}".format(value.geom_type))
+    if not value.is_valid:
+        value = value.buffer(0)
+    return value
+
+
+def _polygons(geometry):
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    return geometry["coordinates"]
+
+
+def clip_geometry(geometry, bbox):
+    """
+    :param geometry: shapely geometry of field
+    :param bbox: [min_x, min_y, max_x, max_y] of request
+    :return: part of field inside bbox, None if field does not cover any area of bbox
+    """
+    clipped = geometry.intersection(box(*bbox))
+    if clipped.is_empty or clipped.area == 0:
+        return None
+    if clipped.geom_type == "GeometryCollection":
+        # lines and points where field touches bbox border are dropped
+        polygons = []
+        for part in clipped.geoms:
+            if part.geom_type == "Polygon":
+                polygons.append(part)
+            elif part.geom_type == "MultiPolygon":
+                polygons.extend(part.geoms)
+        clipped = polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+    return clipped
+
+
+def rasterize(geometry, bbox, size):
+    """
+    Scanline rasterization, pixel is inside when its center is inside (even-odd rule).
+    :param geometry: shapely Polygon or MultiPolygon
+    :param bbox: [min_x, min_y, max_x, max_y] of raster
+    :param size: (width, height) of raster
+    :return: bool array (height, width)
+    """
+    min_x, min_y, max_x, max_y = bbox
+    width, height = size
+    edges = []
+    for polygon in getattr(geometry, "geoms", [geometry]):
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            coords = np.asarray(ring.coords)
+            edges.append(np.hstack([coords[:-1], coords[1:]]))
+    edges = np.vstack(edges)
+    # edges in pixel coordinates, y grows to south
+    x0 = (edges[:, 0] - min_x) / (max_x - min_x) * width
+    y0 = (max_y - edges[:, 1]) / (max_y - min_y) * height
+    x1 = (edges[:, 2] - min_x) / (max_x - min_x) * width
+    y1 = (max_y - edges[:, 3]) / (max_y - min_y) * height
+
+    mask = np.zeros((height, width), dtype=bool)
+    for row in range(height):
+        y = row + 0.5
+        crossing = (y0 <= y) != (y1 <= y)
+        if not crossing.any():
+            continue
+        xa, ya, xb, yb = x0[crossing], y0[crossing], x1[crossing], y1[crossing]
+        xs = np.sort(xa + (y - ya) * (xb - xa) / (yb - ya))
+        # pixel centers col + 0.5 in [start, end)
+        starts = np.clip(np.ceil(xs[0::2] - 0.5), 0, width).astype(int)
+        ends = np.clip(np.ceil(xs[1::2] - 0.5), 0, width).astype(int)
+        for start, end in zip(starts, ends):
+            mask[row, start:end] = True
+    return mask
+
+
+class PackedMask(object):
+    """
+    Bit packed pixel mask of field, arrays are packed to field pixels
+    so out of field pixels are never computed.
+    """
+
+    def __init__(self, mask):
+        self.shape = mask.shape
+        self.bits = np.packbits(mask, axis=None)
+        self.count = int(np.count_nonzero(mask))
+        self._index = None
+
+    @classmethod
+    def from_geometry(cls, geometry, bbox, size):
+        return cls(rasterize(geometry, bbox, size))
+
+    @property
+    def fraction(self):
+        return self.count / (self.shape[0] * self.shape[1])
+
+    @property
+    def index(self):
+        if self._index is None:
+            size = self.shape[0] * self.shape[1]
+            self._index = np.flatnonzero(np.unpackbits(self.bits, count=size))
+        return self._index
+
+    def pack(self, array):
+        """
+        :param array: (..., height, width, bands)
+        :return: (..., field pixels, bands)
+        """
+        lead = array.shape[:-3]
+        flat = array.reshape(lead + (-1,) + array.shape[-1:])
+        return flat[..., self.index, :]
+
+    def unpack(self, packed, fill=0):
+        """
+        :param packed: (..., field pixels, bands)
+        :return: (..., height, width, bands), out of field pixels are fill
+        """
+        lead = packed.shape[:-2]
+        out = np.full(lead + (self.shape[0] * self.shape[1],) + packed.shape[-1:], fill,
+                      dtype=packed.dtype)
+        out[..., self.index, :] = packed
+        return out.reshape(lead + self.shape + packed.shape[-1:])
@@ -1,29 +1,101 @@
+import collections
 import concurrent
 import datetime
+import functools
+import hashlib
+import json
 import logging
 import os
 import argparse
-from sentinelhub import (
-    SHConfig, MimeType, CRS,
-    BBox, SentinelHubRequest,
-    DataSource, bbox_to_dimensions, WmsRequest
-)
+import random
+import time
+
 import settings
-from utils import init_mp_pool, init_logger, init_thread_pool_executor, timeit
+from evalscripts import (
+    check_sample_type, compose_evalscript, compose_orbit_evalscript,
+    compose_sample_type_evalscript, index_bands, output_id, split_orbit_response, split_tar
+)
+from journal import Journal
+from metrics import REGISTRY, timed_phase
+from utils import (
+    atomic_write, decode_image, encode_png, encode_tiff,
+    init_mp_pool, init_logger, init_thread_pool_executor, lazy_import, timeit
+)
+
+# heavy packages and modules which import them are loaded on first use,
+# --help, --plan and cache hits do not pay for what they do not touch
+# (python benchmarks/import_time.py)
+asyncio = lazy_import("asyncio")
+np = lazy_import("numpy")
+(SHConfig, MimeType, CRS, BBox, SentinelHubRequest,
+ DataSource, WmsRequest, Geometry) = lazy_import(
+    "sentinelhub", "SHConfig", "MimeType", "CRS", "BBox", "SentinelHubRequest",
+    "DataSource", "WmsRequest", "Geometry")
+band_math = lazy_import("band_math")
+estimator = lazy_import("estimator")
+contact_sheet, valid_fraction = lazy_import("preview", "contact_sheet", "valid_fraction")
+merge_profiles, plan_resolution, script_profile = lazy_import(
+    "resolution", "merge_profiles", "plan_resolution", "script_profile")
+consume_array, share_array = lazy_import("shared_arrays", "consume_array", "share_array")
+RasterIndex, crop_rasters, request_footprint = lazy_import(
+    "spatial_index", "RasterIndex", "crop_rasters", "request_footprint")
+download_mosaic, needs_tiling, split_bbox, window_tile = lazy_import(
+    "tiling", "download_mosaic", "needs_tiling", "split_bbox", "window_tile")
+AsyncDownloadEngine, save_response = lazy_import(
+    "async_engine", "AsyncDownloadEngine", "save_response")
+ResponseCache, cacheable, request_key = lazy_import(
+    "cache", "ResponseCache", "cacheable", "request_key")
+AcquisitionCatalog = lazy_import("catalog", "AcquisitionCatalog")
+cloud_fraction, probe_size = lazy_import("cloud_probe", "cloud_fraction", "probe_size")
+write_cog = lazy_import("cog", "write_cog")
+Compositor = lazy_import("composite", "Compositor")
+DataCube = lazy_import("cube", "DataCube")
+SceneStore, link_file, unshare = lazy_import(
+    "scene_store", "SceneStore", "link_file", "unshare")
+PackedMask, clip_geometry, load_geometry = lazy_import(
+    "field_geometry", "PackedMask", "clip_geometry", "load_geometry")
 
 log = logging.getLogger(__name__)
 
 
 class GISImageDownloader(object):
-    def __init__(self, field_name):
+    def __init__(self, field_name, cache=None):
+        self.field_name = field_name
         self.data = self.field_data(field_name)
+        self.geometry = self.field_geometry()
         self._bbox, self._size = self.bbox_size()
+        self._field_mask = None
+        self.cube_dates = set()
+        # cube (--cube) and running temporal composite (--composite) of downloaded dates
+        self.cube = None
+        self.compositor = None
+        # one engine (OAuth token, connection pool, scheduler) for catalog search,
+        # cloud probe and downloads of a run, see run_engine
+        self._loop = None
+        self._engine = None
+        self._request_callback = None
         self.config = self.generate_conf()
         self.wms_config = self.generate_wms_conf()
         self.data_dir = self.check_data_dir_exist()
+        self.catalog = AcquisitionCatalog(
+            self.config, os.path.join(self.data_dir, settings.CATALOG_CACHE_DIR))
+        self.journal = Journal(os.path.join(self.data_dir, settings.JOURNAL_FILE))
+        self.raster_index = RasterIndex(os.path.join(self.data_dir, settings.SPATIAL_INDEX_FILE))
+        self.scene_store = SceneStore(os.path.join(self.data_dir, settings.SCENE_DIR))
         self.start_date = self.data.get("time_range").get("start_date")
         self.end_date = self.data.get("time_range").get("end_date")
+        # scene cloud coverage filter of Processing API
+        self.maxcc = self.data.get("maxcc", 1.0)
+        self.cloud_threshold = self.data.get("cloud_threshold", settings.CLOUD_THRESHOLD)
         self.band_type = None
+        self.local_bands = None
+        self.band_types = None
+        self.multi_temporal = False
+        self.output_format = settings.OUTPUT_FORMAT
+        self.sample_type = settings.OUTPUT_SAMPLE_TYPE
+        if cache is None and settings.RESPONSE_CACHE:
+            cache = ResponseCache()
+        self.cache = cache
 
     def check_data_dir_exist(self):
         pth = self.data.get("dir")
@@ -41,6 +113,7 @@ class GISImageDownloader(object):
         conf = SHConfig()
         conf.sh_client_id = settings.SENTINEL_HUB_CLIENT_ID
         conf.sh_client_secret = settings.SENTINEL_HUB_SECRET_KEY
+        conf.sh_base_url = settings.SENTINEL_HUB_BASE_URL
         return conf
 
     def generate_wms_conf(self):
@@ -48,12 +121,47 @@ class GISImageDownloader(object):
         conf.instance_id = settings.SENTINEL_HUB_INSTANCE_ID
         return conf
 
+    def field_geometry(self):
+        """
+        :return: shapely geometry of field "geometry", None if field is a bbox
+        """
+        geometry = self.data.get("geometry")
+        return load_geometry(geometry) if geometry else None
+
     def bbox_size(self):
         resolution = self.data.get("resolution")
         coords = self.data.get("coordinates")
+        if not coords and self.geometry is not None:
+            coords = list(self.geometry.bounds)
         _bbox = BBox(bbox=coords, crs=CRS.WGS84)
-        _size = bbox_to_dimensions(_bbox, resolution=resolution)
-        return _bbox, _size
+        plan = plan_resolution(_bbox, script_profile(self.generate_evalscript()),
+                               field_resolution=resolution)
+        return _bbox, plan.size
+
+    def plan_size(self, resolution=None, max_pixels=None, max_bytes=None, max_pu=None):
+        """
+        Output size of self._bbox from budgets, see resolution.py
+        :param resolution: m/px, by default field "resolution" not finer than NATIVE_RESOLUTION
+        :return: (width, height)
+        """
+        if self.local_bands:
+            scripts = [settings.RAW_BANDS_EVALSCRIPT]
+        else:
+            scripts = [settings.BAND_TYPES[b]["exec_script"]
+                       for b in self.band_types or [self.band_type]]
+        profile = merge_profiles([script_profile(script) for script in scripts])
+        if self.sample_type and self.sample_type != "AUTO":
+            profile = profile._replace(sample_type=self.sample_type)
+        # raw, multi band and multi-temporal requests are not split into tiles
+        single_request = self.local_bands or self.band_types or self.multi_temporal
+        plan = plan_resolution(
+            self._bbox, profile, resolution, self.data.get("resolution"),
+            max_pixels=max_pixels, max_bytes=max_bytes, max_pu=max_pu,
+            max_dimension=settings.MAX_REQUEST_DIMENSION if single_request else None,
+        )
+        log.info("RESOLUTION: {0} m/px, {1}x{2} px, {3:.1f} MB, {4:.2f} PU per request".format(
+            plan.resolution, plan.size[0], plan.size[1], plan.bytes / 1024 ** 2, plan.pu))
+        return plan.size
 
     def generate_evalscript(self):
         return self.data.get("exec_script")
@@ -75,6 +183,53 @@ class GISImageDownloader(object):
         else:
             raise ValueError("Band type incorrect check settings.BAND_TYPES.")
 
+    def prepare_local_bands(self, band_types):
+        """
+        :param band_types: comma separated band types, all locally rendered if empty
+        :return: list of band types
+        """
+        if not band_types:
+            return [b for b in settings.BAND_TYPES if b in band_math.VISUALIZERS]
+        return [band_math.check_local_band(self.check_band_type(b.strip()))
+                for b in band_types.split(",")]
+
+    def prepare_band_types(self, band_types):
+        """
+        :param band_types: comma separated band types
+        :return: list of band types
+        """
+        return [self.check_band_type(b.strip()) for b in band_types.split(",")]
+
+    def request_geometry(self, coords):
+        """
+        :param coords: BBox of request
+        :return: sentinelhub Geometry of field part inside coords, None for bbox fields
+        """
+        if self.geometry is None:
+            return None
+        clipped = clip_geometry(self.geometry, list(coords))
+        return Geometry(clipped, coords.crs) if clipped is not None else None
+
+    def field_covers(self, coords):
+        """
+        :param coords: BBox of tile or strip
+        :return: False when whole coords is outside of field geometry
+        """
+        return self.geometry is None or clip_geometry(self.geometry, list(coords)) is not None
+
+    def field_mask(self):
+        """
+        :return: PackedMask of field geometry over current bbox and size, None for bbox fields
+        """
+        if self.geometry is None:
+            return None
+        key = (tuple(self._bbox), tuple(self._size))
+        if self._field_mask is None or self._field_mask[0] != key:
+            mask = PackedMask.from_geometry(self.geometry, list(self._bbox), self._size)
+            log.info("Field covers {0:.0%} of bbox".format(mask.fraction))
+            self._field_mask = (key, mask)
+        return self._field_mask[1]
+
     def eval_scr_by_band(self, band_name):
         eval_src = settings.BAND_TYPES.get(band_name)
         return eval_src.get("exec_script")
@@ -91,17 +246,754 @@ class GISImageDownloader(object):
         else:
             return dates
 
+    def __getstate__(self):
+        # mp mode pickles downloader for pool workers, they do not use the engine
+        state = self.__dict__.copy()
+        state["_loop"] = state["_engine"] = None
+        return state
+
+    def run_engine(self, coro_function):
+        """
+        Run coro_function(engine) on the engine shared by every request of this
+        downloader, event loop and engine are created on first use.
+        :return: result of coroutine
+        """
+        if self._engine is None:
+            self._loop = asyncio.new_event_loop()
+            self._engine = AsyncDownloadEngine(self.config, cache=self.cache,
+                                               callback=self.engine_result)
+            self._loop.run_until_complete(self._engine.__aenter__())
+        return self._loop.run_until_complete(coro_function(self._engine))
+
+    def close_engine(self):
+        if self._engine is not None:
+            self._loop.run_until_complete(self._engine.__aexit__(None, None, None))
+            self._loop.close()
+            self._loop = self._engine = None
+
+    def engine_result(self, download_request, content, error):
+        """
+        Callback of shared engine, only downloads which ask for it (async_requests)
+        get results, probes, tiles and strips are handled by their callers.
+        """
+        if self._request_callback is not None:
+            self._request_callback(download_request, content, error)
+
+    def plan_dates(self, dates):
+        """
+        Drop dates without acquisition over current bbox, see catalog.py
+        :param dates: list of dates str
+        :return: list of dates str
+        """
+        try:
+            return self.run_engine(
+                lambda engine: self.catalog.filter_dates_async(self._bbox, dates, engine))
+        except Exception as catalog_exc:
+            log.error("Catalog search failed, all dates will be requested: {0}".format(
+                catalog_exc))
+            return dates
+
+    def probe_dates(self, dates):
+        """
+        Drop dates whose field is covered by clouds, see cloud_probe.py
+        :param dates: list of dates str
+        :return: list of dates str
+        """
+        return self.run_engine(lambda engine: self.probe_dates_async(dates, engine))
+
+    async def probe_dates_async(self, dates, engine=None):
+        """
+        Same as probe_dates, probes go through engine if it is given.
+        Date is kept if its probe failed.
+        """
+        if engine is None:
+            async with AsyncDownloadEngine(self.config, cache=self.cache) as engine:
+                return await self.probe_dates_async(dates, engine)
+
+        download_requests = []
+        for date in dates:
+            download_request = self.cloud_probe_request(self._bbox, (date, date)).download_list[0]
+            download_request.save_response = False
+            download_requests.append(download_request)
+        contents = await engine.execute_all(download_requests)
+
+        clear = []
+        for date, content in zip(dates, contents):
+            if isinstance(content, Exception):
+                clear.append(date)
+                continue
+            with timed_phase("decode"):
+                fraction = cloud_fraction(decode_image(content))
+            if fraction is None:
+                log.info("CLOUD PROBE {0}: no data, skipped".format(date))
+            elif fraction > self.cloud_threshold:
+                log.info("CLOUD PROBE {0}: {1:.0%} clouds, skipped".format(date, fraction))
+            else:
+                clear.append(date)
+        REGISTRY.inc("fields_cloudy_dates_skipped_total", len(dates) - len(clear))
+        log.info("CLOUD PROBE: {0} of {1} dates below {2:.0%} clouds".format(
+            len(clear), len(dates), self.cloud_threshold))
+        return clear
+
+    def preview_path(self, band_type, date):
+        return os.path.join(self.data_dir, settings.PREVIEW_DIR, band_type, f"{date}.png")
+
+    def preview_dates(self, dates, selected=None):
+        """
+        WMS thumbnails of every acquisition in dates range are fetched in parallel
+        and saved with contact sheet into data_dir/PREVIEW_DIR/<band>/, see preview.py
+        :param dates: list of dates str
+        :param selected: dates to refine, by default every date whose thumbnail has data
+        :return: list of dates str to download in full resolution
+        """
+        if not settings.SENTINEL_HUB_INSTANCE_ID:
+            raise ValueError("Preview needs SENTINEL_HUB_INSTANCE_ID with a WMS layer "
+                             "for every band type.")
+        band_type = self.band_type or (self.local_bands or self.band_types)[0]
+        req = self.wms_preview_request((dates[0], dates[-1]), band_type)
+        with timed_phase("download"):
+            images = req.get_data(max_threads=settings.PREVIEW_THREADS)
+        wanted = set(dates)
+        thumbnails = collections.OrderedDict()
+        # WMS returns most recent first, one date can have several tiles
+        for timestamp, image in sorted(zip(req.get_dates(), images), key=lambda i: i[0]):
+            date = timestamp.strftime("%Y-%m-%d")
+            if date in wanted and date not in thumbnails:
+                thumbnails[date] = image
+
+        with timed_phase("write"):
+            for date, image in thumbnails.items():
+                atomic_write(self.preview_path(band_type, date),
+                             encode_png(image if image.ndim == 2 or image.shape[2] > 1
+                                        else image[:, :, 0]))
+            if thumbnails:
+                sheet_path = os.path.join(self.data_dir, settings.PREVIEW_DIR, band_type,
+                                          "contact_sheet_{0}_{1}.png".format(dates[0], dates[-1]))
+                contact_sheet(list(thumbnails.items())).save(sheet_path)
+                log.info("PREVIEW: {0} dates, contact sheet {1}".format(
+                    len(thumbnails), sheet_path))
+
+        if selected:
+            return [date for date in dates if date in set(selected)]
+        return [
+            date for date, image in thumbnails.items()
+            if valid_fraction(image) >= settings.PREVIEW_MIN_VALID
+        ]
+
+    def date_windows(self, dates):
+        """
+        Group dates into windows not longer than MULTI_TEMPORAL_WINDOW_DAYS.
+        :param dates: sorted list of dates str
+        :return: list of lists of dates str
+        """
+        windows = []
+        window_start = None
+        for date in dates:
+            day = datetime.datetime.strptime(date, "%Y-%m-%d")
+            if window_start is None or (day - window_start).days >= settings.MULTI_TEMPORAL_WINDOW_DAYS:
+                windows.append([])
+                window_start = day
+            windows[-1].append(date)
+        return windows
+
+    def journal_dates(self, dates, resume=False, record=True):
+        """
+        Record dispatched jobs in journal, with resume only dates whose job
+        is not done or whose output is missing or corrupted are kept.
+        :param dates: list of dates str
+        :param resume: skip jobs completed by previous runs
+        :param record: False only checks journal (--plan)
+        :return: list of dates str
+        """
+        if (self.local_bands or self.band_types or self.multi_temporal
+                or needs_tiling(self._size)):
+            if resume:
+                log.warning("Resume works only for per date downloads of one band type, "
+                            "all dates are requested")
+            return dates
+        jobs = collections.OrderedDict(
+            (date, self.sentinel_cli_hub_request(
+                self._bbox, (date, date), self.band_type).download_list[0].get_hashed_name())
+            for date in dates
+        )
+        if resume:
+            outstanding = self.journal.outstanding(jobs.values())
+            log.info("RESUME: {0} of {1} dates outstanding".format(len(outstanding), len(jobs)))
+            jobs = collections.OrderedDict(
+                (date, job_id) for date, job_id in jobs.items() if job_id in outstanding)
+        if not record:
+            return list(jobs)
+        self.journal.plan([
+            (job_id, self.field_name, date, self.band_type) for date, job_id in jobs.items()
+        ])
+        return list(jobs)
+
+    def request_result(self, download_request, content, error):
+        """
+        Callback of AsyncDownloadEngine, saved response is stored once per scene
+        (scene_store.py) and recorded in journal (journal.py) and spatial index (spatial_index.py)
+        :param content: response bytes, saved file is read if None
+        """
+        job_id = download_request.get_hashed_name()
+        if error is not None:
+            self.journal.fail(job_id, error)
+        elif download_request.save_response:
+            _, response_path = download_request.get_storage_paths()
+            if settings.SCENE_DEDUP:
+                _, shared = self.scene_store.add(response_path, content)
+                if shared:
+                    # file is stored scene now, its bytes can differ from content
+                    content = None
+            self.journal.complete(job_id, response_path, content)
+            self.raster_index.add_request(download_request, response_path)
+
     def multi_proc_requests(self, dates):
+        """
+        Failed dates do not stop the pool, they are retried
+        with backoff up to SCHEDULER_MAX_RETRIES times.
+        """
         with init_mp_pool() as pool:
+            for attempt in range(settings.SCHEDULER_MAX_RETRIES + 1):
+                failed = []
+                for date, error, records in pool.imap_unordered(self.sentinel_mp_job, dates):
+                    REGISTRY.merge(records)
+                    if error:
+                        failed.append(date)
+                    else:
+                        self.date_done(date)
+                if not failed:
+                    return
+                delay = min(settings.SCHEDULER_BACKOFF_MAX,
+                            settings.SCHEDULER_BACKOFF_BASE * 2 ** attempt)
+                log.warning("{0} dates failed, retry in {1} s".format(len(failed), delay))
+                time.sleep(random.uniform(delay / 2, delay))
+                dates = failed
+            log.error("Dates failed after retries: {0}".format(dates))
+
+    def worker_state(self):
+        """
+        Everything init_shm_worker needs, pickled once per pool worker
+        """
+        return {
+            "field_name": self.field_name,
+            "bbox": self._bbox,
+            "size": self._size,
+            "band_type": self.band_type,
+            "geometry": self.geometry,
+            "sample_type": self.sample_type,
+            "output_format": self.output_format,
+            "settings": {
+                name: getattr(settings, name)
+                for name in ("RESPONSE_CACHE", "SPATIAL_INDEX", "CLOUD_PROBE", "SCENE_DEDUP")
+            },
+        }
+
+    def shm_requests(self, dates):
+        """
+        Workers of process pool download and decode dates, rasters come back
+        through shared memory (shared_arrays.py) and are written into
+        data_dir/CUBE_DIR/<band> without pickling.
+        :param dates: list of dates str
+        """
+        cube = DataCube(self.cube_path(self.band_type))
+
+        def _write(date, image):
+            with timed_phase("write"):
+                cube.write(date, image, bbox=self._bbox, band_type=self.band_type)
+
+        with init_mp_pool(init_shm_worker, (self.worker_state(),),
+                          processes=settings.SHM_WORKERS) as pool:
+            for attempt in range(settings.SCHEDULER_MAX_RETRIES + 1):
+                failed = []
+                for date, shared, error, records in pool.imap_unordered(shm_job, dates):
+                    REGISTRY.merge(records)
+                    if error:
+                        failed.append(date)
+                        continue
+                    consume_array(shared, functools.partial(_write, date))
+                    self.cube_dates.add(date)
+                if not failed:
+                    return
+                delay = min(settings.SCHEDULER_BACKOFF_MAX,
+                            settings.SCHEDULER_BACKOFF_BASE * 2 ** attempt)
+                log.warning("{0} dates failed, retry in {1} s".format(len(failed), delay))
+                time.sleep(random.uniform(delay / 2, delay))
+                dates = failed
+            log.error("Dates failed after retries: {0}".format(dates))
+
+    def sentinel_mp_job(self, date):
+        """
+        :return: (date, error str or None, metrics records of worker),
+        exception never leaves worker
+        """
+        with REGISTRY.capture() as records:
             try:
-                for i in pool.imap_unordered(self.sentinel_mp_requests, dates):
-                    pass
-            except Exception as pool_exc:
-                log.error("Error is raised: {0}".format(pool_exc))
+                self.sentinel_mp_requests(date)
+                error = None
+            except Exception as job_exc:
+                log.error("Error is raised for {0}: {1}".format(date, job_exc))
+                error = str(job_exc)
+        return date, error, records
 
     def get_satellite_data(self, dates):
         for date in dates:
             self.sentinel_mp_requests(date)
+            self.date_done(date)
+
+    def async_requests(self, dates):
+        """
+        Download all dates through one AsyncDownloadEngine,
+        one OAuth token and one connection pool for every request.
+        :param dates: list of dates str
+        """
+        download_requests, request_dates = [], {}
+        for date in dates:
+            req = self.sentinel_cli_hub_request(self._bbox, (date, date), self.band_type)
+            download_requests.extend(req.download_list)
+            request_dates.update((dr.get_hashed_name(), date) for dr in req.download_list)
+
+        def callback(download_request, content, error):
+            self.request_result(download_request, content, error)
+            if error is None:
+                self.date_done(request_dates[download_request.get_hashed_name()])
+
+        self._request_callback = callback
+        try:
+            self.run_engine(lambda engine: engine.execute_all(download_requests))
+        finally:
+            self._request_callback = None
+
+    def raster_key(self):
+        """
+        :return: <width>x<height>_<bbox hash>, outputs of different bbox or
+        resolution do not share files
+        """
+        bbox = json.dumps([list(self._bbox), str(self._bbox.crs)])
+        return "{0}x{1}_{2}".format(self._size[0], self._size[1],
+                                    hashlib.sha1(bbox.encode()).hexdigest()[:12])
+
+    def mosaic_path(self, date):
+        return os.path.join(
+            self.data_dir, settings.MOSAIC_DIR,
+            f"{self.band_type}_{date}_{self.raster_key()}.npy")
+
+    def tiled_requests(self, dates):
+        """
+        Bbox is too large for one request, every date is downloaded as
+        a grid of tiles and stitched into data_dir/MOSAIC_DIR/<band>_<date>_<raster_key>.npy
+        :param dates: list of dates str
+        """
+        # tiles outside of field geometry stay empty in mosaic
+        tiles = [tile for tile in split_bbox(self._bbox, self._size)
+                 if self.field_covers(tile.bbox)]
+        jobs = []
+        for date in dates:
+            download_requests = [
+                self.sentinel_cli_hub_request(
+                    tile.bbox, (date, date), self.band_type, size=tile.size
+                ).download_list[0]
+                for tile in tiles
+            ]
+            jobs.append((download_requests, self.mosaic_path(date)))
+
+        async def _run(engine):
+            return await asyncio.gather(*[
+                download_mosaic(engine, tiles, reqs, path, self._size)
+                for reqs, path in jobs
+            ], return_exceptions=True)
+
+        for date, res in zip(dates, self.run_engine(_run)):
+            if isinstance(res, Exception):
+                log.error("Mosaic for {0} failed: {1}".format(date, res))
+                continue
+            self.raster_index.add(res, request_footprint(self.sentinel_cli_hub_request(
+                self._bbox, (date, date), self.band_type).download_list[0]))
+
+    def local_requests(self, dates):
+        """
+        Dates covered by rasters of spatial index are cropped locally,
+        only not covered strips are downloaded, see spatial_index.py
+        :param dates: list of dates str
+        :return: list of dates str which have to be downloaded whole
+        """
+        remaining = []
+        crops = []
+        for date in dates:
+            download_request = self.sentinel_cli_hub_request(
+                self._bbox, (date, date), self.band_type).download_list[0]
+            footprint = request_footprint(download_request)
+            _, response_path = download_request.get_storage_paths()
+            rasters = [r for r in self.raster_index.query(footprint) if r["path"] != response_path]
+            if not rasters:
+                remaining.append(date)
+                continue
+            with timed_phase("decode"):
+                image, missing = crop_rasters(footprint, rasters)
+            if image is None or len(missing) > settings.SPATIAL_INDEX_MAX_STRIPS:
+                remaining.append(date)
+                continue
+            strips = [window_tile(self._bbox, self._size, window) for window in missing]
+            strips = [strip for strip in strips if self.field_covers(strip.bbox)]
+            crops.append((date, download_request, image, strips))
+        if crops:
+            log.info("LOCAL: {0} of {1} dates cropped from stored rasters, {2} strips "
+                     "requested".format(len(crops), len(dates), sum(len(c[3]) for c in crops)))
+            self.crop_requests(crops)
+        return remaining
+
+    def crop_requests(self, crops):
+        """
+        :param crops: list of (date, DownloadRequest, cropped image, missing strips Tile)
+        """
+        strip_requests = []
+        for date, _, _, strips in crops:
+            for strip in strips:
+                strip_request = self.sentinel_cli_hub_request(
+                    strip.bbox, (date, date), self.band_type, size=strip.size).download_list[0]
+                strip_request.save_response = False
+                strip_requests.append(strip_request)
+        contents = iter(self.run_engine(lambda engine: engine.execute_all(strip_requests))
+                        if strip_requests else [])
+
+        for date, download_request, image, strips in crops:
+            strip_contents = [next(contents) for _ in strips]
+            errors = [c for c in strip_contents if isinstance(c, Exception)]
+            if errors:
+                log.error("Strips for {0} failed: {1}".format(date, errors[0]))
+                self.request_result(download_request, None, errors[0])
+                continue
+            for strip, content in zip(strips, strip_contents):
+                with timed_phase("decode"):
+                    strip_image = decode_image(content)
+                row, col, height, width = strip.window
+                image[row:row + height, col:col + width] = strip_image.reshape(
+                    (height, width) + image.shape[2:])
+            with timed_phase("write"):
+                content = self.encode_response(download_request, image)
+                save_response(download_request, content)
+            self.request_result(download_request, content, None)
+
+    def band_path(self, band_type, date, ext=".png"):
+        return os.path.join(
+            self.data_dir, settings.BAND_FILES_DIR, band_type, f"{date}{ext}")
+
+    def raw_requests(self, dates):
+        """
+        Raw mode, B04/B08/dataMask of every date are downloaded once and
+        every band of self.local_bands is rendered locally in batches of dates.
+        :param dates: list of dates str
+        """
+        if needs_tiling(self._size):
+            raise ValueError("Raw mode does not support bbox larger than "
+                             "MAX_REQUEST_DIMENSION, use larger resolution.")
+
+        async def _run(engine):
+            loop = asyncio.get_event_loop()
+            for start in range(0, len(dates), settings.RAW_BATCH_SIZE):
+                batch = dates[start:start + settings.RAW_BATCH_SIZE]
+                download_requests = [
+                    self.raw_hub_request(self._bbox, (date, date)).download_list[0]
+                    for date in batch
+                ]
+                contents = await engine.execute_all(download_requests)
+                downloaded = [
+                    (date, content) for date, content in zip(batch, contents)
+                    if not isinstance(content, Exception)
+                ]
+                if downloaded:
+                    await loop.run_in_executor(None, self.render_local, downloaded)
+
+        self.run_engine(_run)
+
+    def render_local(self, downloaded):
+        """
+        :param downloaded: list of (date, raw TIFF content)
+        """
+        with timed_phase("decode"):
+            stack = np.stack([decode_image(content) for _, content in downloaded])
+        mask = self.field_mask()
+        with timed_phase("render"):
+            if mask is not None:
+                # only pixels of field are rendered, others stay transparent
+                packed = band_math.render_stack(self.local_bands, mask.pack(stack))
+                rendered = {band_type: mask.unpack(images) for band_type, images in packed.items()}
+            else:
+                rendered = band_math.render_stack(self.local_bands, stack)
+        with timed_phase("write"):
+            for band_type, images in rendered.items():
+                for (date, _), image in zip(downloaded, images):
+                    atomic_write(self.band_path(band_type, date), encode_png(image))
+        log.info("Rendered {0} for {1} dates".format(self.local_bands, len(downloaded)))
+
+    def multi_band_requests(self, dates):
+        """
+        Every band of self.band_types comes in one multi-output response
+        per date, response is split into data_dir/BAND_FILES_DIR/<band>/<date>.png
+        :param dates: list of dates str
+        """
+        if needs_tiling(self._size):
+            raise ValueError("Several band types do not support bbox larger than "
+                             "MAX_REQUEST_DIMENSION, use larger resolution.")
+        download_requests = []
+        for date in dates:
+            download_request = self.multi_hub_request(
+                self._bbox, (date, date), self.band_types).download_list[0]
+            # tar is split into band files, no need to keep it in hash folder
+            download_request.save_response = False
+            download_requests.append(download_request)
+
+        contents = self.run_engine(lambda engine: engine.execute_all(download_requests))
+        for date, content in zip(dates, contents):
+            if isinstance(content, Exception):
+                continue
+            with timed_phase("decode"):
+                outputs = split_tar(content)
+            with timed_phase("write"):
+                for band_type in self.band_types:
+                    ext, data = outputs[output_id(band_type)]
+                    atomic_write(self.band_path(band_type, date, ext), data)
+        log.info("Saved {0} for {1} dates".format(self.band_types, len(dates)))
+
+    def multi_temporal_requests(self, dates):
+        """
+        One ORBIT mosaicking request per window of dates, every scene
+        of response is saved as the PNG the per day request would produce.
+        :param dates: list of dates str
+        """
+        if needs_tiling(self._size):
+            raise ValueError("Multi-temporal mode does not support bbox larger than "
+                             "MAX_REQUEST_DIMENSION, use larger resolution.")
+        windows = self.date_windows(dates)
+        download_requests = []
+        for window in windows:
+            download_request = self.orbit_hub_request(
+                self._bbox, (window[0], window[-1]), self.band_type).download_list[0]
+            download_request.save_response = False
+            download_requests.append(download_request)
+        log.info("{0} dates in {1} multi-temporal requests".format(len(dates), len(windows)))
+
+        contents = self.run_engine(lambda engine: engine.execute_all(download_requests))
+        for window, content in zip(windows, contents):
+            if isinstance(content, Exception):
+                continue
+            wanted = set(window)
+            with timed_phase("decode"):
+                scenes = split_orbit_response(content)
+            with timed_phase("write"):
+                for date, image in scenes:
+                    if date not in wanted:
+                        continue
+                    per_day = self.sentinel_cli_hub_request(
+                        self._bbox, (date, date), self.band_type).download_list[0]
+                    save_response(per_day, self.encode_response(per_day, image))
+
+    def frame_path(self, band_type, date):
+        """
+        :return: file downloaded for band type and date by any mode, None if there is none
+        """
+        if needs_tiling(self._size):
+            path = self.mosaic_path(date)
+        elif self.local_bands or self.band_types:
+            path = self.band_path(band_type, date)
+        else:
+            _, path = self.sentinel_cli_hub_request(
+                self._bbox, (date, date), band_type).download_list[0].get_storage_paths()
+        return path if os.path.exists(path) else None
+
+    def cube_path(self, band_type):
+        # frames of other bbox or resolution go into their own cube
+        return os.path.join(self.data_dir, settings.CUBE_DIR, band_type, self.raster_key())
+
+    def read_frame(self, path):
+        with timed_phase("decode"):
+            if path.endswith(".npy"):
+                return np.load(path, mmap_mode="r")
+            with open(path, "rb") as f:
+                return decode_image(f.read())
+
+    def encode_response(self, download_request, image):
+        """
+        :return: image bytes in format of download_request response file
+        """
+        _, response_path = download_request.get_storage_paths()
+        if response_path.endswith((".tif", ".tiff")):
+            return encode_tiff(image)
+        if image.ndim == 3 and image.shape[2] == 1:
+            image = image[:, :, 0]
+        return encode_png(image)
+
+    def cog_path(self, band_type, date):
+        return os.path.join(self.data_dir, settings.COG_DIR, band_type, f"{date}.tif")
+
+    def date_done(self, date):
+        """
+        Downloaded date is appended to cube (--cube) and folded into
+        composite (--composite) as soon as it arrives, frame is decoded once.
+        Dates already appended or folded are skipped.
+        """
+        to_cube = self.cube is not None and date not in self.cube_dates
+        to_composite = self.compositor is not None and date not in self.compositor.added
+        if not (to_cube or to_composite):
+            return
+        path = self.frame_path(self.band_type, date)
+        if path is None:
+            return
+        image = self.read_frame(path)
+        if to_cube:
+            with timed_phase("write"):
+                self.cube.write(date, image, bbox=self._bbox, band_type=self.band_type)
+            self.cube_dates.add(date)
+        if to_composite:
+            with timed_phase("composite"):
+                self.compositor.add(date, image)
+
+    def composite_path(self, dates):
+        return os.path.join(self.data_dir, settings.COMPOSITE_DIR, self.band_type,
+                            f"{dates[0]}_{dates[-1]}")
+
+    def write_composite(self):
+        """
+        Dates which were not downloaded in this run (journal, spatial index,
+        tiled mosaics) are folded from files (and appended to cube), then composite is written
+        data_dir/COMPOSITE_DIR/<band>/<start>_<end>/<reducer>.tif
+        """
+        for date in self.compositor.dates:
+            self.date_done(date)
+        if not self.compositor.added:
+            log.warning("COMPOSITE: no downloaded dates")
+            return
+        with timed_phase("write"):
+            written = self.compositor.save(self.composite_path(self.compositor.dates),
+                                           self._bbox, epsg=int(self._bbox.crs.epsg))
+        log.info("COMPOSITE: {0} of {1} dates, {2} files".format(
+            len(self.compositor.added), len(self.compositor.dates), len(written)))
+
+    def write_cogs(self, dates):
+        """
+        Convert downloaded dates into tiled GeoTIFF with overviews
+        data_dir/COG_DIR/<band>/<date>.tif, see cog.py
+        :param dates: list of dates str
+        """
+        scale_offset = None
+        if self.sample_type == "UINT16" and self.band_type:
+            # only index bands are scaled, dataMask is stored as it is
+            scale_offset = (1.0 / settings.UINT16_SCALE, -settings.UINT16_OFFSET)
+        for band_type in self.local_bands or self.band_types or [self.band_type]:
+            written = 0
+            # dates of one stored scene share inode (scene_store.py), GeoTIFF is linked
+            scene_cogs = {}
+            for date in dates:
+                path = self.frame_path(band_type, date)
+                if path is None:
+                    continue
+                cog_path = self.cog_path(band_type, date)
+                scene = os.stat(path).st_ino
+                if scene in scene_cogs:
+                    try:
+                        link_file(scene_cogs[scene], cog_path)
+                        continue
+                    except OSError:
+                        pass
+                image = self.read_frame(path)
+                with timed_phase("write"):
+                    write_cog(cog_path, image, list(self._bbox),
+                              epsg=int(self._bbox.crs.epsg), scale_offset=scale_offset,
+                              scaled_bands=index_bands(band_type) if scale_offset else None)
+                scene_cogs[scene] = cog_path
+                written += 1
+            log.info("GeoTIFF {0}: {1} dates written, {2} linked to the same scene".format(
+                band_type, written, len(dates) - written))
+
+    def write_cube(self, dates):
+        """
+        Dates which were not appended on arrival (date_done) are streamed one by one
+        into data_dir/CUBE_DIR/<band>/<raster_key>, see cube.py
+        :param dates: list of dates str
+        """
+        for band_type in self.local_bands or self.band_types or [self.band_type]:
+            cube = DataCube(self.cube_path(band_type))
+            written = 0
+            image, previous_scene = None, None
+            for date in dates:
+                if date in self.cube_dates:
+                    continue
+                path = self.frame_path(band_type, date)
+                if path is None:
+                    continue
+                # duplicate scene of previous date is not decoded again
+                scene = os.stat(path).st_ino
+                if scene != previous_scene:
+                    image, previous_scene = self.read_frame(path), scene
+                with timed_phase("write"):
+                    cube.write(date, image, bbox=self._bbox, band_type=band_type)
+                written += 1
+            log.info("Cube {0}: {1} dates written".format(cube.path, written))
+
+    def download_dates(self, dates, mode=None):
+        if self.local_bands:
+            return self.raw_requests(dates)
+        if self.band_types:
+            return self.multi_band_requests(dates)
+        if self.multi_temporal:
+            return self.multi_temporal_requests(dates)
+        if needs_tiling(self._size):
+            return self.tiled_requests(dates)
+        if settings.SPATIAL_INDEX:
+            dates = self.local_requests(dates)
+            if not dates:
+                return
+        mode = mode or settings.DOWNLOAD_MODE
+        log.info("DOWNLOAD MODE: {0}".format(mode))
+        if mode == "async":
+            self.async_requests(dates)
+        elif mode == "mp":
+            self.multi_proc_requests(dates)
+        elif mode == "sync":
+            self.get_satellite_data(dates)
+        elif mode == "shm":
+            self.shm_requests(dates)
+        else:
+            raise ValueError("Download mode incorrect use one of async, mp, sync, shm.")
+
+    def fetch(self, req):
+        """
+        Serve SentinelHubRequest from response cache, download and
+        store it in cache otherwise. Response is saved to data_dir in both cases.
+        :param req: SentinelHubRequest
+        """
+        for download_request in req.download_list:
+            job = REGISTRY.job(download_request.get_hashed_name(), engine="sentinelhub")
+            key = None
+            if self.cache and cacheable(download_request):
+                with job.phase("cache"):
+                    key = request_key(download_request)
+                    content = self.cache.get(key)
+                if content is not None:
+                    job.cache_hit = True
+                    with job.phase("write"):
+                        save_response(download_request, content)
+                    job.finish()
+                    self.request_result(download_request, content, None)
+                    continue
+            # sentinelhub writes into existing file, scene of other dates must stay intact
+            unshare(download_request.get_storage_paths()[1])
+            try:
+                # sentinelhub client does transfer, decode and write at once
+                with job.phase("download"):
+                    req.get_data(save_data=True)
+            except Exception as fetch_exc:
+                job.finish("failed")
+                self.request_result(download_request, None, fetch_exc)
+                raise
+            _, response_path = download_request.get_storage_paths()
+            job.bytes = os.path.getsize(response_path)
+            if key:
+                with job.phase("write"):
+                    with open(response_path, "rb") as f:
+                        self.cache.put(key, f.read())
+            job.finish()
+            self.request_result(download_request, None, None)
+        log.debug(f"Files Saved in {req.data_folder}")
 
     def sentinel_hub_request(self):
         """
@@ -117,12 +1009,14 @@ class GISImageDownloader(object):
                 SentinelHubRequest.input_data(
                     data_source=DataSource.SENTINEL2_L1C,
                     time_interval=(self.start_date, self.end_date),
+                    maxcc=self.maxcc,
                 )
             ],
             responses=[
                 SentinelHubRequest.output_response('default', MimeType.PNG)
             ],
             bbox=self._bbox,
+            geometry=self.request_geometry(self._bbox),
             size=self._size,
             config=self.config
         )
@@ -134,31 +1028,194 @@ class GISImageDownloader(object):
         t = (date, date)
         b = self.band_type
         res = self.sentinel_cli_hub_request(c, t, b)
-        res.get_data(save_data=True)
+        self.fetch(res)
 
-    def sentinel_cli_hub_request(self, coords, time_range, band_type):
+    def sentinel_cli_hub_request(self, coords, time_range, band_type, size=None):
         """
         In next title you can find acceptable layer(band-type)
         https://www.sentinel-hub.com/develop/api/ogc/standard-parameters/wms/
         :param cords: Coordinates in BBOX format
         :param time_range: str representation of time
         :param band_type: settings BAND_TYPES
+        :param size: (width, height) default is self._size
         :return:
         """
 
+        if self.sample_type:
+            evalscript = compose_sample_type_evalscript(
+                self.check_band_type(band_type), self.sample_type)
+        else:
+            evalscript = self.eval_scr_by_band(self.check_band_type(band_type))
         hr = SentinelHubRequest(
             data_folder=self.data_dir,
-            evalscript=self.eval_scr_by_band(self.check_band_type(band_type)),
+            evalscript=evalscript,
             input_data=[
                 SentinelHubRequest.input_data(
                     data_source=DataSource.SENTINEL2_L2A,
                     time_interval=time_range,
+                    maxcc=self.maxcc,
                 )
             ],
             responses=[
-                SentinelHubRequest.output_response('default', MimeType.PNG)
+                SentinelHubRequest.output_response('default', self.response_mime_type())
+            ],
+            bbox=coords,
+            geometry=self.request_geometry(coords),
+            size=size or self._size,
+            config=self.config
+        )
+
+        return hr
+
+    def response_mime_type(self):
+        """
+        PNG holds only 8 bit visualizations, GeoTIFF output and
+        UINT16/FLOAT32 sample types are requested as TIFF
+        """
+        if self.output_format == "cog" or self.sample_type in ("UINT16", "FLOAT32"):
+            return MimeType.TIFF
+        return MimeType.PNG
+
+    def wms_preview_request(self, time_range, band_type):
+        """
+        Thumbnails of every acquisition in time_range, layer of
+        WMS instance has to be named as band type.
+        :param time_range: (start_date, end_date) str
+        :param band_type: settings BAND_TYPES
+        :return:
+        """
+
+        wr = WmsRequest(
+            data_source=DataSource.SENTINEL2_L2A,
+            data_folder=os.path.join(self.data_dir, settings.PREVIEW_DIR),
+            layer=band_type,
+            bbox=self._bbox,
+            time=time_range,
+            width=settings.PREVIEW_WIDTH,
+            maxcc=self.maxcc,
+            image_format=MimeType.PNG,
+            time_difference=datetime.timedelta(hours=2),
+            config=self.wms_config
+        )
+
+        return wr
+
+    def cloud_probe_request(self, coords, time_range):
+        """
+        Low resolution CLM and dataMask, see settings.CLOUD_PROBE_EVALSCRIPT
+        :param coords: Coordinates in BBOX format
+        :param time_range: str representation of time
+        :return:
+        """
+
+        hr = SentinelHubRequest(
+            data_folder=self.data_dir,
+            evalscript=settings.CLOUD_PROBE_EVALSCRIPT,
+            input_data=[
+                SentinelHubRequest.input_data(
+                    data_source=DataSource.SENTINEL2_L2A,
+                    time_interval=time_range,
+                    maxcc=self.maxcc,
+                )
+            ],
+            responses=[
+                SentinelHubRequest.output_response('default', MimeType.TIFF)
             ],
             bbox=coords,
+            geometry=self.request_geometry(coords),
+            size=probe_size(self._size),
+            config=self.config
+        )
+
+        return hr
+
+    def raw_hub_request(self, coords, time_range):
+        """
+        B04, B08 and dataMask as FLOAT32 TIFF, see settings.RAW_BANDS_EVALSCRIPT
+        :param coords: Coordinates in BBOX format
+        :param time_range: str representation of time
+        :return:
+        """
+
+        hr = SentinelHubRequest(
+            data_folder=self.data_dir,
+            evalscript=settings.RAW_BANDS_EVALSCRIPT,
+            input_data=[
+                SentinelHubRequest.input_data(
+                    data_source=DataSource.SENTINEL2_L2A,
+                    time_interval=time_range,
+                    maxcc=self.maxcc,
+                )
+            ],
+            responses=[
+                SentinelHubRequest.output_response('default', MimeType.TIFF)
+            ],
+            bbox=coords,
+            geometry=self.request_geometry(coords),
+            size=self._size,
+            config=self.config
+        )
+
+        return hr
+
+    def multi_hub_request(self, coords, time_range, band_types):
+        """
+        One request with a PNG output for every band type,
+        response is TAR, see evalscripts.compose_evalscript
+        :param coords: Coordinates in BBOX format
+        :param time_range: str representation of time
+        :param band_types: list of settings BAND_TYPES
+        :return:
+        """
+
+        hr = SentinelHubRequest(
+            data_folder=self.data_dir,
+            evalscript=compose_evalscript(band_types),
+            input_data=[
+                SentinelHubRequest.input_data(
+                    data_source=DataSource.SENTINEL2_L2A,
+                    time_interval=time_range,
+                    maxcc=self.maxcc,
+                )
+            ],
+            responses=[
+                SentinelHubRequest.output_response(output_id(b), MimeType.PNG)
+                for b in band_types
+            ],
+            bbox=coords,
+            geometry=self.request_geometry(coords),
+            size=self._size,
+            config=self.config
+        )
+
+        return hr
+
+    def orbit_hub_request(self, coords, time_range, band_type):
+        """
+        All scenes of time_range in one request (mosaicking ORBIT),
+        see evalscripts.compose_orbit_evalscript
+        :param coords: Coordinates in BBOX format
+        :param time_range: str representation of time
+        :param band_type: settings BAND_TYPES
+        :return:
+        """
+
+        hr = SentinelHubRequest(
+            data_folder=self.data_dir,
+            evalscript=compose_orbit_evalscript(self.check_band_type(band_type)),
+            input_data=[
+                SentinelHubRequest.input_data(
+                    data_source=DataSource.SENTINEL2_L2A,
+                    time_interval=time_range,
+                    maxcc=self.maxcc,
+                )
+            ],
+            responses=[
+                SentinelHubRequest.output_response('default', MimeType.TIFF),
+                SentinelHubRequest.output_response('userdata', MimeType.JSON)
+            ],
+            bbox=coords,
+            geometry=self.request_geometry(coords),
             size=self._size,
             config=self.config
         )
@@ -167,23 +1224,112 @@ class GISImageDownloader(object):
 
     @timeit
     def main_cli(self, arguments):
-        c = self.prepare_coordinates(arguments.coordinates)
+        if arguments.geometry:
+            self.geometry = load_geometry(arguments.geometry)
+            c = list(self.geometry.bounds)
+        else:
+            # -c is a plain bbox, geometry of field does not apply to it
+            self.geometry = None
+            c = self.prepare_coordinates(arguments.coordinates)
         t = self.prepare_time(arguments.time_range)
-        b = self.check_band_type(arguments.band_type)
+        if arguments.raw:
+            self.local_bands = self.prepare_local_bands(arguments.band_type)
+            b = None
+        elif "," in arguments.band_type:
+            self.band_types = self.prepare_band_types(arguments.band_type)
+            b = None
+        else:
+            b = self.check_band_type(arguments.band_type)
         self._bbox = BBox(bbox=c, crs=CRS.WGS84)
-        self._size = bbox_to_dimensions(self._bbox, resolution=6)  # need add argument resolution
         self.band_type = b
+        self.multi_temporal = arguments.multi_temporal
+        self.output_format = arguments.format
+        self.sample_type = arguments.sample_type
+        if b:
+            check_sample_type(b, self.sample_type)
+        if self.multi_temporal and self.sample_type not in (None, "AUTO"):
+            # ORBIT evalscript keeps sampleType of band script, scenes are 8-bit
+            raise ValueError("--multi-temporal supports only AUTO sample type.")
+        self._size = self.plan_size(arguments.resolution, arguments.max_pixels,
+                                    arguments.max_bytes, arguments.max_pu)
+        if arguments.plan:
+            self.plan_cli(arguments, t)
+            return
+        try:
+            self.download_cli(arguments, t)
+        finally:
+            self.close_engine()
+
+    def download_cli(self, arguments, t):
+        """
+        Dates selection, downloads and outputs of main_cli, catalog search, cloud
+        probe and async downloads share one engine, main_cli closes it.
+        """
+        if arguments.cube and self.band_type and arguments.mode != "shm":
+            self.cube = DataCube(self.cube_path(self.band_type))
+        all_dates = arguments.all_dates or not settings.CATALOG_PLANNING
         if t and len(t) > 1:
             dates = self.dates_range(t)
+            if arguments.preview:
+                # WMS already lists only dates with acquisition under maxcc
+                selected = arguments.select.split(",") if arguments.select else None
+                dates = self.preview_dates(dates, selected)
+                if arguments.preview_only:
+                    return
+            elif not all_dates:
+                dates = self.plan_dates(dates)
+                if settings.CLOUD_PROBE:
+                    dates = self.probe_dates(dates)
+            if arguments.composite:
+                if self.band_type and index_bands(self.band_type):
+                    # dates skipped by journal are folded from files in write_composite
+                    self.compositor = Compositor(dates, arguments.composite.split(","))
+                else:
+                    log.warning("--composite needs single index band type (e.g. NDVIINDEX), "
+                                "composite is skipped")
+            dates = self.journal_dates(dates, arguments.resume)
             log.info("DATES: {0}".format(dates))
-            self.multi_proc_requests(dates)
+            self.download_dates(dates, arguments.mode)
         elif t and len(t) == 1:
-            t = tuple([t[0], t[0]])
-            req = self.sentinel_cli_hub_request(self._bbox, t, b)
-            req.get_data(save_data=True)
-            log.debug(f"Files Saved in {req.data_folder}")
+            dates = self.journal_dates([t[0]], arguments.resume)
+            if dates:
+                self.download_dates(dates, arguments.mode)
         else:
             log.error("Dates set is empty or incorrect!")
+            dates = []
+        if self.output_format == "cog" and dates:
+            self.write_cogs(dates)
+        if self.compositor is not None:
+            self.write_composite()
+        if (arguments.cube or arguments.mode == "shm") and dates:
+            self.write_cube(dates)
+        if self.cache:
+            log.info("CACHE: {0}".format(self.cache.report()))
+
+    def plan_cli(self, arguments, t):
+        """
+        --plan, jobs of main_cli are estimated without network calls, see estimator.py
+        """
+        dates = self.dates_range(t) if t else []
+        probe = False
+        all_dates = arguments.all_dates or not settings.CATALOG_PLANNING
+        if len(t) > 1 and not all_dates and not arguments.preview:
+            planned = self.catalog.cached_dates(self._bbox, dates)
+            if planned is None:
+                log.info("PLAN: catalog of time range is not cached, every day is counted")
+            else:
+                dates = planned
+            # probe can only drop dates, so estimate is an upper bound
+            probe = settings.CLOUD_PROBE
+        if arguments.resume:
+            dates = self.journal_dates(dates, resume=True, record=False)
+        jobs = estimator.expand_jobs(self, dates, probe)
+        throughput = estimator.load_throughput(
+            arguments.metrics_jsonl or settings.METRICS_JSONL_PATH)
+        estimator.log_estimate(estimator.estimate(jobs, throughput))
+        if arguments.plan_output:
+            estimator.write_jobs(arguments.plan_output, jobs)
+            log.info("PLAN: jobs written to {0}".format(arguments.plan_output))
 
     @timeit
     def main_cli_sync(self, arguments):
@@ -192,36 +1338,191 @@ class GISImageDownloader(object):
         b = self.check_band_type(arguments.band_type)
         if len(t) > 1:
             self._bbox = BBox(bbox=c, crs=CRS.WGS84)
-            self._size = bbox_to_dimensions(self._bbox,
-                                            resolution=6)  # need add argument resolution
             self.band_type = b
+            self._size = self.plan_size(arguments.resolution, arguments.max_pixels,
+                                        arguments.max_bytes, arguments.max_pu)
             dates = self.dates_range(t)
             log.info("DATES: {0}".format(dates))
             self.get_satellite_data(dates)
         else:
             req = self.sentinel_cli_hub_request(c, t, b)
-            req.get_data(save_data=True)
-            log.debug(f"Files Saved in {req.data_folder}")
+            self.fetch(req)
 
     def main(self):
         req = self.sentinel_hub_request()
-        req.get_data(save_data=True)
-        log.debug(f"Files Saved in {req.data_folder}")
+        self.fetch(req)
+
+
+_WORKER = None
+
+
+def init_shm_worker(state):
+    """
+    Initializer of shm mode pool, downloader, its event loop and HTTP session
+    are built once per worker and reused by every shm_job.
+    :param state: GISImageDownloader.worker_state()
+    """
+    global _WORKER
+    for name, value in state["settings"].items():
+        setattr(settings, name, value)
+    downloader = GISImageDownloader(state["field_name"])
+    downloader._bbox, downloader._size = state["bbox"], state["size"]
+    downloader.band_type = state["band_type"]
+    downloader.geometry = state["geometry"]
+    downloader.sample_type = state["sample_type"]
+    downloader.output_format = state["output_format"]
+    loop = asyncio.new_event_loop()
+    engine = AsyncDownloadEngine(downloader.config, max_concurrency=1, cache=downloader.cache,
+                                 callback=downloader.request_result)
+    loop.run_until_complete(engine.__aenter__())
+    _WORKER = (downloader, loop, engine)
+
+
+def shm_job(date):
+    """
+    :return: (date, SharedArray of decoded response or None, error str or None,
+    metrics records of worker)
+    """
+    downloader, loop, engine = _WORKER
+    with REGISTRY.capture() as records:
+        try:
+            download_request = downloader.sentinel_cli_hub_request(
+                downloader._bbox, (date, date), downloader.band_type).download_list[0]
+            content = loop.run_until_complete(engine.execute(download_request))
+            with timed_phase("decode"):
+                image = decode_image(content)
+            return date, share_array(image), None, records
+        except Exception as job_exc:
+            log.error("Error is raised for {0}: {1}".format(date, job_exc))
+            return date, None, str(job_exc), records
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--coordinates",  help="for coordinates "
+                                                    "Example 46.16,-16.15;46.51,-15.58",
+                        action="store")
+    parser.add_argument("-g", "--geometry", help="field polygon as WKT, GeoJSON or path "
+                                                 "of file with one of them, used instead of -c",
+                        action="store")
+    parser.add_argument("-t", "--time-range", help="time from,to "
+                                                    "Example 2020-02-01,2020-03-01",
+                        action="store")
+    parser.add_argument("-b", "--band-type", help="band type or comma separated "
+                                                  "band types Example NDVIGV,TRUE-COLORHC",
+                        action="store")
+    parser.add_argument("-m", "--mode", help="download engine "
+                                             "async, mp, sync or shm (process pool, "
+                                             "rasters go into cube through shared memory)",
+                        choices=("async", "mp", "sync", "shm"),
+                        default=settings.DOWNLOAD_MODE,
+                        action="store")
+    parser.add_argument("--all-dates", help="request every day of time range "
+                                            "without catalog search",
+                        action="store_true")
+    parser.add_argument("--no-cache", help="do not use response cache",
+                        action="store_true")
+    parser.add_argument("--raw", help="download B04/B08 once and render "
+                                      "band types locally, -b can be "
+                                      "comma separated list",
+                        action="store_true")
+    parser.add_argument("--multi-temporal", help="request windows of dates "
+                                                 "in one ORBIT mosaicking request, "
+                                                 "only AUTO --sample-type",
+                        action="store_true")
+    parser.add_argument("--resolution", help="m/px, by default field resolution "
+                                              "not finer than native 10 m",
+                        type=float, action="store")
+    parser.add_argument("--max-pixels", help="budget of output width * height, "
+                                             "resolution is made coarser to fit",
+                        type=int, action="store")
+    parser.add_argument("--max-bytes", help="budget of uncompressed output bytes",
+                        type=int, action="store")
+    parser.add_argument("--max-pu", help="budget of processing units per request",
+                        type=float, action="store")
+    parser.add_argument("--format", help="png (server side PNG as is) or cog (tiled "
+                                          "GeoTIFF with overviews <dir>/cog/<band>/<date>.tif)",
+                        choices=("png", "cog"), default=settings.OUTPUT_FORMAT,
+                        action="store")
+    parser.add_argument("--compression", help="GeoTIFF compression, lzw and zstd "
+                                               "need imagecodecs",
+                        choices=("deflate", "lzw", "zstd"), action="store")
+    parser.add_argument("--no-predictor", help="GeoTIFF without predictor",
+                        action="store_true")
+    parser.add_argument("--sample-type", help="output sampleType of band script, "
+                                              "UINT16 of index band types is "
+                                              "(value + 1) * 10000",
+                        choices=("AUTO", "UINT8", "UINT16", "FLOAT32"),
+                        default=settings.OUTPUT_SAMPLE_TYPE, action="store")
+    parser.add_argument("--preview", help="fetch WMS thumbnails and contact sheet of "
+                                           "time range first, then download dates with "
+                                           "data (or --select) in full resolution",
+                        action="store_true")
+    parser.add_argument("--preview-only", help="stop after thumbnails",
+                        action="store_true")
+    parser.add_argument("--select", help="comma separated dates refined after --preview",
+                        action="store")
+    parser.add_argument("--composite", help="fold downloaded dates of time range into "
+                                            "temporal composite <dir>/composite/<band>, "
+                                            "reducers max,mean,median,latest, see composite.py",
+                        nargs="?", const=",".join(settings.COMPOSITE_REDUCERS), action="store")
+    parser.add_argument("--cube", help="also store downloaded dates in chunked time "
+                                        "series cube <dir>/cube/<band>/<size>_<bbox>, "
+                                        "see cube.py",
+                        action="store_true")
+    parser.add_argument("--no-local", help="do not crop requested dates from "
+                                           "overlapping downloaded rasters",
+                        action="store_true")
+    parser.add_argument("--no-dedup", help="store every date as its own file, by default "
+                                           "identical scenes are stored once",
+                        action="store_true")
+    parser.add_argument("--no-cloud-probe", help="download dates without checking "
+                                                 "clouds over field first",
+                        action="store_true")
+    parser.add_argument("--resume", help="request only dates which are not "
+                                          "completed in journal or whose files "
+                                          "are missing or corrupted",
+                        action="store_true")
+    parser.add_argument("--plan", "--dry-run", help="print jobs, PU, bytes and wall time "
+                                                    "estimate without downloading",
+                        action="store_true")
+    parser.add_argument("--plan-output", help="with --plan write every job to this "
+                                              "JSON lines file",
+                        action="store")
+    parser.add_argument("--metrics-jsonl", help="append per job metrics to this file",
+                        action="store")
+    parser.add_argument("--metrics-prom", help="write Prometheus metrics to this file",
+                        action="store")
+    parser.add_argument("--metrics-port", help="serve Prometheus metrics on "
+                                               "http://127.0.0.1:<port>/metrics",
+                        type=int, action="store")
+    return parser
+
+
+def configure(args):
+    """
+    Apply global CLI options to settings and metrics registry.
+    """
+    if args.no_cache:
+        settings.RESPONSE_CACHE = False
+    if args.no_local:
+        settings.SPATIAL_INDEX = False
+    if args.no_cloud_probe:
+        settings.CLOUD_PROBE = False
+    if args.no_dedup:
+        settings.SCENE_DEDUP = False
+    if args.compression:
+        settings.COG_COMPRESSION = args.compression
+    if args.no_predictor:
+        settings.COG_PREDICTOR = False
+    REGISTRY.configure(args.metrics_jsonl, args.metrics_prom, args.metrics_port)
 
 
 if __name__ == '__main__':
     init_logger(log)
     if settings.CLI:
-        parser = argparse.ArgumentParser()
-        parser.add_argument("-c", "--coordinates",  help="for coordinates "
-                                                        "Example 46.16,-16.15;46.51,-15.58",
-                            action="store")
-        parser.add_argument("-t", "--time-range", help="time from,to "
-                                                        "Example 2020-02-01,2020-03-01",
-                            action="store")
-        parser.add_argument("-b", "--band-type", help="",
-                            action="store")
-        args = parser.parse_args()
+        args = build_parser().parse_args()
+        configure(args)
         inst = GISImageDownloader("test")
         inst.main_cli(args)# main_cli 23043.75 ms
         # inst.main_cli_sync(args) # main_cli_sync 299120.74 ms
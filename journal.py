@@ -0,0 +1,151 @@
+"""
+Append-only run journal in SQLite next to field data_dir.
+Every planned and completed (field, date, band) job is an event with output
+path and sha256 checksum, --resume dispatches only outstanding or corrupted jobs.
+Job id is the sentinelhub request hash, the same one as name of response folder.
+
+python journal.py /tmp/test_dir  # where every date and band is stored
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    job_id TEXT NOT NULL,
+    field TEXT,
+    date TEXT,
+    band TEXT,
+    status TEXT NOT NULL,
+    output_path TEXT,
+    checksum TEXT,
+    size INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS events_job_id ON events (job_id, id);
+"""
+
+# last event of every job
+LATEST = """
+SELECT e.job_id, e.field, e.date, e.band, e.status, e.output_path, e.checksum, e.size
+FROM events e
+JOIN (SELECT job_id, MAX(id) AS id FROM events GROUP BY job_id) last ON last.id = e.id
+"""
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Journal(object):
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # connection is not shared with pool workers, every process opens its own
+        return {"path": self.path, "_conn": None, "_pid": None}
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            dir_name = os.path.dirname(self.path)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _append(self, rows):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO events (ts, job_id, field, date, band, status, output_path, "
+                "checksum, size, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def plan(self, jobs):
+        """
+        :param jobs: list of (job_id, field, date, band)
+        """
+        now = time.time()
+        self._append([
+            (now, job_id, field, date, band, "planned", None, None, None, None)
+            for job_id, field, date, band in jobs
+        ])
+
+    def complete(self, job_id, output_path, content=None):
+        """
+        :param job_id: request hash
+        :param output_path: saved response
+        :param content: response bytes, checksum of output_path is computed if not given
+        """
+        if content is not None:
+            checksum, size = hashlib.sha256(content).hexdigest(), len(content)
+        else:
+            checksum, size = file_checksum(output_path), os.path.getsize(output_path)
+        self._append([(time.time(), job_id, None, None, None, "done",
+                       output_path, checksum, size, None)])
+
+    def fail(self, job_id, error):
+        self._append([(time.time(), job_id, None, None, None, "failed",
+                       None, None, None, str(error)[:1000])])
+
+    def latest(self):
+        """
+        :return: dict job_id -> row of LATEST, field/date/band of planned event
+        """
+        jobs = {}
+        planned = {}
+        for row in self.conn.execute(
+                "SELECT job_id, field, date, band FROM events WHERE status = 'planned'"):
+            planned[row[0]] = row[1:]
+        for row in self.conn.execute(LATEST):
+            job_id = row[0]
+            field, date, band = planned.get(job_id, row[1:4])
+            jobs[job_id] = {
+                "field": field, "date": date, "band": band, "status": row[4],
+                "output_path": row[5], "checksum": row[6], "size": row[7],
+            }
+        return jobs
+
+    def outstanding(self, job_ids, verify=None):
+        """
+        :param job_ids: job ids of this run
+        :param verify: compare sha256 of output file, default settings.JOURNAL_VERIFY_CHECKSUM
+        :return: set of job ids which are not done or whose output is missing or corrupted
+        """
+        verify = settings.JOURNAL_VERIFY_CHECKSUM if verify is None else verify
+        latest = self.latest()
+        result = set()
+        for job_id in job_ids:
+            job = latest.get(job_id)
+            if not job or job["status"] != "done" or not job["output_path"]:
+                result.add(job_id)
+                continue
+            path = job["output_path"]
+            if not os.path.exists(path) or os.path.getsize(path) != job["size"]:
+                result.add(job_id)
+            elif verify and file_checksum(path) != job["checksum"]:
+                result.add(job_id)
+        return result
+
+
+if __name__ == '__main__':
+    journal = Journal(os.path.join(sys.argv[1], settings.JOURNAL_FILE))
+    for job_id, job in sorted(journal.latest().items(), key=lambda i: (i[1]["date"] or "")):
+        print("{field}\t{date}\t{band}\t{status}\t{output_path}".format(**job))
@@ -0,0 +1,255 @@
+"""
+Per job instrumentation of downloads.
+Every job records duration of its phases (cache, queue, oauth, ttfb, transfer,
+decode, write), bytes, retries and estimated processing units.
+Jobs are aggregated into histograms, exported as JSON lines (one line per job)
+and Prometheus text format (file or local http endpoint /metrics).
+Process pool workers capture their records and return them with job result,
+parent merges them into its REGISTRY (capture/merge).
+"""
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import settings
+
+log = logging.getLogger(__name__)
+
+# "download" is transfer, decode and write of sentinelhub client (mp and sync modes)
+PHASES = ("cache", "queue", "oauth", "ttfb", "transfer", "download", "decode", "render", "write")
+# seconds, upper bounds of histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class JobMetrics(object):
+    def __init__(self, registry, name, **labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.started = time.time()
+        self.phases = collections.OrderedDict()
+        self.bytes = 0
+        self.retries = 0
+        self.processing_units = 0.0
+        self.status = "ok"
+        self.cache_hit = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started)
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self, status=None):
+        if status:
+            self.status = status
+        self.registry.record(self)
+
+    def to_dict(self):
+        return {
+            "job": self.name,
+            "labels": self.labels,
+            "started": self.started,
+            "duration": time.time() - self.started,
+            "status": self.status,
+            "cache_hit": self.cache_hit,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "processing_units": round(self.processing_units, 4),
+            "phases": {k: round(v, 6) for k, v in self.phases.items()},
+        }
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.histograms = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.jsonl_path = None
+        self.prometheus_path = None
+        self._lock = threading.Lock()
+        self._server = None
+        # list of records while capture() is active (pool worker)
+        self._captured = None
+
+    def configure(self, jsonl_path=None, prometheus_path=None, port=None):
+        self.jsonl_path = jsonl_path or settings.METRICS_JSONL_PATH
+        self.prometheus_path = prometheus_path or settings.METRICS_PROMETHEUS_PATH
+        port = port or settings.METRICS_PORT
+        if port:
+            self.serve(port)
+
+    def job(self, name, **labels):
+        return JobMetrics(self, name, **labels)
+
+    @contextlib.contextmanager
+    def capture(self):
+        """
+        Jobs and observations are collected instead of recorded, pool worker
+        returns yielded list to parent which calls merge.
+        """
+        self._captured = records = []
+        try:
+            yield records
+        finally:
+            self._captured = None
+
+    def merge(self, records):
+        """
+        Record what capture() collected in other process.
+        """
+        for kind, record in records:
+            if kind == "job":
+                self.record_dict(record)
+            else:
+                metric, value, labels = record
+                self.observe(metric, value, **labels)
+
+    def observe(self, metric, value, **labels):
+        if self._captured is not None:
+            self._captured.append(("observe", (metric, value, labels)))
+            return
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record(self, job):
+        if self._captured is not None:
+            self._captured.append(("job", job.to_dict()))
+            return
+        self.record_dict(job.to_dict())
+
+    def record_dict(self, job):
+        """
+        :param job: JobMetrics.to_dict()
+        """
+        for phase, seconds in job["phases"].items():
+            self.observe("fields_job_phase_seconds", seconds, phase=phase)
+        self.observe("fields_job_seconds", job["duration"])
+        self.inc("fields_jobs_total", status=job["status"],
+                 cache_hit=str(job["cache_hit"]).lower())
+        self.inc("fields_job_bytes_total", job["bytes"])
+        self.inc("fields_job_retries_total", job["retries"])
+        self.inc("fields_job_processing_units_total", job["processing_units"])
+        if self.jsonl_path:
+            line = json.dumps(job) + "\n"
+            with self._lock:
+                with open(self.jsonl_path, "a") as f:
+                    f.write(line)
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            typed = set()
+            for (metric, labels), hist in self.histograms.items():
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} histogram")
+                    typed.add(metric)
+                for bound, total in hist.cumulative():
+                    lines.append("{0}_bucket{1} {2}".format(
+                        metric, format_labels(labels + (("le", str(bound)),)), total))
+                lines.append("{0}_bucket{1} {2}".format(
+                    metric, format_labels(labels + (("le", "+Inf"),)), hist.count))
+                lines.append(f"{metric}_sum{format_labels(labels)} {hist.sum}")
+                lines.append(f"{metric}_count{format_labels(labels)} {hist.count}")
+            for (metric, labels), value in self.counters.items():
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} counter")
+                    typed.add(metric)
+                lines.append(f"{metric}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        if self.prometheus_path:
+            dir_name = os.path.dirname(self.prometheus_path)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name, exist_ok=True)
+            tmp_path = self.prometheus_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, self.prometheus_path)
+            log.info("Metrics Saved in {0}".format(self.prometheus_path))
+
+    def serve(self, port, host="127.0.0.1"):
+        # only --metrics-port needs http server, CLI startup does not import it
+        import http.server
+
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        log.info("Metrics on http://{0}:{1}/metrics".format(host, port))
+
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    """
+    Phase done outside of one job (decode or render of a batch),
+    goes only to fields_job_phase_seconds histogram.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe("fields_job_phase_seconds", time.perf_counter() - started, phase=phase)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, v) for k, v in labels) + "}"
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,58 @@
+"""
+Quick look of a time range through WMS (settings.SENTINEL_HUB_INSTANCE_ID),
+small thumbnails of every date are fetched in parallel and put on one
+contact sheet before full resolution downloads start.
+"""
+import numpy as np
+from PIL import Image, ImageDraw
+
+import settings
+
+LABEL_HEIGHT = 14  # px under every thumbnail
+
+
+def to_rgba(image):
+    """
+    :param image: thumbnail array (height, width[, 1-4 bands]) uint8
+    :return: PIL RGBA image
+    """
+    if image.dtype != np.uint8:
+        image = (np.clip(image, 0.0, 1.0) * 255).astype(np.uint8)
+    if image.ndim == 3 and image.shape[2] == 2:
+        # gray and alpha
+        image = np.dstack([image[:, :, 0]] * 3 + [image[:, :, 1]])
+    elif image.ndim == 3 and image.shape[2] == 1:
+        image = image[:, :, 0]
+    return Image.fromarray(image).convert("RGBA")
+
+
+def valid_fraction(image):
+    """
+    :return: part of thumbnail pixels with data, alpha or any band above zero
+    """
+    if image.ndim == 2:
+        return np.count_nonzero(image) / image.size
+    if image.shape[2] in (2, 4):
+        return np.count_nonzero(image[:, :, -1]) / image[:, :, -1].size
+    return np.count_nonzero(image.any(axis=2)) / (image.shape[0] * image.shape[1])
+
+
+def contact_sheet(thumbnails, columns=None):
+    """
+    :param thumbnails: list of (date str, thumbnail array)
+    :param columns: thumbnails per row, default settings.PREVIEW_COLUMNS
+    :return: PIL RGBA image, every thumbnail is labeled with its date
+    """
+    columns = columns or settings.PREVIEW_COLUMNS
+    images = [(date, to_rgba(image)) for date, image in thumbnails]
+    cell_width = max(image.width for _, image in images)
+    cell_height = max(image.height for _, image in images) + LABEL_HEIGHT
+    rows = (len(images) + columns - 1) // columns
+    sheet = Image.new("RGBA", (cell_width * min(columns, len(images)), cell_height * rows),
+                      (255, 255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    for i, (date, image) in enumerate(images):
+        x, y = (i % columns) * cell_width, (i // columns) * cell_height
+        sheet.paste(image, (x, y), image)
+        draw.text((x + 2, y + image.height + 1), date, fill=(0, 0, 0, 255))
+    return sheet
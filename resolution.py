@@ -0,0 +1,126 @@
+"""
+Output resolution from budgets instead of a fixed resolution.
+Resolution starts from --resolution (or field "resolution" not finer than
+settings.NATIVE_RESOLUTION, so small parcels are not oversampled) and is made
+coarser until raster fits pixel, byte and processing unit budgets.
+https://docs.sentinel-hub.com/api/latest/api/overview/processing-unit/
+"""
+import collections
+import math
+import re
+
+from sentinelhub import bbox_to_dimensions
+
+import settings
+from scheduler import request_units
+
+# number of input bands, number of output bands and sampleType of evalscript
+ScriptProfile = collections.namedtuple("ScriptProfile",
+                                       ["input_bands", "output_bands", "sample_type"])
+Plan = collections.namedtuple("Plan", ["resolution", "size", "pixels", "bytes", "pu"])
+
+SAMPLE_BYTES = {
+    "AUTO": 1,
+    "UINT8": 1,
+    "UINT16": 2,
+    "FLOAT32": 4,
+}
+# scripts without parsable setup(), RGB PNG
+DEFAULT_PROFILE = ScriptProfile(3, 3, "AUTO")
+
+
+def script_profile(evalscript):
+    """
+    :param evalscript: V3 evalscript
+    :return: ScriptProfile, band names of input are counted without dataMask
+    """
+    if not evalscript:
+        return DEFAULT_PROFILE
+    input_bands = set()
+    for names in re.findall(r"bands\s*:\s*\[([^\]]*)\]", evalscript):
+        input_bands.update(name for name in re.findall(r"[\"'](\w+)[\"']", names)
+                           if name != "dataMask")
+    output_bands = [int(n) for n in re.findall(r"bands\s*:\s*(\d+)", evalscript)]
+    sample_types = re.findall(r"sampleType\s*:\s*(?:SampleType\.|[\"'])(\w+)", evalscript)
+    return ScriptProfile(
+        len(input_bands) or DEFAULT_PROFILE.input_bands,
+        sum(output_bands) or DEFAULT_PROFILE.output_bands,
+        max(sample_types, key=SAMPLE_BYTES.get) if sample_types else "AUTO",
+    )
+
+
+def merge_profiles(profiles):
+    """
+    Profile of one request with outputs of several evalscripts.
+    """
+    return ScriptProfile(
+        max(p.input_bands for p in profiles),
+        sum(p.output_bands for p in profiles),
+        max((p.sample_type for p in profiles), key=SAMPLE_BYTES.get),
+    )
+
+
+def raster_bytes(size, profile):
+    """
+    :return: uncompressed size of output
+    """
+    width, height = size
+    return width * height * profile.output_bands * SAMPLE_BYTES.get(profile.sample_type, 1)
+
+
+def processing_units(size, profile, max_dimension=None):
+    """
+    PU of one request in the same way scheduler charges it (scheduler.request_units),
+    bbox larger than max_dimension is split into tiles so only a single tile is counted.
+    """
+    max_dimension = max_dimension or settings.MAX_REQUEST_DIMENSION
+    width, height = size
+    return request_units(min(width, max_dimension), min(height, max_dimension),
+                         profile.input_bands, profile.sample_type == "FLOAT32")
+
+
+def plan_resolution(bbox, profile=DEFAULT_PROFILE, resolution=None, field_resolution=None,
+                    max_pixels=None, max_bytes=None, max_pu=None, max_dimension=None):
+    """
+    :param bbox: sentinelhub BBox
+    :param profile: ScriptProfile of request evalscript
+    :param resolution: m/px asked explicitly, it is kept when budgets allow even below
+    settings.NATIVE_RESOLUTION
+    :param field_resolution: m/px of field settings
+    :param max_pixels: budget of width * height, default settings.MAX_PIXELS
+    :param max_bytes: budget of uncompressed output, default settings.MAX_BYTES
+    :param max_pu: budget of processing units per request, default settings.MAX_PU
+    :param max_dimension: max width/height in px, for modes which can not split bbox into tiles
+    :return: Plan
+    """
+    max_pixels = max_pixels or settings.MAX_PIXELS
+    max_bytes = max_bytes or settings.MAX_BYTES
+    max_pu = max_pu or settings.MAX_PU
+    if resolution is None:
+        resolution = max(field_resolution or settings.NATIVE_RESOLUTION,
+                         settings.NATIVE_RESOLUTION)
+
+    for _ in range(20):
+        if resolution > settings.MAX_RESOLUTION:
+            raise ValueError("Budgets need resolution coarser than MAX_RESOLUTION "
+                             "{0} m, use larger budgets.".format(settings.MAX_RESOLUTION))
+        size = tuple(max(1, n) for n in bbox_to_dimensions(bbox, resolution=resolution))
+        plan = Plan(resolution, size, size[0] * size[1], raster_bytes(size, profile),
+                    processing_units(size, profile))
+        # all budgets scale with number of pixels, resolution with square root of it
+        ratios = [1.0]
+        if max_pixels:
+            ratios.append(plan.pixels / max_pixels)
+        if max_bytes:
+            ratios.append(plan.bytes / max_bytes)
+        # minimal PU of a request is not lowered by coarser resolution
+        if max_pu and plan.pu > processing_units((1, 1), profile):
+            ratios.append(plan.pu / max_pu)
+        if max_dimension:
+            ratios.append((max(size) / max_dimension) ** 2)
+        ratio = max(ratios)
+        if ratio <= 1.0:
+            return plan
+        # round up to cm, rounding of bbox_to_dimensions may need one more step
+        resolution = math.ceil(resolution * math.sqrt(ratio) * 100 + 1) / 100
+    raise ValueError("Resolution of bbox {0} does not fit budgets.".format(list(bbox)))
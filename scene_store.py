@@ -0,0 +1,171 @@
+"""
+Deduplicated storage of downloaded scenes.
+With time_interval (date, date) and default mosaicking adjacent days often
+return the same acquisition, every unique scene is kept once in
+data_dir/SCENE_DIR/<2 chars>/<sha256>.<ext> and per date response files are
+hard links to it, so readers of response paths do not change.
+Scene is identified by hash of decoded pixels (settings.SCENE_HASH "pixels"),
+Processing API responses do not carry acquisition ID.
+
+python scene_store.py /tmp/test_dir  # rebuild of already downloaded responses
+"""
+import argparse
+import hashlib
+import logging
+import os
+
+import settings
+from utils import decode_image, init_logger, init_mp_pool, lazy_import
+
+np = lazy_import("numpy")
+
+log = logging.getLogger(__name__)
+
+# single image responses, TAR and other outputs are hashed as bytes
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff")
+
+
+def scene_hash(path, content=None, mode=None):
+    """
+    :param path: response file, read if content is None
+    :param content: response bytes
+    :param mode: pixels or bytes, default settings.SCENE_HASH
+    :return: sha256 hex digest
+    """
+    mode = mode or settings.SCENE_HASH
+    if content is None:
+        with open(path, "rb") as f:
+            content = f.read()
+    if mode == "pixels" and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS:
+        try:
+            image = np.ascontiguousarray(decode_image(content))
+        except Exception:
+            image = None
+        if image is not None:
+            digest = hashlib.sha256("{0}{1}".format(image.dtype.str, image.shape).encode())
+            digest.update(image.tobytes())
+            return digest.hexdigest()
+    return hashlib.sha256(content).hexdigest()
+
+
+def _hash_job(path):
+    try:
+        return path, scene_hash(path)
+    except OSError as hash_exc:
+        log.error("Scene {0} is not readable: {1}".format(path, hash_exc))
+        return path, None
+
+
+class SceneStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def scene_path(self, digest, ext):
+        return os.path.join(self.root, digest[:2], digest + ext)
+
+    def add(self, path, content=None, digest=None):
+        """
+        Store scene of saved response once, path becomes a hard link to stored copy.
+        :param path: saved response file
+        :param content: its bytes, read if None
+        :param digest: scene_hash of it if already known
+        :return: (digest, True if scene was already stored)
+        """
+        digest = digest or scene_hash(path, content)
+        scene = self.scene_path(digest, os.path.splitext(path)[1])
+        try:
+            if not os.path.exists(scene):
+                os.makedirs(os.path.dirname(scene), exist_ok=True)
+                # first copy of scene is stored without copying
+                os.link(path, scene)
+                return digest, False
+            if os.path.samefile(path, scene):
+                return digest, True
+            link_file(scene, path)
+        except OSError as link_exc:
+            # file system without hard links, response stays as is
+            log.debug("Scene {0} is not deduplicated: {1}".format(path, link_exc))
+            return digest, False
+        return digest, True
+
+    def rebuild(self, paths):
+        """
+        Hash already saved responses in process pool and link duplicates.
+        :param paths: list of response files
+        :return: dict of scenes, duplicates and saved bytes
+        """
+        stats = {"files": len(paths), "scenes": 0, "duplicates": 0, "saved_bytes": 0}
+        seen = set()
+        processes = settings.SCENE_REBUILD_WORKERS or os.cpu_count()
+        with init_mp_pool(processes=processes) as pool:
+            for path, digest in pool.imap_unordered(_hash_job, paths, chunksize=8):
+                if digest is None:
+                    continue
+                size = os.path.getsize(path)
+                # linked by previous run or live download
+                linked = os.stat(path).st_nlink > 1
+                self.add(path, digest=digest)
+                if digest in seen:
+                    stats["duplicates"] += 1
+                    if not linked:
+                        stats["saved_bytes"] += size
+                else:
+                    seen.add(digest)
+                    stats["scenes"] += 1
+        return stats
+
+    def scenes(self):
+        """
+        :return: dict of stored scene path -> number of response files linked to it
+        """
+        result = {}
+        for dir_path, _, file_names in os.walk(self.root):
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                result[path] = os.stat(path).st_nlink - 1
+        return result
+
+
+def link_file(source, path):
+    """
+    Replace path by hard link to source atomically, readers never miss the file.
+    """
+    tmp_path = path + ".link"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    os.link(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def unshare(path):
+    """
+    Remove path if it is linked to a stored scene, so writers which open
+    it in place (sentinelhub save_data) do not overwrite the scene of other dates.
+    """
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        os.remove(path)
+
+
+def response_files(data_dir):
+    """
+    :return: response.* files saved by sentinelhub and async engine in data_dir
+    """
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(data_dir):
+        if os.path.abspath(dir_path) == os.path.abspath(os.path.join(data_dir,
+                                                                      settings.SCENE_DIR)):
+            dir_names[:] = []
+            continue
+        paths.extend(os.path.join(dir_path, name) for name in file_names
+                     if name.startswith("response."))
+    return sorted(paths)
+
+
+if __name__ == '__main__':
+    init_logger(log)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", help="field dir with downloaded responses")
+    args = parser.parse_args()
+    store = SceneStore(os.path.join(args.data_dir, settings.SCENE_DIR))
+    result = store.rebuild(response_files(args.data_dir))
+    log.info("SCENES: {0}".format(result))
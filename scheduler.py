@@ -0,0 +1,164 @@
+"""
+Rate limit and processing unit aware scheduling of Processing API requests.
+Request rate and processing units (PU) budgets of account are token buckets,
+429 Retry-After pauses every job of the engine, failed job is retried with
+jittered exponential backoff.
+Docks https://docs.sentinel-hub.com/api/latest/api/overview/processing-unit/
+"""
+import asyncio
+import logging
+import random
+import re
+import time
+
+import settings
+
+log = logging.getLogger(__name__)
+
+# dataMask and other service bands are free
+INPUT_BANDS_RE = re.compile(r'"(B\d[\dA]|CLM|CLP|SCL|SNW|CLD|AOT|WVP)"')
+DAYS_PER_SCENE = 5
+
+
+class RetryableError(Exception):
+    """
+    Response status is 429 or 5xx, request can be repeated.
+    """
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header, Sentinel Hub sends milliseconds
+    see settings.RETRY_AFTER_SCALE
+    :return: seconds or None
+    """
+    if not value:
+        return None
+    try:
+        return float(value) * settings.RETRY_AFTER_SCALE
+    except ValueError:
+        return None
+
+
+def request_units(width, height, input_bands, float32=False, scenes=1):
+    """
+    PU = area factor x bands factor x output factor x scenes,
+    area factor is width * height / 512^2 (at least 0.01), bands factor is
+    input bands / 3, FLOAT32 output counts twice, ORBIT mosaicking counts
+    every expected scene of time range. Request costs at least 0.005 PU.
+    """
+    area = max(width * height / (512 * 512), 0.01)
+    bands = max(input_bands, 1) / 3
+    output_factor = 2 if float32 else 1
+    return max(area * bands * output_factor * scenes, 0.005)
+
+
+def estimate_processing_units(download_request):
+    """
+    :param download_request: sentinelhub.DownloadRequest of Processing API
+    :return: estimated PU, see request_units
+    """
+    payload = download_request.post_values or {}
+    output = payload.get("output", {})
+    width = output.get("width") or 512
+    height = output.get("height") or 512
+    evalscript = payload.get("evalscript", "")
+
+    scenes = 1
+    if "ORBIT" in evalscript:
+        time_range = payload["input"]["data"][0]["dataFilter"]["timeRange"]
+        days = (_parse_day(time_range["to"]) - _parse_day(time_range["from"])) / 86400 + 1
+        scenes = max(days / DAYS_PER_SCENE, 1)
+    return request_units(width, height, len(set(INPUT_BANDS_RE.findall(evalscript))),
+                         "FLOAT32" in evalscript, scenes)
+
+
+def _parse_day(timestamp):
+    return time.mktime(time.strptime(timestamp[:10], "%Y-%m-%d"))
+
+
+class TokenBucket(object):
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """
+        :return: seconds until amount is available, 0 if it is taken now
+        """
+        self._refill()
+        # request larger than bucket waits for full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / self.rate
+
+
+class Scheduler(object):
+    """
+    Shared by all coroutines of AsyncDownloadEngine.
+    """
+
+    def __init__(self, requests_per_minute=None, units_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute or settings.SCHEDULER_REQUESTS_PER_MINUTE)
+        self.units = TokenBucket(units_per_minute or settings.SCHEDULER_PU_PER_MINUTE)
+        self.paused_until = 0
+        self._lock = None
+        self.stats = {"requests": 0, "processing_units": 0.0, "retries": 0, "throttled": 0}
+
+    async def acquire(self, units):
+        """
+        Wait until both buckets can pay for one request of given PU cost.
+        """
+        if self._lock is None:
+            # lock belongs to running loop, scheduler can be created before it
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                wait = self.requests.wait_time(1)
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                wait = self.units.wait_time(units)
+                if wait:
+                    # request token is already taken, give it back
+                    self.requests.tokens += 1
+                    await asyncio.sleep(wait)
+                    continue
+                break
+        self.stats["requests"] += 1
+        self.stats["processing_units"] += units
+
+    def backoff(self, attempt, error):
+        """
+        :param attempt: 0 based number of failed attempt
+        :param error: RetryableError
+        :return: seconds to wait before next attempt
+        """
+        self.stats["retries"] += 1
+        delay = min(settings.SCHEDULER_BACKOFF_MAX, settings.SCHEDULER_BACKOFF_BASE * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after + random.uniform(0, settings.SCHEDULER_BACKOFF_BASE))
+        if error.status == 429:
+            # whole account is over limit, every job waits
+            self.stats["throttled"] += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
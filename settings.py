@@ -8,9 +8,190 @@ SENTINEL_HUB_SECRET_KEY = os.environ.get("SENTINEL_HUB_SECRET_KEY")
 SENTINEL_HUB_CLIENT_ID = os.environ.get("SENTINEL_HUB_CLIENT_ID")
 SENTINEL_HUB_INSTANCE_ID = os.environ.get("SENTINEL_HUB_INSTANCE_ID")
 
+SENTINEL_HUB_BASE_URL = os.environ.get(
+    "SENTINEL_HUB_BASE_URL", "https://services.sentinel-hub.com"
+)
+SENTINEL_HUB_OAUTH_URL = f"{SENTINEL_HUB_BASE_URL}/oauth/token"
+
 CLI = True
 LOG_LEVEL = "INFO"
 
+# Download engine used by main_cli: "async", "mp"(multiprocessing.Pool), "sync"
+# or "shm"(multiprocessing.Pool, decoded rasters go into cube through shared memory)
+DOWNLOAD_MODE = "async"
+ASYNC_MAX_CONCURRENCY = 8  # requests in flight at the same time
+ASYNC_CONNECTION_LIMIT = 16  # size of shared HTTP connection pool
+DOWNLOAD_TIMEOUT = 120  # seconds
+OAUTH_TOKEN_LEEWAY = 60  # refresh token this many seconds before it expires
+# processes of "shm" pool, every worker has one request in flight like one async slot
+SHM_WORKERS = ASYNC_MAX_CONCURRENCY
+
+# Account limits of async engine (scheduler.py), check your plan on
+# https://apps.sentinel-hub.com/dashboard/#/account/settings
+SCHEDULER_REQUESTS_PER_MINUTE = 300
+SCHEDULER_PU_PER_MINUTE = 300
+SCHEDULER_MAX_RETRIES = 5
+SCHEDULER_BACKOFF_BASE = 1  # seconds, doubled on every retry
+SCHEDULER_BACKOFF_MAX = 60  # seconds
+RETRY_AFTER_SCALE = 0.001  # Retry-After header of Sentinel Hub is in milliseconds
+
+# Per job metrics (metrics.py), JSON lines file, Prometheus text file and
+# local http endpoint http://127.0.0.1:<port>/metrics, None is disabled
+METRICS_JSONL_PATH = os.environ.get("FIELDS_METRICS_JSONL")
+METRICS_PROMETHEUS_PATH = os.environ.get("FIELDS_METRICS_PROMETHEUS")
+METRICS_PORT = None
+
+# Catalog search before download, only dates with acquisition are requested
+CATALOG_PLANNING = True
+CATALOG_COLLECTION = "sentinel-2-l2a"
+CATALOG_CACHE_DIR = ".catalog"  # inside field "dir"
+CATALOG_PAGE_LIMIT = 100
+CATALOG_CACHE_TTL = 6 * 60 * 60  # seconds, only for ranges which are not settled
+CATALOG_SETTLE_DAYS = 3  # range ended this many days ago never gets new acquisitions
+
+# Persistent response cache, LRU eviction when size is over budget,
+# dates newer than CATALOG_SETTLE_DAYS are not cached
+RESPONSE_CACHE = True
+RESPONSE_CACHE_DIR = os.environ.get(
+    "FIELDS_RESPONSE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "fields_drones", "responses")
+)
+RESPONSE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Run journal (journal.py), SQLite file inside field "dir"
+JOURNAL_FILE = "journal.sqlite"
+JOURNAL_VERIFY_CHECKSUM = True  # --resume compares sha256 of saved files
+
+# Local service (daemon.py), identical requests in flight are sent once,
+# queued requests run by priority of caller class (lower first)
+DAEMON_PORT = 8765
+DAEMON_SOCKET = "/tmp/fields_drones.sock"  # daemon_client.py --socket default
+DAEMON_WORKERS = 8  # requests executed at once
+DAEMON_PRIORITIES = {
+    "interactive": 0,
+    "service": 1,
+    "batch": 2,
+}
+DAEMON_DEFAULT_PRIORITY = "service"
+DAEMON_JOB_TIMEOUT = 3600  # s, POST /jobs waits at most this long
+
+# Processing API limit of output width/height, larger bbox is split into tiles
+MAX_REQUEST_DIMENSION = 2500
+# Output resolution planner (resolution.py), budgets of None are not checked,
+# --resolution, --max-pixels, --max-bytes and --max-pu override them
+NATIVE_RESOLUTION = 10  # m/px of Sentinel-2 B02, B03, B04, B08, finer is oversampling
+MAX_RESOLUTION = 2500  # m/px
+MAX_PIXELS = None  # width * height of output
+MAX_BYTES = None  # uncompressed output
+MAX_PU = None  # processing units per request
+MOSAIC_DIR = "mosaic"  # inside field "dir", stitched tiles as <band>_<date>_<size>_<bbox>.npy
+# inside field "dir", <band>/<date>.png of raw mode and multi band requests
+BAND_FILES_DIR = "bands"
+
+# Deduplicated scenes (scene_store.py) inside field "dir", identical scenes of
+# adjacent dates are stored once, response files of dates are hard links to them
+SCENE_DEDUP = True
+SCENE_DIR = "scenes"
+SCENE_HASH = "pixels"  # pixels (decoded) or bytes (response file)
+SCENE_REBUILD_WORKERS = None  # processes of python scene_store.py, default one per CPU
+
+# Footprints of downloaded rasters (spatial_index.py), SQLite file inside field "dir",
+# overlapping requests of the same date and band are cropped locally
+SPATIAL_INDEX = True
+SPATIAL_INDEX_FILE = "rasters.sqlite"
+SPATIAL_INDEX_RESOLUTION_TOLERANCE = 0.05  # relative difference of pixel size
+SPATIAL_INDEX_MAX_STRIPS = 4  # more missing strips, whole bbox is requested
+
+# --preview, WMS thumbnails of SENTINEL_HUB_INSTANCE_ID layers (named as band types)
+# inside field "dir" <band>/<date>.png and contact sheet (preview.py)
+PREVIEW_DIR = "preview"
+PREVIEW_WIDTH = 256  # px, height follows bbox
+PREVIEW_THREADS = 16  # parallel WMS requests
+PREVIEW_COLUMNS = 6  # thumbnails per row of contact sheet
+PREVIEW_MIN_VALID = 0.5  # dates with less data in thumbnail are not refined
+
+# --format cog, tiled GeoTIFF with overviews inside field "dir" <band>/<date>.tif (cog.py)
+OUTPUT_FORMAT = "png"
+COG_DIR = "cog"
+COG_TILE_SIZE = 256  # px, multiple of 16
+COG_COMPRESSION = "deflate"  # deflate, lzw or zstd (lzw and zstd need imagecodecs)
+COG_COMPRESSION_LEVEL = 6
+COG_PREDICTOR = True  # horizontal for integers, floating point for FLOAT32
+# --sample-type, None keeps sampleType of band script, UINT16 and FLOAT32 are
+# requested as TIFF, UINT16 stores (value + UINT16_OFFSET) * UINT16_SCALE
+OUTPUT_SAMPLE_TYPE = None
+UINT16_SCALE = 10000
+UINT16_OFFSET = 1
+
+# --composite, inside field "dir" <band>/<start>_<end>/<reducer>.tif (composite.py)
+COMPOSITE_DIR = "composite"
+COMPOSITE_REDUCERS = ("max", "mean", "median", "latest")
+COMPOSITE_MEDIAN_BINS = 64  # histogram bins per pixel, median error is half a bin
+COMPOSITE_VALUE_RANGE = (-1.0, 1.0)  # histogram range of FLOAT32 and UINT16 index values
+
+# --cube, inside field "dir" <band>/<size>_<bbox hash>/ chunked time series store (cube.py)
+CUBE_DIR = "cube"
+CUBE_CHUNK_SIZE = 256  # px, chunk is one date x 256 x 256 x bands
+CUBE_COMPRESSION_LEVEL = 1  # zlib, low level keeps writes close to disk speed
+
+# Multi-temporal mode, dates of one window are sent in one ORBIT request
+MULTI_TEMPORAL_WINDOW_DAYS = 31
+
+# Raw mode, B04, B08 and dataMask are downloaded once as FLOAT32 TIFF and
+# NDVI visualizations are rendered locally (band_math.py)
+RAW_BATCH_SIZE = 8  # dates rendered together as one stack
+RAW_BANDS_EVALSCRIPT = """
+    //VERSION=3
+
+    function evaluatePixel(samples) {
+        return [samples.B04, samples.B08, samples.dataMask];
+    }
+
+    function setup() {
+      return {
+        input: [{
+          bands: [
+            "B04",
+            "B08",
+            "dataMask"
+          ]
+        }],
+        output: {
+          bands: 3,
+          sampleType: "FLOAT32"
+        }
+      }
+    }
+"""
+
+# Cloud probe (cloud_probe.py), low resolution CLM before full download of a date,
+# date is skipped when cloudy part of field is above field "cloud_threshold"
+CLOUD_PROBE = True
+CLOUD_PROBE_SIZE = 64  # px, longer side of probe
+CLOUD_THRESHOLD = 0.5  # default of fields without "cloud_threshold"
+CLOUD_PROBE_EVALSCRIPT = """
+    //VERSION=3
+
+    function evaluatePixel(samples) {
+        return [samples.CLM, samples.dataMask];
+    }
+
+    function setup() {
+      return {
+        input: [{
+          bands: [
+            "CLM",
+            "dataMask"
+          ]
+        }],
+        output: {
+          bands: 2,
+          sampleType: "UINT8"
+        }
+      }
+    }
+"""
+
 BAND_TYPES = {
     "NDVI-CM": {
         "desc": """
@@ -168,6 +349,8 @@ BAND_TYPES = {
     },
     "NDVIINDEX": {
      "desc": """DVI (Normalized Difference Vegetation Index) - INDEX""",
+     # leading output samples which are index values, --sample-type UINT16 scales only them
+     "index_bands": 1,
      "exec_script": """
      //VERSION=3
 
@@ -302,12 +485,17 @@ BAND_TYPES = {
 
 FIELDS = {
         "test": {
-            "maxcc": 0.3,
+            "maxcc": 0.3,  # max scene cloud coverage, 0-1
+            "cloud_threshold": 0.5,  # max cloudy part of field, see cloud_probe.py
             "width": 512,
             "height": 856,
             "dir": "/tmp/test_dir",
             "resolution": 6,# meters for small area change resolution to 6 or some other from 1 to 2500
+            # resolution finer than NATIVE_RESOLUTION is used only with --resolution
             "coordinates": [35.424557,32.521052, 35.560513,32.650360],
+            # polygon or multipolygon of field as GeoJSON or WKT, requests are clipped to it
+            # and bbox of geometry is used when "coordinates" are not set
+            # "geometry": "POLYGON((35.43 32.53, 35.55 32.52, 35.55 32.64, 35.43 32.53))",
             # "coordinates": [34.878856,32.120528, 34.885315,32.129178],
             "time_range": {
                 # "start_date": "2020-05-01",
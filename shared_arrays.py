@@ -0,0 +1,42 @@
+"""
+Hand decoded rasters from pool workers to parent through
+multiprocessing.shared_memory, only a small descriptor is pickled.
+Worker creates the block, parent maps it zero-copy and frees it.
+"""
+import collections
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+SharedArray = collections.namedtuple("SharedArray", ["name", "shape", "dtype"])
+
+
+def share_array(array):
+    """
+    Called in worker, copy array into a new shared memory block.
+    :param array: numpy array
+    :return: SharedArray descriptor
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    descriptor = SharedArray(shm.name, array.shape, array.dtype.str)
+    # block is unlinked by parent, worker must not remove it when it exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return descriptor
+
+
+def consume_array(descriptor, func):
+    """
+    Called in parent, func gets zero-copy view of block and must not keep it,
+    block is freed when func returns.
+    :param descriptor: SharedArray from share_array
+    :param func: callable(array)
+    :return: result of func
+    """
+    shm = shared_memory.SharedMemory(name=descriptor.name)
+    try:
+        return func(np.ndarray(descriptor.shape, dtype=descriptor.dtype, buffer=shm.buf))
+    finally:
+        shm.close()
+        shm.unlink()
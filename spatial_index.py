@@ -0,0 +1,270 @@
+"""
+Footprint index of downloaded rasters (SQLite R*Tree) next to field data_dir.
+Request of the same product (evalscript, data source, output format), CRS,
+date and resolution which falls inside stored rasters is cropped locally,
+request covered partly downloads only missing strips.
+
+python spatial_index.py /tmp/test_dir  # every indexed raster
+"""
+import copy
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+import settings
+from utils import decode_image, lazy_import
+
+# index is opened by every downloader, numpy is needed only for cropping
+np = lazy_import("numpy")
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rasters (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    product TEXT NOT NULL,
+    crs TEXT NOT NULL,
+    date TEXT NOT NULL,
+    min_x REAL, min_y REAL, max_x REAL, max_y REAL,
+    width INTEGER, height INTEGER
+);
+CREATE INDEX IF NOT EXISTS rasters_product ON rasters (product, crs, date);
+CREATE VIRTUAL TABLE IF NOT EXISTS rasters_rtree USING rtree (id, min_x, max_x, min_y, max_y);
+"""
+
+# Footprint of one request or raster, bbox is [min_x, min_y, max_x, max_y]
+QUERY = """
+SELECT r.path, r.min_x, r.min_y, r.max_x, r.max_y, r.width, r.height
+FROM rasters_rtree t JOIN rasters r ON r.id = t.id
+WHERE t.max_x > ? AND t.min_x < ? AND t.max_y > ? AND t.min_y < ?
+AND r.product = ? AND r.crs = ? AND r.date = ?
+"""
+
+
+def request_footprint(download_request):
+    """
+    :param download_request: sentinelhub.DownloadRequest of one day Processing API request
+    :return: dict product, crs, date, bbox, size or None if request is not one day
+    """
+    payload = download_request.post_values or {}
+    try:
+        bounds = payload["input"]["bounds"]
+        time_range = payload["input"]["data"][0]["dataFilter"]["timeRange"]
+        size = (payload["output"]["width"], payload["output"]["height"])
+    except (KeyError, IndexError, TypeError):
+        return None
+    if "bbox" not in bounds or time_range["from"][:10] != time_range["to"][:10]:
+        return None
+
+    # everything but bbox, size and time decides what is in pixels
+    product = copy.deepcopy(payload)
+    del product["input"]["bounds"]["bbox"]
+    del product["output"]["width"], product["output"]["height"]
+    for data in product["input"]["data"]:
+        data.get("dataFilter", {}).pop("timeRange", None)
+    return {
+        "product": hashlib.sha1(json.dumps(product, sort_keys=True).encode()).hexdigest(),
+        "crs": bounds.get("properties", {}).get("crs", ""),
+        "date": time_range["from"][:10],
+        "bbox": list(bounds["bbox"]),
+        "size": size,
+    }
+
+
+class RasterIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # connection is not shared with pool workers, every process opens its own
+        return {"path": self.path, "_conn": None, "_pid": None}
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            dir_name = os.path.dirname(self.path)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def add(self, path, footprint):
+        """
+        :param path: .png/.tif response or .npy mosaic
+        :param footprint: see request_footprint
+        """
+        min_x, min_y, max_x, max_y = footprint["bbox"]
+        width, height = footprint["size"]
+        with self.conn:
+            self._remove(path)
+            cursor = self.conn.execute(
+                "INSERT INTO rasters (path, product, crs, date, min_x, min_y, max_x, max_y, "
+                "width, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, footprint["product"], footprint["crs"], footprint["date"],
+                 min_x, min_y, max_x, max_y, width, height)
+            )
+            self.conn.execute(
+                "INSERT INTO rasters_rtree (id, min_x, max_x, min_y, max_y) VALUES (?, ?, ?, ?, ?)",
+                (cursor.lastrowid, min_x, max_x, min_y, max_y)
+            )
+
+    def add_request(self, download_request, path):
+        footprint = request_footprint(download_request)
+        if footprint:
+            self.add(path, footprint)
+
+    def _remove(self, path):
+        row = self.conn.execute("SELECT id FROM rasters WHERE path = ?", (path,)).fetchone()
+        if row:
+            self.conn.execute("DELETE FROM rasters_rtree WHERE id = ?", row)
+            self.conn.execute("DELETE FROM rasters WHERE id = ?", row)
+
+    def query(self, footprint, tolerance=None):
+        """
+        :param footprint: see request_footprint
+        :param tolerance: allowed relative difference of pixel size,
+        default settings.SPATIAL_INDEX_RESOLUTION_TOLERANCE
+        :return: list of raster dicts (path, bbox, size) intersecting footprint,
+        largest overlap first
+        """
+        tolerance = settings.SPATIAL_INDEX_RESOLUTION_TOLERANCE if tolerance is None else tolerance
+        min_x, min_y, max_x, max_y = footprint["bbox"]
+        width, height = footprint["size"]
+        dx, dy = (max_x - min_x) / width, (max_y - min_y) / height
+        rasters = []
+        stale = []
+        for path, r_min_x, r_min_y, r_max_x, r_max_y, r_width, r_height in self.conn.execute(
+                QUERY, (min_x, max_x, min_y, max_y,
+                        footprint["product"], footprint["crs"], footprint["date"])):
+            r_dx = (r_max_x - r_min_x) / r_width
+            r_dy = (r_max_y - r_min_y) / r_height
+            if abs(r_dx - dx) > tolerance * dx or abs(r_dy - dy) > tolerance * dy:
+                continue
+            if not os.path.exists(path):
+                stale.append(path)
+                continue
+            overlap = ((min(max_x, r_max_x) - max(min_x, r_min_x))
+                       * (min(max_y, r_max_y) - max(min_y, r_min_y)))
+            rasters.append({
+                "path": path,
+                "bbox": [r_min_x, r_min_y, r_max_x, r_max_y],
+                "size": (r_width, r_height),
+                "overlap": overlap,
+            })
+        if stale:
+            with self.conn:
+                for path in stale:
+                    self._remove(path)
+        return sorted(rasters, key=lambda r: -r["overlap"])
+
+    def rasters(self):
+        return self.conn.execute(
+            "SELECT path, date, crs, min_x, min_y, max_x, max_y, width, height, product "
+            "FROM rasters ORDER BY date, path").fetchall()
+
+
+def load_raster(path):
+    """
+    .npy mosaic is memory mapped, crop of it reads only cropped rows
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    with open(path, "rb") as f:
+        return decode_image(f.read())
+
+
+def _source_index(centers, start, step, length):
+    index = np.floor((centers - start) / step).astype(np.int64)
+    valid = np.nonzero((index >= 0) & (index < length))[0]
+    return index, valid
+
+
+def crop_rasters(footprint, rasters):
+    """
+    Fill pixel grid of footprint from stored rasters, nearest pixel,
+    aligned windows are plain slices of source.
+    :param footprint: see request_footprint
+    :param rasters: result of RasterIndex.query
+    :return: (image or None, list of missing windows (row, col, height, width))
+    """
+    min_x, min_y, max_x, max_y = footprint["bbox"]
+    width, height = footprint["size"]
+    xs = min_x + (np.arange(width) + 0.5) * (max_x - min_x) / width
+    ys = max_y - (np.arange(height) + 0.5) * (max_y - min_y) / height
+    covered = np.zeros((height, width), dtype=bool)
+    image = None
+
+    for raster in rasters:
+        r_min_x, r_min_y, r_max_x, r_max_y = raster["bbox"]
+        r_width, r_height = raster["size"]
+        cols, valid_cols = _source_index(xs, r_min_x, (r_max_x - r_min_x) / r_width, r_width)
+        rows, valid_rows = _source_index(-ys, -r_max_y, (r_max_y - r_min_y) / r_height, r_height)
+        if not len(valid_cols) or not len(valid_rows):
+            continue
+        # source pixel index grows with request pixel, covered part is one rectangle
+        r0, r1 = valid_rows[0], valid_rows[-1] + 1
+        c0, c1 = valid_cols[0], valid_cols[-1] + 1
+        if covered[r0:r1, c0:c1].all():
+            continue
+
+        source = load_raster(raster["path"])
+        if source.ndim == 2:
+            source = source[:, :, np.newaxis]
+        if image is None:
+            image = np.zeros((height, width) + source.shape[2:], dtype=source.dtype)
+        src_rows, src_cols = rows[r0:r1], cols[c0:c1]
+        if (np.all(np.diff(src_rows) == 1) and np.all(np.diff(src_cols) == 1)):
+            crop = source[src_rows[0]:src_rows[-1] + 1, src_cols[0]:src_cols[-1] + 1]
+        else:
+            crop = source[src_rows][:, src_cols]
+        image[r0:r1, c0:c1] = crop
+        covered[r0:r1, c0:c1] = True
+        if covered.all():
+            break
+
+    if image is None:
+        return None, [(0, 0, height, width)]
+    return image, missing_windows(covered)
+
+
+def missing_windows(covered):
+    """
+    Split not covered pixels into rectangles, rows with the same
+    not covered column runs are merged into one strip.
+    :param covered: bool array (height, width)
+    :return: list of windows (row, col, height, width)
+    """
+    windows = []
+    open_runs = {}
+    previous = ()
+    for row in range(covered.shape[0] + 1):
+        runs = _runs(~covered[row]) if row < covered.shape[0] else ()
+        if runs != previous:
+            for start, end in previous:
+                windows.append((open_runs[(start, end)], start, row - open_runs[(start, end)],
+                                end - start))
+            open_runs = {run: row for run in runs}
+            previous = runs
+    return windows
+
+
+def _runs(mask):
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0]
+    return tuple(zip(starts.tolist(), ends.tolist()))
+
+
+if __name__ == '__main__':
+    index = RasterIndex(os.path.join(sys.argv[1], settings.SPATIAL_INDEX_FILE))
+    for path, date, crs, *bbox_size, product in index.rasters():
+        print("{0}\t{1}\t{2}\t{3}\t{4}".format(date, crs, bbox_size, product[:8], path))
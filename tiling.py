@@ -0,0 +1,168 @@
+"""
+Split large BBox into request sized tiles and stitch downloaded tiles
+into one raster through a memory mapped buffer.
+Processing API accepts at most settings.MAX_REQUEST_DIMENSION px per side.
+"""
+import asyncio
+import collections
+import logging
+import math
+import os
+
+import numpy as np
+from sentinelhub import BBox
+
+import settings
+from metrics import timed_phase
+from utils import decode_image
+
+log = logging.getLogger(__name__)
+
+# window is (row offset, column offset, height, width) in mosaic pixels
+Tile = collections.namedtuple("Tile", ["bbox", "size", "window"])
+
+
+def needs_tiling(size, max_dimension=None):
+    max_dimension = max_dimension or settings.MAX_REQUEST_DIMENSION
+    return max(size) > max_dimension
+
+
+def split_bbox(bbox, size, max_dimension=None):
+    """
+    Output of Processing API maps bbox linearly onto width x height in bbox CRS,
+    so tiles cut on pixel borders stitch back without seams.
+    :param bbox: sentinelhub BBox
+    :param size: (width, height) of full raster
+    :param max_dimension: max tile width/height in px
+    :return: list of Tile, row by row from north-west corner
+    """
+    max_dimension = max_dimension or settings.MAX_REQUEST_DIMENSION
+    width, height = size
+    cols = math.ceil(width / max_dimension)
+    rows = math.ceil(height / max_dimension)
+    x_edges = [width * c // cols for c in range(cols + 1)]
+    y_edges = [height * r // rows for r in range(rows + 1)]
+
+    tiles = []
+    for r in range(rows):
+        for c in range(cols):
+            x0, x1 = x_edges[c], x_edges[c + 1]
+            y0, y1 = y_edges[r], y_edges[r + 1]
+            tiles.append(window_tile(bbox, size, (y0, x0, y1 - y0, x1 - x0)))
+    log.info("BBOX {0}x{1} px split into {2}x{3} tiles".format(width, height, cols, rows))
+    return tiles
+
+
+def window_tile(bbox, size, window):
+    """
+    :param bbox: sentinelhub BBox of full raster
+    :param size: (width, height) of full raster
+    :param window: (row, col, height, width) in raster pixels
+    :return: Tile of window, its pixels are the same as pixels of full raster
+    """
+    width, height = size
+    row, col, win_height, win_width = window
+    dx = (bbox.max_x - bbox.min_x) / width
+    dy = (bbox.max_y - bbox.min_y) / height
+    tile_bbox = BBox(
+        bbox=[
+            bbox.min_x + col * dx,
+            bbox.max_y - (row + win_height) * dy,
+            bbox.min_x + (col + win_width) * dx,
+            bbox.max_y - row * dy,
+        ],
+        crs=bbox.crs,
+    )
+    return Tile(tile_bbox, (win_width, win_height), window)
+
+
+class Mosaic(object):
+    """
+    Raster stored as .npy file and filled tile by tile through np.memmap,
+    whole mosaic never has to be in RAM.
+    Tiles are pasted into path.tmp, path appears only when every tile is pasted.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.width, self.height = size
+        self.array = None
+        self.closed = False
+
+    def paste(self, tile, image):
+        if self.closed:
+            raise RuntimeError("Mosaic {0} is already closed".format(self.path))
+        if self.array is None:
+            dir_name = os.path.dirname(self.path)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name, exist_ok=True)
+            # bands and dtype are known only after first tile is decoded
+            self.array = np.lib.format.open_memmap(
+                self.tmp_path, mode="w+", dtype=image.dtype,
+                shape=(self.height, self.width) + image.shape[2:]
+            )
+        row, col, height, width = tile.window
+        self.array[row:row + height, col:col + width] = image
+
+    def close(self, complete=True):
+        """
+        :param complete: every tile is pasted, otherwise partial mosaic is removed
+        """
+        self.closed = True
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+            if complete:
+                os.replace(self.tmp_path, self.path)
+            else:
+                os.remove(self.tmp_path)
+
+
+def _decode(content):
+    with timed_phase("decode"):
+        return decode_image(content)
+
+
+async def download_mosaic(engine, tiles, download_requests, path, size):
+    """
+    Download all tiles concurrently through engine and paste them into mosaic.
+    :param engine: entered AsyncDownloadEngine
+    :param tiles: list of Tile
+    :param download_requests: DownloadRequest for every tile
+    :param path: .npy output path
+    :param size: (width, height) of mosaic
+    :return: path
+    """
+    loop = asyncio.get_event_loop()
+    mosaic = Mosaic(path, size)
+
+    async def _tile(tile, download_request):
+        download_request.save_response = False
+        content = await engine.execute(download_request)
+        image = await loop.run_in_executor(None, _decode, content)
+        with timed_phase("write"):
+            mosaic.paste(tile, image)
+
+    tasks = [asyncio.ensure_future(_tile(tile, req))
+             for tile, req in zip(tiles, download_requests)]
+    complete = False
+    try:
+        if tasks:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in tasks:
+            task.cancel()
+        # mosaic is closed only when no tile can paste into it any more
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        complete = True
+    finally:
+        if not complete:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        mosaic.close(complete)
+    log.info(f"Mosaic Saved in {path}")
+    return path
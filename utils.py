@@ -1,24 +1,71 @@
 # -*- coding: utf-8 -*-
-import concurrent.futures
 import functools
+import importlib
+import io
 import logging
 import os
-import multiprocessing as mp
+import tempfile
 import time
 
-import numpy as np
-import matplotlib.pyplot as plt
-
 import settings
-
-try:
-    import colorlog
-except ImportError:
-    colorlog = None
+from metrics import REGISTRY
 
 logger = logging.getLogger(__file__)
 
 
+class LazyImport(object):
+    """
+    Module or attribute of module which is imported on first use,
+    see lazy_import.
+    """
+
+    def __init__(self, module_name, name=None):
+        self._module_name = module_name
+        self._name = name
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            module = importlib.import_module(self._module_name)
+            self._target = getattr(module, self._name) if self._name else module
+        return self._target
+
+    def __getattr__(self, attr):
+        if attr in ("_module_name", "_name", "_target"):
+            # instance without state (copy, pickle), never import
+            raise AttributeError(attr)
+        return getattr(self._resolve(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self._module_name + ("." + self._name if self._name else "")
+        return "<lazy {0}{1}>".format(name, "" if self._target is None else " imported")
+
+
+def lazy_import(module_name, *names):
+    """
+    Defer import of heavy packages (numpy, sentinelhub, matplotlib...) until
+    they are used, so --help and runs which do not need them start fast.
+    np = lazy_import("numpy")
+    BBox, CRS = lazy_import("sentinelhub", "BBox", "CRS")
+    :return: LazyImport of module, or of every name (one LazyImport for one name)
+    """
+    if not names:
+        return LazyImport(module_name)
+    proxies = tuple(LazyImport(module_name, name) for name in names)
+    return proxies[0] if len(proxies) == 1 else proxies
+
+
+futures = lazy_import("concurrent.futures")
+mp = lazy_import("multiprocessing")
+np = lazy_import("numpy")
+plt = lazy_import("matplotlib.pyplot")
+tifffile = lazy_import("tifffile")
+Image = lazy_import("PIL.Image")
+
+
 def plot_image(image, factor=1):
     """
     Utility function for plotting RGB images.
@@ -41,6 +88,11 @@ def init_logger(logger, log_file=None,):
     else:
         lo_to_file_handler = None
 
+    try:
+        import colorlog
+    except ImportError:
+        colorlog = None
+
     level = getattr(logging, settings.LOG_LEVEL, logging.INFO)
     logger.setLevel(level)
     log_str_color_format = (
@@ -71,30 +123,87 @@ def init_logger(logger, log_file=None,):
         logger.addHandler(ch)
 
 
-def init_mp_pool():
-    num_procs = mp.cpu_count()
-    if num_procs > 6:
-        num_procs = num_procs - 2
+def init_mp_pool(initializer=None, initargs=(), processes=None):
+    """
+    :param processes: pool size, default leaves 2 CPUs free on large machines
+    """
+    if processes:
+        num_procs = processes
     else:
-        num_procs = 1
+        num_procs = mp.cpu_count()
+        if num_procs > 6:
+            num_procs = num_procs - 2
+        else:
+            num_procs = 1
 
     print(f"Starting multiprocessing.Pool({num_procs})")
-    return mp.Pool(num_procs)
+    return mp.Pool(num_procs, initializer=initializer, initargs=initargs)
 
 
 def init_thread_pool_executor():
-    return concurrent.futures.ThreadPoolExecutor(max_workers=6)
+    return futures.ThreadPoolExecutor(max_workers=6)
+
+
+def decode_image(content):
+    """
+    Decode PNG/JPEG/TIFF response content into numpy array (height, width[, bands]).
+    """
+    if content[:4] in (b"II*\x00", b"MM\x00*"):
+        return tifffile.imread(io.BytesIO(content))
+    return np.array(Image.open(io.BytesIO(content)))
+
+
+def encode_tiff(array):
+    """
+    Encode array (height, width[, bands]) into TIFF bytes, any dtype.
+    """
+    buf = io.BytesIO()
+    tifffile.imwrite(buf, array)
+    return buf.getvalue()
+
+
+def encode_png(array):
+    """
+    Encode uint8 array (height, width[, 2|3|4 bands]) into PNG bytes.
+    """
+    buf = io.BytesIO()
+    Image.fromarray(array).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def atomic_write(path, data):
+    """
+    Write bytes to path through a temporary file in the same directory,
+    readers never see a half written file.
+    """
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name or None, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 def timeit(func):
-    """Simple decorator to measure wall-clock time of a function."""
+    """
+    Decorator to measure wall-clock time of a function,
+    duration goes to metrics histogram fields_run_seconds and stdout.
+    """
     @functools.wraps(func)
     def timed(*args, **kwargs):
         tstart = time.time()
         try:
             return func(*args, **kwargs)
         finally:
-            duration_ms = (time.time() - tstart) * 1000
-            print(f"{func.__name__} {duration_ms:2.2f} ms")
+            duration = time.time() - tstart
+            REGISTRY.observe("fields_run_seconds", duration, name=func.__name__)
+            REGISTRY.flush()
+            print(f"{func.__name__} {duration * 1000:2.2f} ms")
 
     return timed
\ No newline at end of file